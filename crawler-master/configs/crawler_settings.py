@@ -7,5 +7,144 @@ DEFAULT_HEADERS = {
 }
 
 MIN_DOMAIN_LENGTH = 3
-CRAWLER_WORKER_NUM = 5
+CRAWLER_WORKER_NUM = int(os.getenv("CRAWLER_WORKER_NUM", 5))
+# Number of crawler processes run by the supervisor, 1 runs the crawler in the main process
+CRAWLER_PROCESS_NUM = int(os.getenv("CRAWLER_PROCESS_NUM", 1))
+WORKER_RESTART_DELAY = float(os.getenv("WORKER_RESTART_DELAY", 1))
+WORKER_MAX_RESTART_DELAY = float(os.getenv("WORKER_MAX_RESTART_DELAY", 60))
+WORKER_DRAIN_TIMEOUT = float(os.getenv("WORKER_DRAIN_TIMEOUT", 300))
+METRICS_REPORT_INTERVAL = float(os.getenv("METRICS_REPORT_INTERVAL", 60))
+# Prometheus metrics endpoint, worker processes of the supervisor use METRICS_PORT + worker id. 0 disables it
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9464))
 DEFAULT_BATCH_SIZE = os.getenv("DEFAULT_BATCH_SIZE",1000)
+
+# Render jobs in flight are adapted between RENDER_MIN_CONCURRENCY and RENDER_MAX_CONCURRENCY (AIMD).
+# Renders slower than RENDER_PARK_AFTER seconds stop counting against the limit, up to RENDER_MAX_PARKED
+RENDER_INITIAL_CONCURRENCY = int(os.getenv("RENDER_INITIAL_CONCURRENCY", 2))
+RENDER_MIN_CONCURRENCY = int(os.getenv("RENDER_MIN_CONCURRENCY", 1))
+RENDER_MAX_CONCURRENCY = int(os.getenv("RENDER_MAX_CONCURRENCY", 16))
+RENDER_LATENCY_TARGET = float(os.getenv("RENDER_LATENCY_TARGET", 20.0))
+RENDER_PARK_AFTER = float(os.getenv("RENDER_PARK_AFTER", 30.0))
+RENDER_MAX_PARKED = int(os.getenv("RENDER_MAX_PARKED", 16))
+
+# Max number of messages of one crawling type processed at the same time.
+# Types which are not listed here are limited by CRAWLER_WORKER_NUM only.
+CRAWLING_TYPE_CONCURRENCY = {
+    "render": int(os.getenv("RENDER_CONCURRENCY", RENDER_MAX_CONCURRENCY + RENDER_MAX_PARKED)),
+}
+# Crawling types processed by their own worker threads instead of the CRAWLER_WORKER_NUM workers.
+# Render workers cover the adaptive limit and the parked renders, the render dispatcher decides how many run
+CRAWLING_TYPE_WORKERS = {
+    "render": int(os.getenv("RENDER_WORKER_NUM", RENDER_MAX_CONCURRENCY + RENDER_MAX_PARKED)),
+}
+
+# asyncio crawling mode
+ASYNC_MAX_IN_FLIGHT = int(os.getenv("ASYNC_MAX_IN_FLIGHT", 1000))
+ASYNC_PER_HOST_LIMIT = int(os.getenv("ASYNC_PER_HOST_LIMIT", 2))
+
+# How RequestsEngine and RenderAPIEngine try https/http and www. variants of a domain:
+# "sequential", "race" (all at once) or "staggered" (next variant starts after FALLBACK_STAGGER_DELAY)
+FALLBACK_MODE = os.getenv("FALLBACK_MODE", "staggered")
+FALLBACK_STAGGER_DELAY = float(os.getenv("FALLBACK_STAGGER_DELAY", 1.0))
+# Render jobs always take seconds, keep their stagger longer to avoid rendering every variant
+RENDER_FALLBACK_STAGGER_DELAY = float(os.getenv("RENDER_FALLBACK_STAGGER_DELAY", 10.0))
+FALLBACK_WINNER_CACHE_SIZE = int(os.getenv("FALLBACK_WINNER_CACHE_SIZE", 100000))
+
+# "auto" crawling type: the source is rendered only when it has less visible text than AUTO_RENDER_MIN_TEXT_LENGTH,
+# a text to markup ratio under AUTO_RENDER_MIN_TEXT_RATIO, or an empty SPA mount point or a noscript JavaScript
+# hint with less text than AUTO_RENDER_SHELL_TEXT_LENGTH. Decisions are kept per domain for AUTO_RENDER_DECISION_TTL
+AUTO_RENDER_MIN_TEXT_LENGTH = int(os.getenv("AUTO_RENDER_MIN_TEXT_LENGTH", 200))
+AUTO_RENDER_SHELL_TEXT_LENGTH = int(os.getenv("AUTO_RENDER_SHELL_TEXT_LENGTH", 1000))
+AUTO_RENDER_MIN_TEXT_RATIO = float(os.getenv("AUTO_RENDER_MIN_TEXT_RATIO", 0.02))
+AUTO_RENDER_SAMPLE_SIZE = int(os.getenv("AUTO_RENDER_SAMPLE_SIZE", 512 * 1024))
+AUTO_RENDER_CACHE_SIZE = int(os.getenv("AUTO_RENDER_CACHE_SIZE", 100000))
+AUTO_RENDER_DECISION_TTL = float(os.getenv("AUTO_RENDER_DECISION_TTL", 7 * 86400))
+
+# Push based RabbitMQ consumer (-i rmq_push). 0 prefetch follows the number of messages processed concurrently
+RMQ_PREFETCH_COUNT = int(os.getenv("RMQ_PREFETCH_COUNT", 0))
+RMQ_ACK_BATCH_SIZE = int(os.getenv("RMQ_ACK_BATCH_SIZE", 50))
+RMQ_ACK_INTERVAL = float(os.getenv("RMQ_ACK_INTERVAL", 0.2))
+
+# Errors are published in batches, retryable ones are retried after RETRY_DELAY * 2 ** (attempt - 1) seconds
+ERRORS_BATCH_SIZE = int(os.getenv("ERRORS_BATCH_SIZE", 100))
+ERRORS_MAX_LATENCY = float(os.getenv("ERRORS_MAX_LATENCY", 1))
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", 5))
+RETRY_DELAY = float(os.getenv("RETRY_DELAY", 60))
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", 3600))
+
+# HTTP connection pools and timeouts (seconds)
+HTTP_POOL_CONNECTIONS = int(os.getenv("HTTP_POOL_CONNECTIONS", 100))
+HTTP_POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", CRAWLER_WORKER_NUM))
+HTTP_KEEP_ALIVE = os.getenv("HTTP_KEEP_ALIVE", "1") == "1"
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", 10))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", 200))
+RENDER_POOL_MAXSIZE = int(os.getenv("RENDER_POOL_MAXSIZE", CRAWLER_WORKER_NUM))
+RENDER_CONNECT_TIMEOUT = float(os.getenv("RENDER_CONNECT_TIMEOUT", 10))
+RENDER_READ_TIMEOUT = float(os.getenv("RENDER_READ_TIMEOUT", 300))
+
+# Bodies are streamed and cut after MAX_BODY_SIZE bytes, non-text content types are skipped
+MAX_BODY_SIZE = int(os.getenv("MAX_BODY_SIZE", 5 * 1024 * 1024))
+BODY_CHUNK_SIZE = int(os.getenv("BODY_CHUNK_SIZE", 64 * 1024))
+# Bodies without a charset in Content-Type, BOM or <meta> are sniffed on their first CHARSET_SNIFF_SIZE bytes,
+# with cchardet when it is installed
+CHARSET_SNIFF_SIZE = int(os.getenv("CHARSET_SNIFF_SIZE", 16 * 1024))
+
+# DNS resolver shared by all DNS crawling types. Empty DNS_NAMESERVERS means /etc/resolv.conf
+DNS_NAMESERVERS = [ns.strip() for ns in os.getenv("DNS_NAMESERVERS", "").split(",") if ns.strip()]
+DNS_PORT = int(os.getenv("DNS_PORT", 53))
+DNS_TIMEOUT = float(os.getenv("DNS_TIMEOUT", 2.0))
+DNS_LIFETIME = float(os.getenv("DNS_LIFETIME", 5.0))
+DNS_MAX_IN_FLIGHT = int(os.getenv("DNS_MAX_IN_FLIGHT", 500))
+DNS_CACHE_SIZE = int(os.getenv("DNS_CACHE_SIZE", 100000))
+DNS_NEGATIVE_TTL = int(os.getenv("DNS_NEGATIVE_TTL", 300))
+DNS_MIN_TTL = int(os.getenv("DNS_MIN_TTL", 30))
+DNS_MAX_TTL = int(os.getenv("DNS_MAX_TTL", 86400))
+# sqlite file shared by worker processes on one node, empty keeps the cache in memory only
+DNS_CACHE_PATH = os.getenv("DNS_CACHE_PATH", "")
+# Expired rows of the sqlite DNS cache are deleted at most once per DNS_CACHE_PURGE_INTERVAL seconds
+DNS_CACHE_PURGE_INTERVAL = float(os.getenv("DNS_CACHE_PURGE_INTERVAL", 3600))
+
+# Elasticsearch bulk indexing. A bulk is sent when any of the thresholds is reached
+ES_BULK_SIZE = int(os.getenv("ES_BULK_SIZE", 500))
+ES_BULK_MAX_BYTES = int(os.getenv("ES_BULK_MAX_BYTES", 10 * 1024 * 1024))
+ES_BULK_MAX_LATENCY = float(os.getenv("ES_BULK_MAX_LATENCY", 5.0))
+ES_BULK_MAX_RETRIES = int(os.getenv("ES_BULK_MAX_RETRIES", 3))
+# Local write-ahead spool in front of Elasticsearch, worker processes use a worker-<id> directory in it.
+# Directories of worker ids beyond the number of processes are moved into the spools of running workers.
+# Crawl results are kept on disk while ES is slow or down and shipped after a restart. Empty ES_SPOOL_PATH disables it
+ES_SPOOL_PATH = os.getenv("ES_SPOOL_PATH", "")
+ES_SPOOL_SEGMENT_BYTES = int(os.getenv("ES_SPOOL_SEGMENT_BYTES", 64 * 1024 * 1024))
+ES_SPOOL_MAX_BYTES = int(os.getenv("ES_SPOOL_MAX_BYTES", 10 * 1024 ** 3))
+ES_SPOOL_MAX_LATENCY = float(os.getenv("ES_SPOOL_MAX_LATENCY", 5.0))
+ES_SPOOL_CLOSE_TIMEOUT = float(os.getenv("ES_SPOOL_CLOSE_TIMEOUT", 30.0))
+
+# Politeness: token buckets per host (www. and non-www. share one) and optionally per resolved IP
+POLITENESS_ENABLED = os.getenv("POLITENESS_ENABLED", "0") == "1"
+POLITENESS_HOST_RATE = float(os.getenv("POLITENESS_HOST_RATE", 1.0))
+POLITENESS_HOST_BURST = int(os.getenv("POLITENESS_HOST_BURST", 2))
+POLITENESS_PER_IP = os.getenv("POLITENESS_PER_IP", "0") == "1"
+POLITENESS_IP_RATE = float(os.getenv("POLITENESS_IP_RATE", 5.0))
+POLITENESS_IP_BURST = int(os.getenv("POLITENESS_IP_BURST", 10))
+POLITENESS_MAX_PENDING = int(os.getenv("POLITENESS_MAX_PENDING", 10000))
+
+# Content fingerprints of indexed documents. Empty CHANGE_DETECTION_PATH disables change detection.
+# Unchanged documents get only a "last_seen" update, or are skipped with CHANGE_DETECTION_MODE=skip
+CHANGE_DETECTION_PATH = os.getenv("CHANGE_DETECTION_PATH", "")
+CHANGE_DETECTION_MODE = os.getenv("CHANGE_DETECTION_MODE", "last_seen")
+SIMHASH_MAX_DISTANCE = int(os.getenv("SIMHASH_MAX_DISTANCE", 3))
+
+# sqlite file with ETag/Last-Modified of crawled pages, empty disables conditional requests
+VALIDATORS_PATH = os.getenv("VALIDATORS_PATH", "")
+
+# Crawl frontier: messages of a (domain, crawling type) crawled less than its recrawl interval ago are
+# acked without crawling. Empty FRONTIER_PATH disables it
+FRONTIER_PATH = os.getenv("FRONTIER_PATH", "")
+FRONTIER_CAPACITY = int(os.getenv("FRONTIER_CAPACITY", 50000000))
+DEFAULT_RECRAWL_INTERVAL = float(os.getenv("DEFAULT_RECRAWL_INTERVAL", 7 * 86400))
+RECRAWL_INTERVALS = {
+    _type.strip(): float(_interval)
+    for _type, _interval in (
+        item.split("=") for item in os.getenv("RECRAWL_INTERVALS", "source=604800,render=604800,careers=86400").split(",")
+        if "=" in item
+    )
+}
@@ -1,21 +1,56 @@
 import argparse
 import logging.config
 import os
+import signal
+import sys
+from functools import partial
 
 from dotenv import load_dotenv
 from elasticsearch import Elasticsearch
 from pymq import RabbitMQQueue, RabbitMQ, RabbitMQConnectionClient
 
-from configs.crawler_settings import DEFAULT_HEADERS, DEFAULT_BATCH_SIZE
+from configs.crawler_settings import DEFAULT_HEADERS, DEFAULT_BATCH_SIZE, CRAWLER_WORKER_NUM, \
+    CRAWLING_TYPE_CONCURRENCY, ASYNC_MAX_IN_FLIGHT, ASYNC_PER_HOST_LIMIT, FALLBACK_MODE, FALLBACK_STAGGER_DELAY, \
+    RENDER_FALLBACK_STAGGER_DELAY, FALLBACK_WINNER_CACHE_SIZE, HTTP_POOL_CONNECTIONS, HTTP_POOL_MAXSIZE, \
+    HTTP_KEEP_ALIVE, HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT, RENDER_POOL_MAXSIZE, RENDER_CONNECT_TIMEOUT, \
+    RENDER_READ_TIMEOUT, MAX_BODY_SIZE, BODY_CHUNK_SIZE, DNS_NAMESERVERS, DNS_PORT, DNS_TIMEOUT, DNS_LIFETIME, \
+    DNS_MAX_IN_FLIGHT, DNS_CACHE_SIZE, DNS_NEGATIVE_TTL, DNS_MIN_TTL, DNS_MAX_TTL, DNS_CACHE_PATH, ES_BULK_SIZE, \
+    ES_BULK_MAX_BYTES, ES_BULK_MAX_LATENCY, ES_BULK_MAX_RETRIES, POLITENESS_ENABLED, POLITENESS_HOST_RATE, \
+    POLITENESS_HOST_BURST, POLITENESS_PER_IP, POLITENESS_IP_RATE, POLITENESS_IP_BURST, POLITENESS_MAX_PENDING, \
+    CHANGE_DETECTION_PATH, CHANGE_DETECTION_MODE, SIMHASH_MAX_DISTANCE, VALIDATORS_PATH, RENDER_INITIAL_CONCURRENCY, \
+    RENDER_MIN_CONCURRENCY, RENDER_MAX_CONCURRENCY, RENDER_LATENCY_TARGET, RENDER_PARK_AFTER, RENDER_MAX_PARKED, \
+    FRONTIER_PATH, FRONTIER_CAPACITY, DEFAULT_RECRAWL_INTERVAL, RECRAWL_INTERVALS, CRAWLER_PROCESS_NUM, \
+    WORKER_RESTART_DELAY, WORKER_MAX_RESTART_DELAY, WORKER_DRAIN_TIMEOUT, METRICS_REPORT_INTERVAL, RMQ_PREFETCH_COUNT, \
+    RMQ_ACK_BATCH_SIZE, RMQ_ACK_INTERVAL, ERRORS_BATCH_SIZE, ERRORS_MAX_LATENCY, RETRY_MAX_ATTEMPTS, RETRY_DELAY, \
+    RETRY_MAX_DELAY, METRICS_PORT, AUTO_RENDER_MIN_TEXT_LENGTH, AUTO_RENDER_SHELL_TEXT_LENGTH, \
+    AUTO_RENDER_MIN_TEXT_RATIO, AUTO_RENDER_SAMPLE_SIZE, AUTO_RENDER_CACHE_SIZE, AUTO_RENDER_DECISION_TTL, \
+    CHARSET_SNIFF_SIZE, ES_SPOOL_PATH, ES_SPOOL_SEGMENT_BYTES, ES_SPOOL_MAX_BYTES, ES_SPOOL_MAX_LATENCY, \
+    ES_SPOOL_CLOSE_TIMEOUT, CRAWLING_TYPE_WORKERS, DNS_CACHE_PURGE_INTERVAL
 from configs.logging_config import logging_config
+from crawler.async_crawling_service import AsyncCrawlingService
 from crawler.base_crawler import BaseCrawler
 from crawler.crawling_service import CrawlingService
-from crawling_locator.locator import CrawlingEngineLocator
+from crawler.frontier import CrawlFrontier
+from crawler.scheduler import PolitenessScheduler
+from crawler.metrics import MetricsServer
+from crawler.supervisor import Supervisor, MetricsReporter
+from crawling_locator.locator import CrawlingEngineLocator, AutoRenderCrawler
+from engine.async_engine import AsyncRequestsEngine
+from engine.fallback import FallbackStrategy, WinnerCache, DEFAULT_VARIANTS
+from engine.http_session import PooledSession
+from engine.dns_cache import DNSCache, SQLiteDNSCacheStore
+from engine.validator_store import ValidatorStore
 from engine.dns_records import DNSRecordsCrawler, DNSRecordsBaseEngine
+from engine.render_classifier import RenderClassifier, RenderDecisionCache
+from engine.render_dispatcher import RenderDispatcher, AdaptiveLimit
 from engine.render_engine import RenderAPIEngine
 from engine.requests_engine import RequestsEngine
 from queues.data_queue import FakeDomainQueue
-from queues.output_queue import ESIndexQueue, PrintingQueue
+from queues.fingerprint_store import FingerprintStore
+from queues.output_queue import ESIndexQueue, PrintingQueue, BufferedQueue
+from queues.rmq_consumer import RMQConsumer
+from queues.rmq_publisher import RMQErrorPublisher
+from queues.spool import SpoolQueue
 from tools.structures import CrawlingType
 
 logger = logging.getLogger(__name__)
@@ -24,9 +59,9 @@ logger = logging.getLogger(__name__)
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("-i", "--input",
-                        choices=["rmq", "fake"],
+                        choices=["rmq", "rmq_push", "fake"],
                         default="rmq",
-                        help="Input queue: fake or rmq. RMQ by default")
+                        help="Input queue: fake, rmq or rmq_push, a prefetching consumer. RMQ by default")
 
     parser.add_argument("-o", "--output",
                         choices=["es", "console"],
@@ -43,13 +78,33 @@ def parse_args():
                         type=int,
                         help="Message batch size from an input queue")
 
+    parser.add_argument("-w", "--workers",
+                        default=CRAWLER_WORKER_NUM,
+                        type=int,
+                        help="Number of messages processed concurrently. 1 disables the worker pool")
+
+    parser.add_argument("-p", "--processes",
+                        default=CRAWLER_PROCESS_NUM,
+                        type=int,
+                        help="Number of crawler processes run by a supervisor. 1 runs the crawler in this process")
+
+    parser.add_argument("-a", "--asyncio",
+                        help="Crawl on an asyncio event loop with AsyncRequestsEngine",
+                        action='store_true')
+
     parser.add_argument("-sb", "--single_batch", help="Run in single batch mode?", action='store_true')
 
     return parser.parse_args()
 
 
-def map_input_queue(key):
-    if key == "rmq":
+def map_input_queue(key, prefetch_count):
+    if key == "rmq_push":
+        queue = RMQConsumer(os.getenv("RABBITMQ_CONNECTION_STRING"),
+                            os.getenv("DOMAINS_QUEUE_NAME"),
+                            prefetch_count=prefetch_count,
+                            ack_batch_size=RMQ_ACK_BATCH_SIZE,
+                            ack_interval=RMQ_ACK_INTERVAL)
+    elif key == "rmq":
         domains_queue = RabbitMQQueue(uri=os.getenv("DOMAINS_QUEUE_NAME"),
                                       exchange=os.getenv("DOMAINS_EXCHANGE_NAME"),
                                       routing=os.getenv("DOMAINS_ROUTING_KEY"))
@@ -62,10 +117,41 @@ def map_input_queue(key):
     return queue
 
 
-def map_output_queue(key):
+def orphaned_spools(worker_id, processes):
+    # Spools of worker ids beyond the current number of processes, each is adopted by one running worker
+    if not os.path.isdir(ES_SPOOL_PATH):
+        return []
+    orphans = []
+    for name in sorted(os.listdir(ES_SPOOL_PATH)):
+        prefix, _, number = name.partition("-")
+        if prefix == "worker" and number.isdigit() and int(number) >= processes \
+                and int(number) % processes == (worker_id or 0):
+            orphans.append(os.path.join(ES_SPOOL_PATH, name))
+    return orphans
+
+
+def map_output_queue(key, worker_id=None, processes=1):
     if key == "es":
         es = Elasticsearch(os.getenv("ELASTICSEARCH_CONNECTION_STRING"))
-        output = ESIndexQueue(es, os.getenv("ELASTICSEARCH_INDEX"))
+        fingerprints = None
+        if CHANGE_DETECTION_PATH:
+            fingerprints = FingerprintStore(CHANGE_DETECTION_PATH, max_distance=SIMHASH_MAX_DISTANCE)
+        output = ESIndexQueue(es, os.getenv("ELASTICSEARCH_INDEX"),
+                              batch_size=ES_BULK_SIZE,
+                              max_batch_bytes=ES_BULK_MAX_BYTES,
+                              max_latency=ES_BULK_MAX_LATENCY,
+                              max_retries=ES_BULK_MAX_RETRIES,
+                              fingerprints=fingerprints,
+                              unchanged_mode=CHANGE_DETECTION_MODE,
+                              validators=ValidatorStore(VALIDATORS_PATH) if VALIDATORS_PATH else None)
+        if ES_SPOOL_PATH:
+            output = SpoolQueue(output, os.path.join(ES_SPOOL_PATH, f"worker-{worker_id or 0}"),
+                                segment_bytes=ES_SPOOL_SEGMENT_BYTES,
+                                max_bytes=ES_SPOOL_MAX_BYTES,
+                                batch_size=ES_BULK_SIZE,
+                                max_latency=ES_SPOOL_MAX_LATENCY,
+                                close_timeout=ES_SPOOL_CLOSE_TIMEOUT,
+                                orphans=orphaned_spools(worker_id, max(1, processes)))
     elif key == "console":
         output = PrintingQueue()
     else:
@@ -75,11 +161,18 @@ def map_output_queue(key):
 
 def map_errors_queue(key):
     if key == "rmq":
-        _errors_queue = RabbitMQQueue(uri=os.getenv("ERRORS_QUEUE_NAME"),
+        publisher = RMQErrorPublisher(os.getenv("RABBITMQ_CONNECTION_STRING"),
                                       exchange=os.getenv("ERRORS_EXCHANGE_NAME"),
-                                      routing=os.getenv("ERRORS_ROUTING_KEY"))
-        queue = RabbitMQ(_errors_queue, RabbitMQConnectionClient(os.getenv("RABBITMQ_CONNECTION_STRING")))
-        queue.connect()
+                                      routing_key=os.getenv("ERRORS_ROUTING_KEY"),
+                                      retry_exchange=os.getenv("DOMAINS_EXCHANGE_NAME"),
+                                      retry_routing_key=os.getenv("DOMAINS_ROUTING_KEY"),
+                                      retry_queue_prefix=os.getenv("RETRY_QUEUE_PREFIX",
+                                                                   f"{os.getenv('DOMAINS_QUEUE_NAME')}.retry"),
+                                      max_attempts=RETRY_MAX_ATTEMPTS,
+                                      retry_delay=RETRY_DELAY,
+                                      max_retry_delay=RETRY_MAX_DELAY,
+                                      batch_size=ERRORS_BATCH_SIZE)
+        queue = BufferedQueue(publisher, batch_size=ERRORS_BATCH_SIZE, max_latency=ERRORS_MAX_LATENCY)
     elif key == "console":
         queue = PrintingQueue()
     else:
@@ -87,29 +180,194 @@ def map_errors_queue(key):
     return queue
 
 
-if __name__ == '__main__':
-    load_dotenv()
-    logging.config.dictConfig(logging_config)
-    args = parse_args()
-    source_engine = RequestsEngine(headers=DEFAULT_HEADERS)
-    render_engine = RenderAPIEngine(os.getenv("RENDER_API_URL"), headers=DEFAULT_HEADERS)
+def build_crawling_service(args, worker_id=None):
+    winners = WinnerCache(FALLBACK_WINNER_CACHE_SIZE)
+    validators = ValidatorStore(VALIDATORS_PATH) if VALIDATORS_PATH else None
+    fallback_workers = args.workers * len(DEFAULT_VARIANTS)
+    source_fallback = FallbackStrategy(FALLBACK_MODE, FALLBACK_STAGGER_DELAY, winners, max_workers=fallback_workers)
+    render_fallback = FallbackStrategy(FALLBACK_MODE, RENDER_FALLBACK_STAGGER_DELAY, winners, max_workers=fallback_workers)
+    if args.asyncio:
+        source_engine = AsyncRequestsEngine(headers=DEFAULT_HEADERS,
+                                            connect_timeout=HTTP_CONNECT_TIMEOUT,
+                                            read_timeout=HTTP_READ_TIMEOUT,
+                                            max_connections=ASYNC_MAX_IN_FLIGHT,
+                                            keep_alive=HTTP_KEEP_ALIVE,
+                                            fallback=source_fallback,
+                                            max_body_size=MAX_BODY_SIZE,
+                                            chunk_size=BODY_CHUNK_SIZE,
+                                            validators=validators,
+                                            charset_sniff_size=CHARSET_SNIFF_SIZE)
+    else:
+        source_session = PooledSession(pool_connections=HTTP_POOL_CONNECTIONS,
+                                       pool_maxsize=max(HTTP_POOL_MAXSIZE, args.workers),
+                                       keep_alive=HTTP_KEEP_ALIVE)
+        source_engine = RequestsEngine(headers=DEFAULT_HEADERS,
+                                       fallback=source_fallback,
+                                       session=source_session,
+                                       connect_timeout=HTTP_CONNECT_TIMEOUT,
+                                       read_timeout=HTTP_READ_TIMEOUT,
+                                       max_body_size=MAX_BODY_SIZE,
+                                       chunk_size=BODY_CHUNK_SIZE,
+                                       validators=validators,
+                                       charset_sniff_size=CHARSET_SNIFF_SIZE)
+    render_session = PooledSession(pool_connections=1,
+                                   pool_maxsize=max(RENDER_POOL_MAXSIZE, RENDER_MAX_CONCURRENCY + RENDER_MAX_PARKED),
+                                   keep_alive=True)
+    render_engine = RenderAPIEngine(os.getenv("RENDER_API_URL"),
+                                    headers=DEFAULT_HEADERS,
+                                    fallback=render_fallback,
+                                    session=render_session,
+                                    connect_timeout=RENDER_CONNECT_TIMEOUT,
+                                    read_timeout=RENDER_READ_TIMEOUT)
+    render_dispatcher = RenderDispatcher(render_engine,
+                                         AdaptiveLimit(initial=RENDER_INITIAL_CONCURRENCY,
+                                                       min_limit=RENDER_MIN_CONCURRENCY,
+                                                       max_limit=RENDER_MAX_CONCURRENCY,
+                                                       latency_target=RENDER_LATENCY_TARGET),
+                                         park_after=RENDER_PARK_AFTER,
+                                         max_parked=RENDER_MAX_PARKED)
     crawling_locator = CrawlingEngineLocator()
     crawling_locator.add(CrawlingType.SOURCE, BaseCrawler(source_engine))
     crawling_locator.add(CrawlingType.CAREERS, BaseCrawler(source_engine))
-    crawling_locator.add(CrawlingType.RENDER, BaseCrawler(render_engine))
-    crawling_locator.add(CrawlingType.SPF, DNSRecordsCrawler(DNSRecordsBaseEngine()))
-    crawling_locator.add(CrawlingType.CNAME, DNSRecordsCrawler(DNSRecordsBaseEngine()))
-    crawling_locator.add(CrawlingType.MX, DNSRecordsCrawler(DNSRecordsBaseEngine()))
-    crawling_locator.add(CrawlingType.NS, DNSRecordsCrawler(DNSRecordsBaseEngine()))
-    crawling_locator.add(CrawlingType.SOA, DNSRecordsCrawler(DNSRecordsBaseEngine()))
-    crawling_locator.add(CrawlingType.TXT, DNSRecordsCrawler(DNSRecordsBaseEngine()))
-
-    input_queue = map_input_queue(args.input)
-    output_queue = map_output_queue(args.output)
+    crawling_locator.add(CrawlingType.RENDER, BaseCrawler(render_dispatcher))
+    render_classifier = RenderClassifier(min_text_length=AUTO_RENDER_MIN_TEXT_LENGTH,
+                                         shell_text_length=AUTO_RENDER_SHELL_TEXT_LENGTH,
+                                         min_text_ratio=AUTO_RENDER_MIN_TEXT_RATIO,
+                                         sample_size=AUTO_RENDER_SAMPLE_SIZE)
+    render_decisions = RenderDecisionCache(max_size=AUTO_RENDER_CACHE_SIZE, max_age=AUTO_RENDER_DECISION_TTL)
+    crawling_locator.add(CrawlingType.AUTO, AutoRenderCrawler(crawling_locator, render_classifier, render_decisions))
+    dns_cache = DNSCache(max_size=DNS_CACHE_SIZE,
+                         negative_ttl=DNS_NEGATIVE_TTL,
+                         min_ttl=DNS_MIN_TTL,
+                         max_ttl=DNS_MAX_TTL,
+                         store=SQLiteDNSCacheStore(DNS_CACHE_PATH, purge_interval=DNS_CACHE_PURGE_INTERVAL)
+                         if DNS_CACHE_PATH else None)
+    dns_engine = DNSRecordsBaseEngine(nameservers=DNS_NAMESERVERS,
+                                      port=DNS_PORT,
+                                      timeout=DNS_TIMEOUT,
+                                      lifetime=DNS_LIFETIME,
+                                      max_in_flight=DNS_MAX_IN_FLIGHT,
+                                      cache=dns_cache)
+    dns_crawler = DNSRecordsCrawler(dns_engine)
+    crawling_locator.add(CrawlingType.SPF, dns_crawler)
+    crawling_locator.add(CrawlingType.CNAME, dns_crawler)
+    crawling_locator.add(CrawlingType.MX, dns_crawler)
+    crawling_locator.add(CrawlingType.NS, dns_crawler)
+    crawling_locator.add(CrawlingType.SOA, dns_crawler)
+    crawling_locator.add(CrawlingType.TXT, dns_crawler)
+    crawling_locator.add(CrawlingType.DNS, dns_crawler)
+
+    prefetch_count = RMQ_PREFETCH_COUNT or \
+        (ASYNC_MAX_IN_FLIGHT if args.asyncio else (args.workers + sum(CRAWLING_TYPE_WORKERS.values())) * 2)
+    input_queue = map_input_queue(args.input, prefetch_count)
+    output_queue = map_output_queue(args.output, worker_id, args.processes)
     errors_queue = map_errors_queue(args.error)
 
-    crawling_service = CrawlingService(crawler=crawling_locator,
-                                       input_queue=input_queue,
-                                       output_queue=output_queue,
-                                       errors_queue=errors_queue)
-    crawling_service.run(message_batch_size=args.batch_size, single_batch=args.single_batch)
+    scheduler = None
+    if POLITENESS_ENABLED:
+        scheduler = PolitenessScheduler(host_rate=POLITENESS_HOST_RATE,
+                                        host_burst=POLITENESS_HOST_BURST,
+                                        ip_rate=POLITENESS_IP_RATE,
+                                        ip_burst=POLITENESS_IP_BURST,
+                                        resolve_ip=dns_engine.host_ip if POLITENESS_PER_IP else None,
+                                        max_pending=POLITENESS_MAX_PENDING)
+
+    frontier = None
+    if FRONTIER_PATH:
+        frontier = CrawlFrontier(FRONTIER_PATH,
+                                 recrawl_intervals=RECRAWL_INTERVALS,
+                                 default_interval=DEFAULT_RECRAWL_INTERVAL,
+                                 capacity=FRONTIER_CAPACITY)
+
+    if args.asyncio:
+        crawling_service = AsyncCrawlingService(crawler=crawling_locator,
+                                                input_queue=input_queue,
+                                                output_queue=output_queue,
+                                                errors_queue=errors_queue,
+                                                worker_num=args.workers,
+                                                max_in_flight=ASYNC_MAX_IN_FLIGHT,
+                                                per_host_limit=ASYNC_PER_HOST_LIMIT,
+                                                async_engines=[source_engine],
+                                                type_concurrency=CRAWLING_TYPE_CONCURRENCY,
+                                                type_workers=CRAWLING_TYPE_WORKERS,
+                                                scheduler=scheduler,
+                                                frontier=frontier)
+    else:
+        crawling_service = CrawlingService(crawler=crawling_locator,
+                                           input_queue=input_queue,
+                                           output_queue=output_queue,
+                                           errors_queue=errors_queue,
+                                           worker_num=args.workers,
+                                           type_concurrency=CRAWLING_TYPE_CONCURRENCY,
+                                           scheduler=scheduler,
+                                           frontier=frontier,
+                                           type_workers=CRAWLING_TYPE_WORKERS)
+
+    def collect_stats():
+        stats = {"service": crawling_service.stats(),
+                 "source": source_engine.stats(),
+                 "render": render_dispatcher.stats()}
+        if isinstance(input_queue, RMQConsumer):
+            stats["input"] = input_queue.stats()
+        if isinstance(errors_queue, BufferedQueue):
+            stats["errors"] = errors_queue.stats()
+        es_queue = output_queue
+        if isinstance(output_queue, SpoolQueue):
+            stats["spool"] = output_queue.stats()
+            es_queue = output_queue.wrapped
+        if isinstance(es_queue, ESIndexQueue):
+            stats["es"] = es_queue.stats()
+        return stats
+
+    return crawling_service, collect_stats
+
+
+def run_crawler(args, worker_id=None, metrics_queue=None) -> bool:
+    crawling_service, collect_stats = build_crawling_service(args, worker_id)
+    metrics_server = None
+    if METRICS_PORT:
+        metrics_server = MetricsServer(METRICS_PORT + (worker_id or 0))
+        metrics_server.start()
+    # SIGTERM drains: no new messages are received, received ones are finished, acked and flushed
+    signal.signal(signal.SIGTERM, lambda signum, frame: crawling_service.stop())
+    signal.signal(signal.SIGINT, lambda signum, frame: crawling_service.stop())
+    reporter = None
+    if metrics_queue is not None:
+        reporter = MetricsReporter(worker_id, metrics_queue, collect_stats, interval=METRICS_REPORT_INTERVAL)
+        reporter.start()
+    finished = crawling_service.run(message_batch_size=args.batch_size, single_batch=args.single_batch)
+    if reporter is not None:
+        reporter.stop()
+    if metrics_server is not None:
+        metrics_server.close()
+    stats = collect_stats()
+    logger.info(f"Source engine connections: {stats['source']}")
+    logger.info(f"Render dispatcher: {stats['render']}")
+    if "es" in stats:
+        logger.info(f"Elasticsearch bulk stats: {stats['es']}")
+    if "spool" in stats:
+        logger.info(f"Output spool: {stats['spool']}")
+    return finished
+
+
+def run_worker(args, worker_id, metrics_queue):
+    sys.exit(0 if run_crawler(args, worker_id, metrics_queue) else 1)
+
+
+if __name__ == '__main__':
+    load_dotenv()
+    logging.config.dictConfig(logging_config)
+    args = parse_args()
+    if args.processes <= 1:
+        run_crawler(args)
+    else:
+        if FRONTIER_PATH:
+            # Creates the shared frontier files once, before the workers open them
+            CrawlFrontier(FRONTIER_PATH, capacity=FRONTIER_CAPACITY).close()
+        supervisor = Supervisor(partial(run_worker, args),
+                                processes=args.processes,
+                                restart_delay=WORKER_RESTART_DELAY,
+                                max_restart_delay=WORKER_MAX_RESTART_DELAY,
+                                drain_timeout=WORKER_DRAIN_TIMEOUT,
+                                metrics_interval=METRICS_REPORT_INTERVAL)
+        supervisor.run()
@@ -0,0 +1,160 @@
+import asyncio
+import logging
+import time
+from collections import defaultdict
+
+from crawler.crawling_service import CrawlingService, InputMessage
+from crawler.metrics import STAGE_SECONDS
+from exceptions import CrawlError
+from tools.structures import URLObject
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncCrawlingService(CrawlingService):
+    def __init__(self, *args, max_in_flight: int = 1000, per_host_limit: int = 2, async_engines=(), **kwargs):
+        super().__init__(*args, **kwargs)
+        # Crawling types limited on the loop, by type_concurrency or else by the workers the type would get
+        type_limits = {**(kwargs.get("type_workers") or {}), **(kwargs.get("type_concurrency") or {})}
+        self._type_concurrency = {_type: limit for _type, limit in type_limits.items() if limit > 0}
+        self._type_semaphores = {}
+        self.async_engines = list(async_engines)
+        self.max_in_flight = max_in_flight
+        self.per_host_limit = per_host_limit
+        self._in_flight = None
+        self._host_limits = {}
+        self._host_waiters = defaultdict(int)
+
+    @staticmethod
+    def host_key(input_message: InputMessage):
+        host = input_message.domain.lower().strip("/")
+        if host.startswith("www."):
+            host = host[4:]
+        return host
+
+    async def _acquire_host(self, host):
+        self._host_waiters[host] += 1
+        semaphore = self._host_limits.get(host)
+        if semaphore is None:
+            semaphore = self._host_limits[host] = asyncio.Semaphore(self.per_host_limit)
+        await semaphore.acquire()
+        return semaphore
+
+    def _release_host(self, host, semaphore):
+        semaphore.release()
+        self._host_waiters[host] -= 1
+        if self._host_waiters[host] <= 0:
+            # Forget idle hosts so the map doesn't grow with every crawled domain
+            del self._host_waiters[host]
+            del self._host_limits[host]
+
+    async def _run_blocking(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    async def crawl_url_async(self, input_message: InputMessage):
+        url_object = URLObject(url=input_message.url_to_crawl,
+                               crawling_type=input_message.crawling_type,
+                               record_types=input_message.record_types)
+        host = self.host_key(input_message)
+        type_limit = self._type_semaphores.get(input_message.crawling_type.value)
+        if type_limit is not None:
+            await type_limit.acquire()
+        try:
+            semaphore = await self._acquire_host(host)
+            try:
+                with self.crawl_timer(input_message):
+                    response = await self.crawler.async_crawl(url_object)
+            finally:
+                self._release_host(host, semaphore)
+        finally:
+            if type_limit is not None:
+                type_limit.release()
+        if response is None:
+            logger.error(
+                f"Empty response from {url_object.url}, {url_object.crawling_type}")
+            return None
+        return response
+
+    async def process_message_async(self, message):
+        with STAGE_SECONDS.time(stage="input_message"):
+            input_message: InputMessage = self.input_message(message)
+        crawling_response = await self.crawl_url_async(input_message)
+
+        if crawling_response is None:
+            raise CrawlError(
+                f"For {input_message.domain} crawling_response is None")
+        await self._run_blocking(self.send_output, input_message, crawling_response)
+
+    async def handle_message_async(self, message):
+        try:
+            try:
+                await self.process_message_async(message)
+            except Exception as e:
+                self.log_failure(e)
+                await self._run_blocking(self.fail_message, message, e)
+            else:
+                await self._run_blocking(self.finish_message, message, True)
+        finally:
+            self._in_flight.release()
+
+    async def process_batch_async(self, messages):
+        tasks = []
+        for message in messages:
+            await self._in_flight.acquire()
+            tasks.append(asyncio.ensure_future(self.handle_message_async(message)))
+        return tasks
+
+    async def schedule_async(self, messages, max_pending):
+        for message in messages:
+            self.scheduler.add(message, self.schedule_host(message))
+        ready = []
+        while True:
+            popped = self.scheduler.pop_ready()
+            ready.extend(popped)
+            if popped:
+                continue
+            if self.scheduler.pending <= max_pending:
+                return ready
+            await asyncio.sleep(min(self.scheduler.next_ready_in() or 0, 1.0))
+
+    async def process_async(self, message_batch_size, single_batch=False):
+        self._in_flight = asyncio.Semaphore(self.max_in_flight)
+        self._type_semaphores = {_type: asyncio.Semaphore(limit) for _type, limit in self._type_concurrency.items()}
+        pending = set()
+        while not self.stopping:
+            messages = await self._run_blocking(lambda: list(self.receive(message_batch_size) or []))
+            to_process = await self._run_blocking(self.unique_messages, messages)
+            if self.scheduler is not None:
+                max_pending = 0 if single_batch else self.scheduler.max_pending
+                to_process = await self.schedule_async(to_process, max_pending)
+            tasks = await self.process_batch_async(to_process)
+            pending.update(tasks)
+            pending = {task for task in pending if not task.done()}
+            if single_batch:
+                break
+            if not messages:
+                await asyncio.sleep(1)
+        if self.scheduler is not None:
+            await self._run_blocking(self.release_deferred)
+        if pending:
+            await asyncio.wait(pending)
+
+    async def _main(self, message_batch_size, single_batch):
+        try:
+            await self.process_async(message_batch_size, single_batch)
+        finally:
+            for engine in self.async_engines:
+                await engine.close()
+
+    def run(self, message_batch_size: int, single_batch) -> bool:
+        try:
+            asyncio.run(self._main(message_batch_size, single_batch))
+        except Exception as e:
+            logger.error("fail_process_entity_global: {}".format(str(e)),
+                         exc_info=True)
+            time.sleep(5)
+            return False
+        finally:
+            self.shutdown()
+        return True
@@ -1,5 +1,6 @@
+import asyncio
 from dataclasses import dataclass
-from typing import Optional
+from typing import Dict, Optional
 
 from crawler.contract import AbstractCrawler
 from engine.contract import EngineContract
@@ -9,12 +10,23 @@ from tools.structures import URLObject
 @dataclass
 class Response:
     text: Optional[str] = None
+    records: Optional[Dict[str, Optional[str]]] = None
 
 
 class BaseCrawler(AbstractCrawler):
     def __init__(self, engine: EngineContract):
         self._engine = engine
 
+    @property
+    def engine(self):
+        return self._engine
+
     def crawl(self, url: URLObject):
         response = self._engine.request(url.url, crawling_type=None)
         return response
+
+    async def async_crawl(self, url: URLObject):
+        if hasattr(self._engine, "async_request"):
+            return await self._engine.async_request(url.url, crawling_type=None)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.crawl, url)
@@ -1,16 +1,26 @@
 import json
 import logging
+import threading
 import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import nullcontext, contextmanager
 from dataclasses import dataclass
-from typing import NamedTuple, Union, Dict, List, Optional
+from datetime import datetime
+from typing import Callable, NamedTuple, Union, Dict, List, Optional
 
 from amqpstorm import Message
 from pymq import MessageReceiveError, MessageQueueContract
 
 from crawler.contract import AbstractCrawler
-from exceptions import WrongCrawlingType, CrawlError
-from queues.output_queue import OutputQueue
-from tools.structures import URLObject, CrawlingType
+from crawler.frontier import CrawlFrontier
+from crawler.metrics import STAGE_SECONDS, CRAWL_SECONDS, MESSAGES_TOTAL, RECEIVED_TOTAL
+from crawler.scheduler import PolitenessScheduler
+from engine.render_parser import parse_render_response
+from exceptions import WrongCrawlingType, CrawlError, classify_error, INTERNAL
+from queues.output_queue import OutputQueue, BufferedQueue
+from queues.rmq_consumer import RMQConsumer
+from tools.structures import URLObject, CrawlingType, DNS_RECORD_TYPES
 
 logger = logging.getLogger(__name__)
 
@@ -20,6 +30,7 @@ class InputMessage:
     domain: str
     crawling_type: CrawlingType
     url_to_crawl: str
+    record_types: Optional[List[CrawlingType]] = None
 
 
 class OutputMessage(NamedTuple):
@@ -29,19 +40,59 @@ class OutputMessage(NamedTuple):
     page_url: Optional[str] = None
     headers: Optional[str] = None
     web_requests: Optional[str] = None
+    truncated: Optional[bool] = None
+    body_size: Optional[int] = None
+    records: Optional[Dict[str, Optional[str]]] = None
+    not_modified: Optional[bool] = None
+    # ETag and Last-Modified of the fetched page, not indexed
+    validators: Optional[Dict[str, Optional[str]]] = None
 
 
 class CrawlingService:
+    # Wait after an empty receive, doubled up to EMPTY_RECEIVE_MAX_WAIT while the input stays empty
+    EMPTY_RECEIVE_WAIT = 0.1
+    EMPTY_RECEIVE_MAX_WAIT = 2.0
+
     def __init__(self,
                  crawler: AbstractCrawler,
                  input_queue: MessageQueueContract,
                  output_queue: OutputQueue,
-                 errors_queue: MessageQueueContract
+                 errors_queue: Union[MessageQueueContract, OutputQueue],
+                 worker_num: int = 1,
+                 type_concurrency: Optional[Dict[str, int]] = None,
+                 scheduler: Optional[PolitenessScheduler] = None,
+                 frontier: Optional[CrawlFrontier] = None,
+                 type_workers: Optional[Dict[str, int]] = None
                  ):
         self.crawler = crawler
         self.input_queue = input_queue
         self.output_queue = output_queue
         self.errors_queue = errors_queue
+        self.worker_num = max(1, worker_num)
+        self.scheduler = scheduler
+        self.frontier = frontier
+        self._type_limits = {
+            _type: threading.BoundedSemaphore(limit)
+            for _type, limit in (type_concurrency or {}).items()
+        }
+        self._queue_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._counters = Counter()
+        self._stopping = threading.Event()
+        self._executor = None
+        self._slots = None
+        if self.worker_num > 1:
+            self._executor = ThreadPoolExecutor(max_workers=self.worker_num,
+                                                thread_name_prefix="crawler")
+            # Keeps the number of received but not yet processed messages bounded
+            self._slots = threading.BoundedSemaphore(self.worker_num * 2)
+        # Crawling types with their own workers: a slow render doesn't hold a worker of the other types,
+        # and the number of renders in flight is left to the render dispatcher
+        self._type_pools = {
+            _type: (ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"crawler-{_type}"),
+                    threading.BoundedSemaphore(workers * 2))
+            for _type, workers in (type_workers or {}).items() if workers > 0
+        }
 
     @staticmethod
     def load_message_into_json(message):
@@ -66,20 +117,35 @@ class CrawlingService:
 
         crawling_type = self.map_crawling_type(message_json)
 
-        if crawling_type == "careers":
+        if crawling_type == CrawlingType.CAREERS:
             url = message_json["url_to_crawl"]
         else:
             url = message_json["domain"]
 
+        record_types = None
+        if crawling_type == CrawlingType.DNS:
+            record_types = self.map_record_types(message_json)
+
         input_message = InputMessage(domain=message_json["domain"],
                                      crawling_type=crawling_type,
-                                     url_to_crawl=url)
+                                     url_to_crawl=url,
+                                     record_types=record_types)
         return input_message
 
+    def receive_lock(self):
+        # The push consumer owns its channel, the other inputs share theirs with the acks of the workers
+        if isinstance(self.input_queue, RMQConsumer):
+            return nullcontext()
+        return self._queue_lock
+
     def receive(self, message_batch_size: int):
         try:
-            messages = self.input_queue.receive(message_batch_size,
-                                                break_on_empty=True)
+            with STAGE_SECONDS.time(stage="receive"), self.receive_lock():
+                messages = self.input_queue.receive(message_batch_size,
+                                                    break_on_empty=True)
+                if messages is not None:
+                    messages = list(messages)
+            RECEIVED_TOTAL.inc(len(messages or []))
             return messages
         except MessageReceiveError as e:
             logger.error("fail_to_receive_messages".format(str(e)),
@@ -95,7 +161,47 @@ class CrawlingService:
 
     def ack_message(self, message):
         if hasattr(self.input_queue, "ack_message"):
-            self.input_queue.ack_message(message)
+            with STAGE_SECONDS.time(stage="ack"), self._queue_lock:
+                self.input_queue.ack_message(message)
+
+    def error_record(self, message, error: Exception):
+        try:
+            record = dict(self.load_message_into_json(message))
+        except Exception:
+            body = getattr(message, "body", message)
+            record = {"raw": body if isinstance(body, str) else repr(body)}
+        reason, retryable = classify_error(error)
+        # The original payload goes back with the reason, so a retried message counts its attempts
+        record["attempt"] = int(record.get("attempt") or 0) + 1
+        record["error"] = {
+            "reason": reason,
+            "retryable": retryable,
+            "message": str(error)[:1000],
+            "failed_at": datetime.utcnow().isoformat(),
+        }
+        return record
+
+    def send_error(self, message, error: Exception, on_sent: Callable[[], None]):
+        record = self.error_record(message, error)
+        self.count(f"error_{record['error']['reason']}")
+        MESSAGES_TOTAL.inc(crawling_type=record.get("crawling_type", ""), result=record["error"]["reason"])
+        if isinstance(self.errors_queue, BufferedQueue):
+            # Published later in a batch, the message is acked only once its record is written
+            self.errors_queue.put(record, on_written=on_sent)
+            return
+        if isinstance(self.errors_queue, OutputQueue):
+            self.errors_queue.put(record)
+        else:
+            with self._queue_lock:
+                self.errors_queue.send(json.dumps(record))
+        on_sent()
+
+    @staticmethod
+    def log_failure(error: Exception):
+        if isinstance(error, CrawlError) and error.reason != INTERNAL:
+            logger.warning(f"Can't process message, {error.reason}: {error}")
+        else:
+            logger.error(f"Can't process message: {error}", exc_info=True)
 
     def create_crawling_url(self, message):
         return self.crawler.create_url(message["domain"])
@@ -113,10 +219,53 @@ class CrawlingService:
             raise WrongCrawlingType
         return crawling_type
 
+    @staticmethod
+    def map_record_types(message):
+        record_types_str = message.get("record_types")
+        if not record_types_str:
+            return list(DNS_RECORD_TYPES)
+        if not isinstance(record_types_str, list):
+            # A string such as "mx,txt" would be read character by character
+            logger.error(f"DNS record types are not a list: {record_types_str}")
+            raise WrongCrawlingType
+
+        try:
+            record_types = [CrawlingType.get_by_index(_type) for _type in record_types_str]
+        except RuntimeError as e:
+            logger.error(f"Wrong DNS record types {record_types_str}")
+            raise WrongCrawlingType from e
+        if any(_type not in DNS_RECORD_TYPES for _type in record_types):
+            logger.error(f"Wrong DNS record types {record_types_str}")
+            raise WrongCrawlingType
+        return record_types
+
+    def type_limit(self, crawling_type: CrawlingType):
+        return self._type_limits.get(crawling_type.value, nullcontext())
+
+    def engine_name(self, crawling_type: CrawlingType):
+        if hasattr(self.crawler, "engine_name"):
+            return self.crawler.engine_name(crawling_type)
+        return type(self.crawler).__name__
+
+    @contextmanager
+    def crawl_timer(self, input_message: InputMessage):
+        started = time.perf_counter()
+        result = "error"
+        try:
+            yield
+            result = "ok"
+        finally:
+            CRAWL_SECONDS.observe(time.perf_counter() - started,
+                                  engine=self.engine_name(input_message.crawling_type),
+                                  crawling_type=input_message.crawling_type.value,
+                                  result=result)
+
     def crawl_url(self, input_message: InputMessage):
         url_object = URLObject(url=input_message.url_to_crawl,
-                               crawling_type=input_message.crawling_type)
-        response = self.crawler.crawl(url_object)
+                               crawling_type=input_message.crawling_type,
+                               record_types=input_message.record_types)
+        with self.type_limit(input_message.crawling_type), self.crawl_timer(input_message):
+            response = self.crawler.crawl(url_object)
         if response is None:
             logger.error(
                 f"Empty response from {url_object.url}, {url_object.crawling_type}")
@@ -125,22 +274,20 @@ class CrawlingService:
 
     @staticmethod
     def output_message(input_message, crawling_response):
-        if input_message.crawling_type.value in ["render"]:
-            crawling_response = crawling_response.json()
-            headers = json.dumps(
-                crawling_response
-                .get("har", {})
-                .get("log", {})
-                .get("entries", [])[0]
-                .get("response", {})
-                .get("headers", {})
-            )
-            web_requests = []
-            for web_request in crawling_response.get("har", {}).get("log", {}).get("entries", []):
-                web_requests.append(web_request.get("request", {}).get("url", {}))
-            web_requests = json.dumps(web_requests)
-            page_url = crawling_response["requestedUrl"]
-            response_txt = crawling_response["html"]
+        # Auto messages are built and indexed as the type they were crawled as
+        crawling_type = getattr(crawling_response, "crawled_as", input_message.crawling_type)
+        if getattr(crawling_response, "not_modified", False):
+            # 304 for a conditional request, the indexed body is still current
+            headers = None
+            web_requests = None
+            page_url = None
+            response_txt = None
+        elif crawling_type.value in ["render"]:
+            render_result = parse_render_response(crawling_response)
+            headers = render_result.headers
+            web_requests = render_result.web_requests
+            page_url = render_result.page_url
+            response_txt = render_result.html
         else:
             headers = None
             web_requests = None
@@ -149,52 +296,207 @@ class CrawlingService:
         output_message = OutputMessage(
             domain=input_message.domain,
             response=response_txt,
-            crawling_type=input_message.crawling_type.value,
+            crawling_type=crawling_type.value,
             page_url=page_url,
             headers=headers,
             web_requests=web_requests,
+            truncated=getattr(crawling_response, "truncated", None),
+            body_size=getattr(crawling_response, "body_size", None),
+            records=getattr(crawling_response, "records", None),
+            not_modified=getattr(crawling_response, "not_modified", None),
+            validators=getattr(crawling_response, "validators", None),
         )
         output_message = output_message._asdict()
         return output_message
 
     def process_message(self, message):
-        input_message: InputMessage = self.input_message(message)
+        with STAGE_SECONDS.time(stage="input_message"):
+            input_message: InputMessage = self.input_message(message)
         crawling_response = self.crawl_url(input_message)
 
         if crawling_response is None:
             raise CrawlError(
                 f"For {input_message.domain} crawling_response is None")
-        output_message = self.output_message(input_message, crawling_response)
-        self.send([output_message])
+        self.send_output(input_message, crawling_response)
+
+    def send_output(self, input_message: InputMessage, crawling_response):
+        crawling_type = input_message.crawling_type.value
+        with STAGE_SECONDS.time(stage="output_message", crawling_type=crawling_type):
+            output_message = self.output_message(input_message, crawling_response)
+        with STAGE_SECONDS.time(stage="send", crawling_type=crawling_type):
+            self.send([output_message])
+        MESSAGES_TOTAL.inc(crawling_type=crawling_type, result="ok")
+
+    def frontier_key(self, message):
+        try:
+            input_message = self.input_message(message)
+        except Exception:
+            return None
+        return input_message.url_to_crawl, input_message.crawling_type.value
+
+    def unique_messages(self, messages):
+        unique = []
+        keys = set()
+        for message in messages:
+            key = self.frontier_key(message)
+            if key is not None:
+                if key in keys or (self.frontier is not None and not self.frontier.claim(*key)):
+                    logger.debug(f"Skip recently crawled {key}")
+                    self.ack_message(message)
+                    self.count("skipped")
+                    MESSAGES_TOTAL.inc(crawling_type=key[1], result="skipped")
+                    continue
+                keys.add(key)
+            unique.append(message)
+        return unique
+
+    def count(self, name, value=1):
+        with self._stats_lock:
+            self._counters[name] += value
+
+    def stats(self):
+        with self._stats_lock:
+            return dict(self._counters)
+
+    def complete_message(self, message, crawled):
+        self.count("crawled" if crawled else "failed")
+        if self.frontier is None:
+            return
+        key = self.frontier_key(message)
+        if key is not None:
+            self.frontier.complete(*key, crawled=crawled)
+
+    def finish_message(self, message, crawled):
+        self.ack_message(message)
+        self.complete_message(message, crawled)
+
+    def fail_message(self, message, error: Exception):
+        try:
+            self.send_error(message, error, on_sent=lambda: self.finish_message(message, crawled=False))
+        except Exception as e:
+            # Left unacked, the broker delivers the message again
+            logger.error(f"Can't send the error record, the message is not acked: {e}", exc_info=True)
+            self.complete_message(message, crawled=False)
+
+    def handle_message(self, message):
+        try:
+            self.process_message(message)
+        except Exception as e:
+            self.log_failure(e)
+            self.fail_message(message, e)
+            return
+        self.finish_message(message, crawled=True)
+
+    def message_pool(self, message):
+        if self._type_pools:
+            try:
+                crawling_type = self.input_message(message).crawling_type.value
+            except Exception:
+                crawling_type = None
+            if crawling_type in self._type_pools:
+                return self._type_pools[crawling_type]
+        if self._executor is None:
+            return None
+        return self._executor, self._slots
+
+    def submit_message(self, message):
+        pool = self.message_pool(message)
+        if pool is None:
+            self.handle_message(message)
+            return None
+        executor, slots = pool
+        slots.acquire()
+        future = executor.submit(self.handle_message, message)
+        future.add_done_callback(lambda _: slots.release())
+        return future
+
+    def schedule_host(self, message):
+        try:
+            input_message = self.input_message(message)
+        except Exception:
+            # Broken messages go straight to processing, which routes them to the errors queue
+            return None
+        if input_message.crawling_type == CrawlingType.DNS or input_message.crawling_type in DNS_RECORD_TYPES:
+            # Lookups go to the resolvers, not to the host
+            return None
+        return input_message.domain
+
+    def schedule(self, messages, max_pending):
+        for message in messages:
+            self.scheduler.add(message, self.schedule_host(message))
+        return self.scheduler.drain(max_pending)
+
+    def process_batch(self, messages, max_pending=0):
+        messages = self.unique_messages(messages)
+        if self.scheduler is not None:
+            messages = self.schedule(messages, max_pending)
+        futures = [self.submit_message(message) for message in messages]
+        return [future for future in futures if future is not None]
 
     def process_single_batch(self, message_batch_size):
         messages = self.receive(message_batch_size)
         if messages is None:
             return
-        messages_set = set(messages)
-        for message in messages_set:
-            try:
-                self.process_message(message)
-            except Exception as e:
-                logger.error(f"Can't process message: {e}", exc_info=True)
-                message_json = self.load_message_into_json(message)
-                self.errors_queue.send(json.dumps(message_json))
-            self.ack_message(message)
+        wait(self.process_batch(messages))
+
+    @property
+    def stopping(self):
+        return self._stopping.is_set()
+
+    # Stops receiving new messages, messages already received are still processed and acked
+    def stop(self):
+        self._stopping.set()
 
     def process(self, message_batch_size):
-        while True:
-            messages_iter = self.receive(message_batch_size)
-            messages_set = set(messages_iter)
-            for message in messages_set:
-                try:
-                    self.process_message(message)
-                except Exception as e:
-                    logger.error(f"Can't process message: {e}", exc_info=True)
-                    message_json = self.load_message_into_json(message)
-                    self.errors_queue.send(json.dumps(message_json))
-                self.ack_message(message)
-
-    def run(self, message_batch_size: int, single_batch):
+        idle_wait = self.EMPTY_RECEIVE_WAIT
+        while not self.stopping:
+            messages = list(self.receive(message_batch_size) or [])
+            if messages:
+                idle_wait = self.EMPTY_RECEIVE_WAIT
+            if self.scheduler is None:
+                self.process_batch(messages)
+            else:
+                # Over-limit messages stay deferred while new batches are received
+                self.process_batch(messages, max_pending=self.scheduler.max_pending)
+                if not messages and self.scheduler.pending:
+                    self.scheduler.wait_ready()
+                    continue
+            if not messages:
+                # An empty queue returns at once, backs off instead of spinning on it
+                self._stopping.wait(idle_wait)
+                idle_wait = min(idle_wait * 2, self.EMPTY_RECEIVE_MAX_WAIT)
+        if self.scheduler is not None:
+            self.release_deferred()
+
+    def release_deferred(self):
+        # Deferred messages aren't crawled on stop. Left unacked, the broker delivers them again
+        # once the input queue is closed, their frontier claims are dropped so the next run takes them
+        deferred = self.scheduler.clear()
+        if not deferred:
+            return
+        if self.frontier is not None:
+            for message in deferred:
+                key = self.frontier_key(message)
+                if key is not None:
+                    self.frontier.complete(*key, crawled=False)
+        self.count("released", len(deferred))
+        logger.info(f"Stop with {len(deferred)} deferred messages, they are left unacked and requeued")
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+        for executor, _ in self._type_pools.values():
+            executor.shutdown(wait=True)
+        self.output_queue.close()
+        if isinstance(self.errors_queue, OutputQueue):
+            self.errors_queue.close()
+        if hasattr(self.input_queue, "close"):
+            # Results and errors are flushed first, then the acks of their messages are sent
+            self.input_queue.close()
+        if self.frontier is not None:
+            self.frontier.close()
+
+    def run(self, message_batch_size: int, single_batch) -> bool:
         try:
             if single_batch:
                 self.process_single_batch(message_batch_size)
@@ -204,3 +506,7 @@ class CrawlingService:
             logger.error("fail_process_entity_global: {}".format(str(e)),
                          exc_info=True)
             time.sleep(5)
+            return False
+        finally:
+            self.shutdown()
+        return True
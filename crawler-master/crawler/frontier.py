@@ -0,0 +1,178 @@
+import fcntl
+import hashlib
+import math
+import mmap
+import os
+import sqlite3
+import struct
+import threading
+import time
+from typing import Dict, Optional
+from urllib.parse import urlparse
+
+BLOOM_MAGIC = b"BLM1"
+BLOOM_HEADER = struct.Struct(">4sQI")
+
+
+class BloomFilter:
+
+    def __init__(self, path, capacity=50000000, error_rate=0.01):
+        self._path = path
+        if os.path.exists(path) and os.path.getsize(path) > BLOOM_HEADER.size:
+            with open(path, "rb") as file:
+                magic, self.bits, self.hashes = BLOOM_HEADER.unpack(file.read(BLOOM_HEADER.size))
+            if magic != BLOOM_MAGIC:
+                raise RuntimeError(f"{path} is not a bloom filter file")
+        else:
+            self.bits = int(-capacity * math.log(error_rate) / math.log(2) ** 2)
+            self.hashes = max(1, round(self.bits / capacity * math.log(2)))
+            with open(path, "wb") as file:
+                file.write(BLOOM_HEADER.pack(BLOOM_MAGIC, self.bits, self.hashes))
+                file.truncate(BLOOM_HEADER.size + (self.bits + 7) // 8)
+        self._file = open(path, "r+b")
+        self._map = mmap.mmap(self._file.fileno(), 0)
+        self._lock = threading.Lock()
+
+    def _positions(self, key: bytes):
+        digest = hashlib.blake2b(key, digest_size=16).digest()
+        first, second = struct.unpack(">QQ", digest)
+        for i in range(self.hashes):
+            yield (first + i * second) % self.bits
+
+    def add(self, key: bytes):
+        # Setting a bit reads and writes back its whole byte, concurrent adds of worker threads and of the
+        # processes sharing the file would lose each other's bits. flock doesn't exclude threads of one process
+        with self._lock:
+            fcntl.flock(self._file, fcntl.LOCK_EX)
+            try:
+                for position in self._positions(key):
+                    offset = BLOOM_HEADER.size + position // 8
+                    self._map[offset] |= 1 << (position % 8)
+            finally:
+                fcntl.flock(self._file, fcntl.LOCK_UN)
+
+    def __contains__(self, key: bytes):
+        for position in self._positions(key):
+            if not self._map[BLOOM_HEADER.size + position // 8] & 1 << (position % 8):
+                return False
+        return True
+
+    def flush(self):
+        self._map.flush()
+
+    def close(self):
+        self._map.flush()
+        self._map.close()
+        self._file.close()
+
+
+def is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def normalize_url(url):
+    if "://" not in url:
+        url = "//" + url
+    parsed = urlparse(url.strip())
+    host = (parsed.hostname or "").lower().rstrip(".")
+    if host.startswith("www."):
+        host = host[4:]
+    path = parsed.path.rstrip("/")
+    if parsed.query:
+        path += "?" + parsed.query
+    return host + path
+
+
+class CrawlFrontier:
+
+    def __init__(self, directory, recrawl_intervals: Dict[str, float] = None, default_interval=86400,
+                 capacity=50000000, error_rate=0.01, claim_timeout=3600):
+        os.makedirs(directory, exist_ok=True)
+        self._recrawl_intervals = recrawl_intervals or {}
+        self._default_interval = default_interval
+        self._claim_timeout = claim_timeout
+        self._bloom = BloomFilter(os.path.join(directory, "seen.bloom"), capacity, error_rate)
+        self._path = os.path.join(directory, "seen.db")
+        self._local = threading.local()
+        self._pid = os.getpid()
+        connection = self._connection()
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS seen (key BLOB PRIMARY KEY, crawled_at REAL NOT NULL) WITHOUT ROWID"
+        )
+        # Keys in flight in any process sharing the directory
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS claims (key BLOB PRIMARY KEY, owner INTEGER NOT NULL, "
+            "claimed_at REAL NOT NULL) WITHOUT ROWID"
+        )
+        # Left by an earlier process with the same pid
+        connection.execute("DELETE FROM claims WHERE owner = ?", (self._pid,))
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self._path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    @staticmethod
+    def key(url, crawling_type: str) -> bytes:
+        # 8 bytes keep the exact store small, collisions stay negligible for hundreds of millions of keys
+        return hashlib.blake2b(f"{crawling_type}:{normalize_url(url)}".encode("utf-8"), digest_size=8).digest()
+
+    def recrawl_interval(self, crawling_type: str):
+        return self._recrawl_intervals.get(crawling_type, self._default_interval)
+
+    def last_crawled(self, key: bytes) -> Optional[float]:
+        if key not in self._bloom:
+            return None
+        row = self._connection().execute("SELECT crawled_at FROM seen WHERE key = ?", (key,)).fetchone()
+        return row[0] if row is not None else None
+
+    def _claimed(self, row, now) -> bool:
+        if row is None:
+            return False
+        owner, claimed_at = row
+        # Claims of a crashed process would skip the redelivered messages, they are taken over
+        return now - claimed_at < self._claim_timeout and is_alive(owner)
+
+    def claim(self, url, crawling_type: str) -> bool:
+        key = self.key(url, crawling_type)
+        now = time.time()
+        crawled_at = self.last_crawled(key)
+        if crawled_at is not None and now - crawled_at < self.recrawl_interval(crawling_type):
+            return False
+        connection = self._connection()
+        # The write lock of the database makes the check and the claim atomic across threads and processes
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute("SELECT owner, claimed_at FROM claims WHERE key = ?", (key,)).fetchone()
+            if self._claimed(row, now):
+                connection.execute("ROLLBACK")
+                return False
+            connection.execute("INSERT OR REPLACE INTO claims (key, owner, claimed_at) VALUES (?, ?, ?)",
+                               (key, self._pid, now))
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return True
+
+    def complete(self, url, crawling_type: str, crawled: bool):
+        key = self.key(url, crawling_type)
+        # Failed crawls are not remembered, so retries of them are not filtered out
+        if crawled:
+            self._connection().execute("INSERT OR REPLACE INTO seen (key, crawled_at) VALUES (?, ?)",
+                                       (key, time.time()))
+            self._bloom.add(key)
+        self._connection().execute("DELETE FROM claims WHERE key = ? AND owner = ?", (key, self._pid))
+
+    def close(self):
+        self._bloom.close()
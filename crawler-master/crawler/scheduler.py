@@ -0,0 +1,201 @@
+import itertools
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+
+    def __init__(self, rate, capacity, now=None):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now if now is not None else time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now):
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def is_idle(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class BucketMap:
+    # Least recently used buckets looked at for an idle one when the map is full
+    EVICT_SCAN = 16
+
+    def __init__(self, rate, capacity, max_size=100000):
+        self.rate = rate
+        self.capacity = capacity
+        self._max_size = max_size
+        self._buckets = OrderedDict()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def _evict(self, now):
+        # A full bucket carries no state, dropping it doesn't loosen the limits
+        for key, bucket in itertools.islice(self._buckets.items(), self.EVICT_SCAN):
+            if bucket.is_idle(now):
+                del self._buckets[key]
+                return
+        # Hard cap, the least recently used host gets a full bucket when it comes back
+        self._buckets.popitem(last=False)
+
+    def get(self, key, now) -> TokenBucket:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            while self._buckets and len(self._buckets) >= self._max_size:
+                self._evict(now)
+            bucket = self._buckets[key] = TokenBucket(self.rate, self.capacity, now)
+        self._buckets.move_to_end(key)
+        return bucket
+
+
+def normalize_host(domain):
+    if "://" in domain:
+        domain = urlparse(domain).hostname or domain
+    host = domain.lower().strip("/").split("/")[0].split(":")[0]
+    if host.startswith("www."):
+        host = host[4:]
+    return host
+
+
+class PolitenessScheduler:
+    # Hosts waiting for their IP are polled every RESOLVE_WAIT seconds
+    RESOLVE_WAIT = 0.05
+
+    def __init__(self, host_rate=1.0, host_burst=2, ip_rate=5.0, ip_burst=10,
+                 resolve_ip: Optional[Callable] = None, max_pending=10000, max_wait=1.0, resolve_workers=8):
+        self._hosts = BucketMap(host_rate, host_burst)
+        self._ips = BucketMap(ip_rate, ip_burst)
+        self._resolve_ip = resolve_ip
+        self.max_pending = max_pending
+        self._max_wait = max_wait
+        self._queues = OrderedDict()
+        self._host_ips = {}
+        self._resolving = set()
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._resolver = None
+        if resolve_ip is not None:
+            # Lookups run off the receive loop, which would otherwise wait for every new host
+            self._resolver = ThreadPoolExecutor(max_workers=resolve_workers, thread_name_prefix="politeness-dns")
+
+    @property
+    def pending(self):
+        return self._pending
+
+    def add(self, message, host: Optional[str]):
+        host = normalize_host(host) if host else ""
+        with self._lock:
+            if host not in self._queues:
+                self._queues[host] = deque()
+                if host and self._resolver is not None and host not in self._resolving:
+                    # Only hosts new to the queues are resolved, queued ones keep their IP
+                    self._resolving.add(host)
+                    future = self._resolver.submit(self._resolve_ip, host)
+                    future.add_done_callback(lambda resolved, host=host: self._resolved(host, resolved))
+            self._queues[host].append(message)
+            self._pending += 1
+
+    def _resolved(self, host, future):
+        try:
+            ip = future.result()
+        except Exception as e:
+            # Limited per host only
+            logger.debug(f"Can't resolve {host}: {e}")
+            ip = None
+        with self._lock:
+            self._resolving.discard(host)
+            if ip is not None and host in self._queues:
+                self._host_ips[host] = ip
+
+    def _wait_time(self, host, now):
+        if not host:
+            return 0.0
+        if host in self._resolving:
+            # The IP bucket isn't known yet
+            return self.RESOLVE_WAIT
+        wait_time = self._hosts.get(host, now).wait_time(now)
+        ip = self._host_ips.get(host)
+        if ip is not None:
+            wait_time = max(wait_time, self._ips.get(ip, now).wait_time(now))
+        return wait_time
+
+    def _consume(self, host, now):
+        if not host:
+            return
+        self._hosts.get(host, now).consume(now)
+        ip = self._host_ips.get(host)
+        if ip is not None:
+            self._ips.get(ip, now).consume(now)
+
+    # One round over the pending hosts, at most one message per host
+    def pop_ready(self):
+        ready = []
+        with self._lock:
+            now = time.monotonic()
+            for host in list(self._queues):
+                if self._wait_time(host, now) > 0:
+                    continue
+                self._consume(host, now)
+                queue = self._queues[host]
+                ready.append(queue.popleft())
+                self._pending -= 1
+                if queue:
+                    # Moves the host to the end of the round robin
+                    self._queues.move_to_end(host)
+                else:
+                    del self._queues[host]
+                    self._host_ips.pop(host, None)
+        return ready
+
+    def next_ready_in(self) -> Optional[float]:
+        with self._lock:
+            if not self._queues:
+                return None
+            now = time.monotonic()
+            return min(self._wait_time(host, now) for host in self._queues)
+
+    # Takes all deferred messages out, they are not dispatched any more
+    def clear(self):
+        with self._lock:
+            messages = [message for queue in self._queues.values() for message in queue]
+            self._queues.clear()
+            self._host_ips.clear()
+            self._pending = 0
+        return messages
+
+    def wait_ready(self):
+        wait_time = self.next_ready_in()
+        if wait_time:
+            time.sleep(min(wait_time, self._max_wait))
+
+    # Yields ready messages, waits for the rate limits only while more than max_pending are deferred
+    def drain(self, max_pending=0):
+        while True:
+            ready = self.pop_ready()
+            yield from ready
+            if ready:
+                continue
+            if self.pending <= max_pending:
+                return
+            self.wait_ready()
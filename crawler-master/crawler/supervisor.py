@@ -0,0 +1,152 @@
+import logging
+import multiprocessing
+import queue
+import signal
+import threading
+import time
+from numbers import Number
+from typing import Callable, Dict
+
+logger = logging.getLogger(__name__)
+
+
+def merge_stats(stats: Dict[int, dict]) -> dict:
+    merged = {}
+    for worker_stats in stats.values():
+        for section, values in worker_stats.items():
+            merged_section = merged.setdefault(section, {})
+            for name, value in values.items():
+                if isinstance(value, Number) and not isinstance(value, bool):
+                    merged_section[name] = merged_section.get(name, 0) + value
+    return merged
+
+
+class MetricsReporter:
+    # Sends the stats of one worker process to the supervisor every interval
+
+    def __init__(self, worker_id, metrics_queue, collect: Callable[[], dict], interval=10.0):
+        self._worker_id = worker_id
+        self._metrics_queue = metrics_queue
+        self._collect = collect
+        self._interval = interval
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="metrics-reporter", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def report(self):
+        try:
+            self._metrics_queue.put_nowait((self._worker_id, self._collect()))
+        except Exception as e:
+            logger.warning(f"Can't report worker metrics: {e}")
+
+    def _run(self):
+        while not self._stopped.wait(self._interval):
+            self.report()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+        # The last report carries the totals of a drained worker
+        self.report()
+
+
+class Supervisor:
+    # Runs the crawler in several worker processes, restarts crashed ones and drains all of them on SIGTERM
+
+    def __init__(self, target: Callable, processes, restart_delay=1.0, max_restart_delay=60.0,
+                 drain_timeout=300.0, metrics_interval=60.0):
+        self._target = target
+        self._processes = processes
+        self._restart_delay = restart_delay
+        self._max_restart_delay = max_restart_delay
+        self._drain_timeout = drain_timeout
+        self._metrics_interval = metrics_interval
+        self._metrics_queue = multiprocessing.Queue()
+        self._workers: Dict[int, multiprocessing.Process] = {}
+        self._started_at: Dict[int, float] = {}
+        self._restarts: Dict[int, int] = {}
+        self._restart_at: Dict[int, float] = {}
+        self._stats: Dict[int, dict] = {}
+        self._stopping = False
+
+    def _start(self, worker_id):
+        process = multiprocessing.Process(target=self._target, args=(worker_id, self._metrics_queue),
+                                          name=f"crawler-{worker_id}")
+        process.start()
+        self._workers[worker_id] = process
+        self._started_at[worker_id] = time.monotonic()
+        logger.info(f"Started worker {worker_id}, pid {process.pid}")
+
+    def _check_workers(self):
+        now = time.monotonic()
+        for worker_id, process in list(self._workers.items()):
+            if process.is_alive():
+                continue
+            process.join()
+            del self._workers[worker_id]
+            if process.exitcode == 0:
+                logger.info(f"Worker {worker_id} finished")
+                continue
+            if now - self._started_at[worker_id] > self._max_restart_delay:
+                # A worker that ran for a while starts over with the shortest delay
+                self._restarts[worker_id] = 0
+            delay = min(self._restart_delay * 2 ** self._restarts.get(worker_id, 0), self._max_restart_delay)
+            self._restarts[worker_id] = self._restarts.get(worker_id, 0) + 1
+            self._restart_at[worker_id] = now + delay
+            logger.error(f"Worker {worker_id} exited with code {process.exitcode}, restart in {delay:.1f}s")
+        for worker_id, restart_at in list(self._restart_at.items()):
+            if restart_at <= now:
+                del self._restart_at[worker_id]
+                self._start(worker_id)
+
+    def _collect_metrics(self, timeout):
+        try:
+            worker_id, stats = self._metrics_queue.get(timeout=timeout)
+        except queue.Empty:
+            return
+        self._stats[worker_id] = stats
+        while True:
+            try:
+                worker_id, stats = self._metrics_queue.get_nowait()
+            except queue.Empty:
+                return
+            self._stats[worker_id] = stats
+
+    def log_metrics(self):
+        logger.info(f"Workers {len(self._workers)}/{self._processes}, metrics: {merge_stats(self._stats)}")
+
+    def _handle_signal(self, signum, frame):
+        logger.info(f"Got signal {signum}, draining workers")
+        self._stopping = True
+
+    def _drain(self):
+        for process in self._workers.values():
+            if process.is_alive():
+                process.terminate()
+        deadline = time.monotonic() + self._drain_timeout
+        for worker_id, process in self._workers.items():
+            while process.is_alive() and time.monotonic() < deadline:
+                self._collect_metrics(timeout=0.5)
+                process.join(timeout=0.5)
+            if process.is_alive():
+                logger.error(f"Worker {worker_id} didn't drain in {self._drain_timeout}s, killed")
+                process.kill()
+                process.join()
+        self._collect_metrics(timeout=0.1)
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._handle_signal)
+        signal.signal(signal.SIGINT, self._handle_signal)
+        for worker_id in range(self._processes):
+            self._start(worker_id)
+        last_log = time.monotonic()
+        while not self._stopping and (self._workers or self._restart_at):
+            self._collect_metrics(timeout=1.0)
+            self._check_workers()
+            if time.monotonic() - last_log >= self._metrics_interval:
+                self.log_metrics()
+                last_log = time.monotonic()
+        self._drain()
+        self.log_metrics()
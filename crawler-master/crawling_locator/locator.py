@@ -1,8 +1,16 @@
+import asyncio
+import logging
+
 from configs.crawler_settings import MIN_DOMAIN_LENGTH
 from crawler.contract import CrawlerContract, AbstractCrawler
-from exceptions import WrongFormatError
+from crawler.metrics import RENDER_DECISIONS_TOTAL
+from engine.render_classifier import RenderClassifier, RenderDecisionCache, BLOCKED, BLOCKED_STATUSES, \
+    UNSUPPORTED_CONTENT
+from exceptions import WrongFormatError, CrawlError, HTTPStatusError, ParseError
 from tools.structures import CrawlingType, URLObject
 
+logger = logging.getLogger(__name__)
+
 
 class CrawlingEngineLocator(AbstractCrawler):
 
@@ -28,6 +36,106 @@ class CrawlingEngineLocator(AbstractCrawler):
 
         return self._engines[_type]
 
+    def engine_name(self, _type: CrawlingType):
+        crawler = self._engines.get(_type)
+        engine = getattr(crawler, "engine", crawler)
+        return type(engine).__name__
+
     def crawl(self, url_object: URLObject):
         crawler = self.locate(url_object.crawling_type)
         return crawler.crawl(url_object)
+
+    async def async_crawl(self, url_object: URLObject):
+        crawler = self.locate(url_object.crawling_type)
+        if hasattr(crawler, "async_crawl"):
+            return await crawler.async_crawl(url_object)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, crawler.crawl, url_object)
+
+
+class AutoRenderCrawler(AbstractCrawler):
+    # CrawlingType.AUTO: the source is fetched first and the page is rendered only when the classifier
+    # finds its content built by JavaScript. The choice is cached per domain, later crawls go straight to it.
+    # Responses carry crawled_as, so the output is built and indexed as a source or a render result
+
+    def __init__(self, locator: CrawlingEngineLocator, classifier: RenderClassifier = None,
+                 decisions: RenderDecisionCache = None):
+        self._locator = locator
+        self.classifier = classifier if classifier is not None else RenderClassifier()
+        self.decisions = decisions if decisions is not None else RenderDecisionCache()
+
+    @staticmethod
+    def _url_object(url_object: URLObject, crawling_type: CrawlingType):
+        return URLObject(url=url_object.url, crawling_type=crawling_type)
+
+    @staticmethod
+    def _crawled_as(response, crawling_type: CrawlingType):
+        if response is not None:
+            response.crawled_as = crawling_type
+        return response
+
+    def _decide(self, domain, crawling_type: CrawlingType, reason):
+        self.decisions.set(domain, crawling_type)
+        RENDER_DECISIONS_TOTAL.inc(crawling_type=crawling_type.value, reason=reason or "static")
+        if reason:
+            logger.debug(f"Render {domain}: {reason}")
+
+    def _needs_render(self, domain, response) -> bool:
+        if getattr(response, "not_modified", False):
+            # Nothing to look at, the unchanged page is kept and the domain is classified next time
+            return False
+        reason = self.classifier.render_reason(response.text)
+        self._decide(domain, CrawlingType.RENDER if reason else CrawlingType.SOURCE, reason)
+        return reason is not None
+
+    @staticmethod
+    def _escalation_reason(error: CrawlError):
+        # A failed source fetch is worth a render when a browser likely gets the page: bot walls,
+        # and content types the source engine doesn't take. Timeouts and dead hosts fail a render too
+        if isinstance(error, HTTPStatusError) and error.status_code in BLOCKED_STATUSES:
+            return BLOCKED
+        if isinstance(error, ParseError):
+            return UNSUPPORTED_CONTENT
+        return None
+
+    def crawl(self, url_object: URLObject):
+        domain = url_object.url
+        decision = self.decisions.get(domain)
+        render_url = self._url_object(url_object, CrawlingType.RENDER)
+        if decision == CrawlingType.RENDER:
+            return self._crawled_as(self._locator.crawl(render_url), CrawlingType.RENDER)
+        try:
+            response = self._locator.crawl(self._url_object(url_object, CrawlingType.SOURCE))
+        except CrawlError as e:
+            reason = self._escalation_reason(e)
+            if decision is not None or reason is None:
+                raise
+            response = self._locator.crawl(render_url)
+            # Decided only once the render got through, a domain down for both is classified next time
+            self._decide(domain, CrawlingType.RENDER, reason)
+            return self._crawled_as(response, CrawlingType.RENDER)
+        if decision is None and self._needs_render(domain, response):
+            return self._crawled_as(self._locator.crawl(render_url), CrawlingType.RENDER)
+        return self._crawled_as(response, CrawlingType.SOURCE)
+
+    async def async_crawl(self, url_object: URLObject):
+        domain = url_object.url
+        decision = self.decisions.get(domain)
+        render_url = self._url_object(url_object, CrawlingType.RENDER)
+        if decision == CrawlingType.RENDER:
+            return self._crawled_as(await self._locator.async_crawl(render_url), CrawlingType.RENDER)
+        try:
+            response = await self._locator.async_crawl(self._url_object(url_object, CrawlingType.SOURCE))
+        except CrawlError as e:
+            reason = self._escalation_reason(e)
+            if decision is not None or reason is None:
+                raise
+            response = await self._locator.async_crawl(render_url)
+            self._decide(domain, CrawlingType.RENDER, reason)
+            return self._crawled_as(response, CrawlingType.RENDER)
+        if decision is None:
+            # Regular expressions over a whole page would stall the event loop
+            loop = asyncio.get_running_loop()
+            if await loop.run_in_executor(None, self._needs_render, domain, response):
+                return self._crawled_as(await self._locator.async_crawl(render_url), CrawlingType.RENDER)
+        return self._crawled_as(response, CrawlingType.SOURCE)
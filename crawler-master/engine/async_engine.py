@@ -0,0 +1,244 @@
+import asyncio
+import json
+import logging
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import Optional
+
+import aiohttp
+
+from crawler.metrics import HTTP_PHASE_SECONDS
+from engine.body_reader import DEFAULT_ALLOWED_CONTENT_TYPES, is_allowed_content_type
+from engine.charset import DEFAULT_SNIFF_SIZE, detect_encoding
+from engine.contract import EngineContract
+from engine.fallback import FallbackStrategy, SEQUENTIAL
+from engine.validator_store import ValidatorStore
+from exceptions import CrawlError, CrawlConnectionError, CrawlTimeoutError, HTTPStatusError, ParseError
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class HTTPResponse:
+    url: str
+    status_code: int
+    content: bytes
+    headers: dict = field(default_factory=dict)
+    encoding: Optional[str] = None
+    truncated: bool = False
+    not_modified: bool = False
+    # Validators to save once the page is indexed
+    validators: Optional[dict] = None
+
+    @property
+    def body_size(self):
+        return len(self.content)
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding or "utf-8", errors="replace")
+
+    def json(self):
+        return json.loads(self.text)
+
+
+@dataclass
+class OpenResponse:
+    # A response whose body isn't read yet, url is the requested one, not the one redirected to
+    url: str
+    response: aiohttp.ClientResponse
+
+    def close(self):
+        self.response.close()
+
+
+class AsyncRequestsEngine(EngineContract):
+
+    def __init__(self, headers: dict = None, connect_timeout=10, read_timeout=200, max_connections=1000,
+                 max_connections_per_host=0, keep_alive=True, fallback: FallbackStrategy = None,
+                 max_body_size=5 * 1024 * 1024, chunk_size=64 * 1024,
+                 allowed_content_types=DEFAULT_ALLOWED_CONTENT_TYPES, validators: ValidatorStore = None,
+                 charset_sniff_size=DEFAULT_SNIFF_SIZE):
+        self.validators = validators
+        self.charset_sniff_size = charset_sniff_size
+        self.headers = headers if headers is not None else {}
+        self.max_body_size = max_body_size
+        self.chunk_size = chunk_size
+        self.allowed_content_types = allowed_content_types
+        self.fallback = fallback if fallback is not None else FallbackStrategy(mode=SEQUENTIAL)
+        self._timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+        self._max_connections = max_connections
+        self._max_connections_per_host = max_connections_per_host
+        self._keep_alive = keep_alive
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._counters = {"requests": 0, "handshakes": 0, "pool_hits": 0}
+
+    def stats(self):
+        return dict(self._counters)
+
+    def _trace_config(self):
+        # aiohttp creates the connection and the TLS session in one step, so connect includes TLS here
+        async def on_request_start(session, context, params):
+            self._counters["requests"] += 1
+            context.request_start = time.perf_counter()
+
+        async def on_request_end(session, context, params):
+            HTTP_PHASE_SECONDS.observe(time.perf_counter() - context.request_start, engine="aiohttp", phase="ttfb")
+
+        async def on_dns_resolvehost_start(session, context, params):
+            context.dns_start = time.perf_counter()
+
+        async def on_dns_resolvehost_end(session, context, params):
+            HTTP_PHASE_SECONDS.observe(time.perf_counter() - context.dns_start, engine="aiohttp", phase="dns")
+
+        async def on_connection_create_start(session, context, params):
+            context.connect_start = time.perf_counter()
+
+        async def on_connection_create_end(session, context, params):
+            self._counters["handshakes"] += 1
+            HTTP_PHASE_SECONDS.observe(time.perf_counter() - context.connect_start, engine="aiohttp", phase="connect")
+
+        async def on_connection_reuseconn(session, context, params):
+            self._counters["pool_hits"] += 1
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(on_request_start)
+        trace_config.on_request_end.append(on_request_end)
+        trace_config.on_dns_resolvehost_start.append(on_dns_resolvehost_start)
+        trace_config.on_dns_resolvehost_end.append(on_dns_resolvehost_end)
+        trace_config.on_connection_create_start.append(on_connection_create_start)
+        trace_config.on_connection_create_end.append(on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+        return trace_config
+
+    def _create_session(self):
+        connector = aiohttp.TCPConnector(limit=self._max_connections,
+                                         limit_per_host=self._max_connections_per_host,
+                                         force_close=not self._keep_alive,
+                                         ttl_dns_cache=300)
+        return aiohttp.ClientSession(connector=connector,
+                                     headers=self.headers,
+                                     timeout=self._timeout,
+                                     trace_configs=[self._trace_config()])
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = self._create_session()
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def _read_body(self, response):
+        with HTTP_PHASE_SECONDS.time(engine="aiohttp", phase="download"):
+            return await self._read_limited(response)
+
+    async def _read_limited(self, response):
+        body = bytearray()
+        async for chunk in response.content.iter_chunked(self.chunk_size):
+            remaining = self.max_body_size - len(body)
+            if len(chunk) > remaining:
+                body.extend(chunk[:remaining])
+                # Drops the connection instead of draining the rest of the body
+                response.close()
+                return bytes(body), True
+            body.extend(chunk)
+        return bytes(body), False
+
+    @staticmethod
+    @asynccontextmanager
+    async def _request_errors(url):
+        try:
+            yield
+        except CrawlError:
+            raise
+        except aiohttp.ClientSSLError as e:
+            logger.warning(f"SSLError occurred for {url}: {e}")
+            raise CrawlConnectionError(f"SSLError for {url}: {e}", retryable=False) from e
+        except asyncio.TimeoutError as e:
+            logger.warning(f"Timeout occurred for {url}: {e}")
+            raise CrawlTimeoutError(f"Timeout for {url}") from e
+        except aiohttp.ClientConnectionError as e:
+            logger.warning(f"ConnectionError occurred for {url}: {e}")
+            raise CrawlConnectionError(f"ConnectionError for {url}: {e}") from e
+        except aiohttp.ClientError as e:
+            logger.warning(f"ClientError occurred for url {url}: {e}")
+            raise CrawlConnectionError(f"ClientError for {url}: {e}") from e
+        except Exception as e:
+            logger.warning(f"Exception for url: {url}. {e}")
+            raise CrawlError(f"Exception for {url}: {e}") from e
+
+    async def _open_response(self, session, _schema, domain):
+        # Stops after the headers, the body is left unread for _finish_response
+        url = f"{_schema}://{domain}"
+        headers = self.validators.conditional_headers(url) if self.validators is not None else None
+        async with self._request_errors(url):
+            response = await session.get(url, headers=headers)
+            response_status = response.status
+            if response_status == 304:
+                response.release()
+                return HTTPResponse(url=url, status_code=response_status, content=b"",
+                                    headers=dict(response.headers), not_modified=True)
+            if response_status < 200 or response_status >= 400:
+                logger.warning(f"Response {response_status} from {url}")
+                response.close()
+                raise HTTPStatusError(response_status, f"Response {response_status} from {url}")
+            content_type = response.headers.get("Content-Type")
+            if not is_allowed_content_type(content_type, self.allowed_content_types):
+                logger.warning(f"Skip {content_type} content from {url}")
+                response.close()
+                raise ParseError(f"Unsupported {content_type} content from {url}")
+            return OpenResponse(url=url, response=response)
+
+    async def _finish_response(self, opened):
+        if isinstance(opened, HTTPResponse):
+            return opened
+        url, response = opened.url, opened.response
+        try:
+            async with self._request_errors(url):
+                content, truncated = await self._read_body(response)
+        finally:
+            response.release()
+        if truncated:
+            logger.warning(f"Body of {url} is truncated to {self.max_body_size} bytes")
+        validators = None
+        if self.validators is not None:
+            validators = self.validators.from_headers(url, response.headers)
+        content_type = response.headers.get("Content-Type")
+        return HTTPResponse(url=url,
+                            status_code=response.status,
+                            content=content,
+                            headers=dict(response.headers),
+                            encoding=detect_encoding(content, content_type, self.charset_sniff_size),
+                            truncated=truncated,
+                            validators=validators)
+
+    async def _request(self, session, domain):
+        async def fetch(_schema, _host):
+            return await self._open_response(session, _schema, _host)
+
+        # Racing variants only download the body of the winner, the losers are closed after their headers
+        return await self.fallback.async_fetch(domain, fetch, self._finish_response)
+
+    async def async_request(self, domain, crawling_type=None):
+        return await self._request(self.session, domain)
+
+    def request(self, domain, crawling_type=None):
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            pass
+        else:
+            # asyncio.run can't nest, a caller on a loop awaits async_request instead
+            raise RuntimeError("AsyncRequestsEngine.request() can't run inside an event loop, "
+                               "await async_request() instead")
+
+        async def _request_once():
+            async with self._create_session() as session:
+                return await self._request(session, domain)
+
+        return asyncio.run(_request_once())
@@ -0,0 +1,28 @@
+from typing import Iterable, Tuple
+
+DEFAULT_ALLOWED_CONTENT_TYPES = (
+    "text/",
+    "application/xhtml+xml",
+    "application/xml",
+    "application/json",
+    "application/rss+xml",
+    "application/atom+xml",
+)
+
+
+def is_allowed_content_type(content_type, allowed=DEFAULT_ALLOWED_CONTENT_TYPES):
+    if not content_type:
+        return True
+    media_type = content_type.split(";")[0].strip().lower()
+    return any(media_type.startswith(prefix) for prefix in allowed)
+
+
+def read_limited(chunks: Iterable[bytes], max_size) -> Tuple[bytes, bool]:
+    body = bytearray()
+    for chunk in chunks:
+        remaining = max_size - len(body)
+        if len(chunk) > remaining:
+            body.extend(chunk[:remaining])
+            return bytes(body), True
+        body.extend(chunk)
+    return bytes(body), False
@@ -0,0 +1,117 @@
+import codecs
+import re
+from typing import Optional
+
+try:
+    # C implementation, orders of magnitude faster than chardet
+    import cchardet as chardet
+except ImportError:
+    import chardet
+
+DEFAULT_ENCODING = "utf-8"
+DEFAULT_SNIFF_SIZE = 16 * 1024
+# <meta> is looked for in the first bytes only, browsers do the same
+META_SCAN_SIZE = 4096
+
+BOMS = (
+    (codecs.BOM_UTF8, "utf-8-sig"),
+    (codecs.BOM_UTF32_LE, "utf-32"),
+    (codecs.BOM_UTF32_BE, "utf-32"),
+    (codecs.BOM_UTF16_LE, "utf-16"),
+    (codecs.BOM_UTF16_BE, "utf-16"),
+)
+
+# Labels which browsers decode as a superset encoding, pages labeled with them often use the superset characters
+SUPERSETS = {
+    "iso-8859-1": "cp1252",
+    "latin-1": "cp1252",
+    "latin1": "cp1252",
+    "us-ascii": "cp1252",
+    "ascii": "cp1252",
+    "iso-8859-9": "cp1254",
+    "shift_jis": "cp932",
+    "shift-jis": "cp932",
+    "sjis": "cp932",
+    "x-sjis": "cp932",
+    "gb2312": "gb18030",
+    "gbk": "gb18030",
+    "euc-kr": "cp949",
+    "ks_c_5601-1987": "cp949",
+    "tis-620": "cp874",
+}
+
+HEADER_CHARSET_RE = re.compile(r"charset\s*=\s*[\"']?\s*([\w.:-]+)", re.I)
+META_CHARSET_RE = re.compile(br"<meta[^>]+charset\s*=\s*[\"']?\s*([\w.:-]+)", re.I)
+XML_ENCODING_RE = re.compile(br"^\s*<\?xml[^>]+encoding\s*=\s*[\"']([\w.:-]+)", re.I)
+NON_ASCII_RE = re.compile(br"[\x80-\xff]")
+
+
+def normalize_encoding(label) -> Optional[str]:
+    if not label:
+        return None
+    if isinstance(label, bytes):
+        label = label.decode("ascii", errors="ignore")
+    label = label.strip().lower()
+    label = SUPERSETS.get(label, label)
+    try:
+        return codecs.lookup(label).name
+    except LookupError:
+        return None
+
+
+def header_encoding(content_type) -> Optional[str]:
+    if not content_type:
+        return None
+    match = HEADER_CHARSET_RE.search(content_type)
+    return normalize_encoding(match.group(1)) if match else None
+
+
+def bom_encoding(content: bytes) -> Optional[str]:
+    for bom, encoding in BOMS:
+        if content.startswith(bom):
+            return encoding
+    return None
+
+
+def meta_encoding(content: bytes) -> Optional[str]:
+    head = content[:META_SCAN_SIZE]
+    match = META_CHARSET_RE.search(head) or XML_ENCODING_RE.search(head)
+    if match is None:
+        return None
+    encoding = normalize_encoding(match.group(1))
+    # A page can't declare a UTF-16 charset in ASCII compatible bytes, browsers take it as UTF-8
+    if encoding is not None and encoding.startswith("utf-16"):
+        return DEFAULT_ENCODING
+    return encoding
+
+
+def is_utf8(content: bytes) -> bool:
+    try:
+        content.decode("utf-8")
+    except UnicodeDecodeError as e:
+        # A truncated body can end in the middle of a character
+        return e.reason == "unexpected end of data" and e.start >= len(content) - 3
+    return True
+
+
+def sniff_encoding(content: bytes, sniff_size=DEFAULT_SNIFF_SIZE) -> Optional[str]:
+    sample = content[:sniff_size]
+    if sample.isascii():
+        # Markup and inline scripts of a page often fill the first bytes, the window of its first
+        # non-ASCII byte tells the encoding. A body without one is ASCII, which UTF-8 decodes
+        match = NON_ASCII_RE.search(content, len(sample))
+        if match is None:
+            return DEFAULT_ENCODING
+        sample = content[match.start():match.start() + sniff_size]
+    if is_utf8(sample):
+        return DEFAULT_ENCODING
+    return normalize_encoding(chardet.detect(sample).get("encoding"))
+
+
+def detect_encoding(content: bytes, content_type=None, sniff_size=DEFAULT_SNIFF_SIZE) -> str:
+    # The order of the HTML standard: BOM, Content-Type charset, <meta>. Only undeclared bodies are sniffed,
+    # and only their first sniff_size bytes, full body detection costs more than the crawl itself
+    if not content:
+        return header_encoding(content_type) or DEFAULT_ENCODING
+    return bom_encoding(content) or header_encoding(content_type) or meta_encoding(content) \
+        or sniff_encoding(content, sniff_size) or DEFAULT_ENCODING
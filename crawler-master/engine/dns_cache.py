@@ -0,0 +1,138 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import List, NamedTuple, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class DNSCacheEntry(NamedTuple):
+    expires_at: float
+    # None is a cached failure (NXDOMAIN, NoAnswer)
+    records: Optional[List[str]]
+
+
+class SQLiteDNSCacheStore:
+
+    def __init__(self, path, purge_interval=3600):
+        self._path = path
+        self._purge_interval = purge_interval
+        self._purge_lock = threading.Lock()
+        self._purged_at = time.monotonic()
+        self._local = threading.local()
+        self._connection().execute(
+            "CREATE TABLE IF NOT EXISTS dns_cache ("
+            "name TEXT NOT NULL, rdtype TEXT NOT NULL, expires_at REAL NOT NULL, records TEXT, "
+            "PRIMARY KEY (name, rdtype)) WITHOUT ROWID"
+        )
+        self.purge_expired()
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self._path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def get(self, name, rdtype) -> Optional[DNSCacheEntry]:
+        row = self._connection().execute(
+            "SELECT expires_at, records FROM dns_cache WHERE name = ? AND rdtype = ?",
+            (name, rdtype)).fetchone()
+        if row is None:
+            return None
+        expires_at, records = row
+        return DNSCacheEntry(expires_at, json.loads(records) if records is not None else None)
+
+    def put(self, name, rdtype, entry: DNSCacheEntry):
+        records = json.dumps(entry.records) if entry.records is not None else None
+        self._connection().execute(
+            "INSERT OR REPLACE INTO dns_cache (name, rdtype, expires_at, records) VALUES (?, ?, ?, ?)",
+            (name, rdtype, entry.expires_at, records))
+        self._purge_periodically()
+
+    def _purge_periodically(self):
+        # A long running crawler looks up new names all the time, expired rows would fill the disk
+        with self._purge_lock:
+            if time.monotonic() - self._purged_at < self._purge_interval:
+                return
+            self._purged_at = time.monotonic()
+        self.purge_expired()
+
+    def purge_expired(self):
+        self._connection().execute("DELETE FROM dns_cache WHERE expires_at < ?", (time.time(),))
+
+
+class DNSCache:
+
+    def __init__(self, max_size=100000, negative_ttl=300, min_ttl=30, max_ttl=86400,
+                 store: SQLiteDNSCacheStore = None):
+        self._max_size = max_size
+        self.negative_ttl = negative_ttl
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self._store = store
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(name, rdtype) -> Tuple[str, str]:
+        return name.lower().rstrip("."), rdtype.upper()
+
+    def _remember(self, key, entry: DNSCacheEntry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+
+    def get(self, name, rdtype) -> Optional[DNSCacheEntry]:
+        key = self.key(name, rdtype)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires_at <= now:
+                del self._entries[key]
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+        if entry is None and self._store is not None:
+            try:
+                entry = self._store.get(*key)
+            except sqlite3.Error as e:
+                logger.warning(f"DNS cache store read failed: {e}")
+                entry = None
+            if entry is not None and entry.expires_at > now:
+                self._remember(key, entry)
+            else:
+                entry = None
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return entry
+
+    def put(self, name, rdtype, records: Optional[List[str]], ttl=None):
+        if records is None:
+            ttl = self.negative_ttl
+        else:
+            ttl = min(max(ttl if ttl is not None else self.min_ttl, self.min_ttl), self.max_ttl)
+        key = self.key(name, rdtype)
+        entry = DNSCacheEntry(time.time() + ttl, records)
+        self._remember(key, entry)
+        if self._store is not None:
+            try:
+                self._store.put(*key, entry)
+            except sqlite3.Error as e:
+                logger.warning(f"DNS cache store write failed: {e}")
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
@@ -1,58 +1,270 @@
+import asyncio
+import json
 import logging
-from typing import List, Optional, Union
+import threading
+import weakref
+from typing import Dict, Iterable, List, Optional, Tuple, Union
 from urllib.parse import urlparse
 
+from dns.asyncresolver import Resolver as AsyncResolver
 from dns.rdatatype import UnknownRdatatype
-from dns.resolver import Resolver, NoAnswer, Timeout
+from dns.resolver import Resolver, NoAnswer, NXDOMAIN, Timeout
 
 from crawler.base_crawler import BaseCrawler, Response
 from engine.contract import EngineContract
-from tools.structures import CrawlingType, URLObject
+from engine.dns_cache import DNSCache
+from exceptions import CrawlError, DNSError
+from tools.structures import CrawlingType, URLObject, DNS_RECORD_TYPES
 
 logger = logging.getLogger(__name__)
 
 
 class DNSRecordsBaseEngine(EngineContract):
 
-    @classmethod
-    def search(cls, domain,
-               record_type: CrawlingType,
-               as_string=True,
-               delimiter="\n") -> Optional[Union[List[str], str]]:
-        resolver = Resolver()
-        try:
-            answers = resolver.resolve(domain, record_type.value)
-        except NoAnswer as e:
+    def __init__(self, nameservers: Optional[List[str]] = None, port=53, timeout=2.0, lifetime=5.0,
+                 max_in_flight=500, cache: DNSCache = None):
+        self.cache = cache
+        self.nameservers = nameservers
+        self.port = port
+        self.timeout = timeout
+        self.lifetime = lifetime
+        self.max_in_flight = max_in_flight
+        self.resolver = self._configure(Resolver(configure=not nameservers))
+        self._async_resolver = None
+        # A semaphore per event loop, an asyncio semaphore can't be awaited from another loop
+        self._in_flight = weakref.WeakKeyDictionary()
+        self._loop_lock = threading.Lock()
+        self._lookup_loop = None
+
+    def _configure(self, resolver):
+        if self.nameservers:
+            resolver.nameservers = list(self.nameservers)
+        resolver.port = self.port
+        resolver.timeout = self.timeout
+        resolver.lifetime = self.lifetime
+        return resolver
+
+    @property
+    def async_resolver(self) -> AsyncResolver:
+        if self._async_resolver is None:
+            self._async_resolver = self._configure(AsyncResolver(configure=not self.nameservers))
+        return self._async_resolver
+
+    def _in_flight_limit(self):
+        loop = asyncio.get_running_loop()
+        with self._loop_lock:
+            semaphore = self._in_flight.get(loop)
+            if semaphore is None:
+                semaphore = self._in_flight[loop] = asyncio.Semaphore(self.max_in_flight)
+        return semaphore
+
+    def _lookups_loop(self):
+        with self._loop_lock:
+            if self._lookup_loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="dns-lookups", daemon=True).start()
+                self._lookup_loop = loop
+            return self._lookup_loop
+
+    @staticmethod
+    def _records(answers) -> List[str]:
+        _records = []
+        for answer in answers:
+            _records.append(answer.to_text().strip("'").strip('"').strip())
+        return _records
+
+    @staticmethod
+    def _as_result(records, as_string, delimiter):
+        if records is None:
+            return None
+        if as_string:
+            return delimiter.join(records)
+        return records
+
+    def _from_cache(self, domain, record_type: CrawlingType):
+        if self.cache is None:
+            return None
+        entry = self.cache.get(domain, record_type.value)
+        if entry is not None and entry.records is None:
+            logger.debug(f"Cached DNS failure, {domain}, {record_type}")
+        return entry
+
+    def _cache_answers(self, domain, record_type: CrawlingType, records, answers):
+        if self.cache is not None:
+            self.cache.put(domain, record_type.value, records, ttl=answers.rrset.ttl)
+
+    def _cache_failure(self, domain, record_type: CrawlingType, e):
+        # Timeouts and server failures are transient, only cache authoritative negative answers
+        if self.cache is not None and isinstance(e, (NoAnswer, NXDOMAIN)):
+            self.cache.put(domain, record_type.value, None)
+
+    @staticmethod
+    def _error(domain, record_type, e) -> CrawlError:
+        if isinstance(e, (NoAnswer, NXDOMAIN)):
+            return DNSError(f"{type(e).__name__}, {domain}, {record_type}", retryable=False)
+        if isinstance(e, UnknownRdatatype):
+            return CrawlError(f"Unknown dns lookup type: {e}")
+        return DNSError(f"DNS lookup failed, {domain}, {record_type}: {e}")
+
+    @staticmethod
+    def _cached_result(domain, record_type, cached, as_string, delimiter, raise_errors):
+        if cached.records is None and raise_errors:
+            raise DNSError(f"Cached DNS failure, {domain}, {record_type}", retryable=False)
+        return DNSRecordsBaseEngine._as_result(cached.records, as_string, delimiter)
+
+    @staticmethod
+    def _log_failure(domain, record_type, e):
+        if isinstance(e, NoAnswer):
             logger.error(f"No answer, {domain}, {record_type}, {e}")
-            return
-        except Timeout as e:
+        elif isinstance(e, Timeout):
             logger.error(f"DNS Search Timeout, {domain}, {record_type}, {e}")
-            return
-        except UnknownRdatatype as e:
+        elif isinstance(e, UnknownRdatatype):
             logger.error(f"Unknown dns lookup type: {e}")
-            return
-        except Exception as e:
+        else:
             logger.error(f"DNS lookup failed: {domain}, {record_type}, {e}")
+
+    def search(self, domain,
+               record_type: CrawlingType,
+               as_string=True,
+               delimiter="\n",
+               raise_errors=False) -> Optional[Union[List[str], str]]:
+        cached = self._from_cache(domain, record_type)
+        if cached is not None:
+            return self._cached_result(domain, record_type, cached, as_string, delimiter, raise_errors)
+        try:
+            answers = self.resolver.resolve(domain, record_type.value)
+        except Exception as e:
+            self._log_failure(domain, record_type, e)
+            self._cache_failure(domain, record_type, e)
+            if raise_errors:
+                raise self._error(domain, record_type, e) from e
             return
-        _records = []
-        for answer in answers:
-            _records.append(answer.to_text().strip("'").strip('"').strip())
-        if as_string:
-            return delimiter.join(_records)
-        return _records
+        records = self._records(answers)
+        self._cache_answers(domain, record_type, records, answers)
+        return self._as_result(records, as_string, delimiter)
 
-    def request(self, url, crawling_type):
+    async def async_search(self, domain,
+                           record_type: CrawlingType,
+                           as_string=True,
+                           delimiter="\n",
+                           raise_errors=False) -> Optional[Union[List[str], str]]:
+        cached = self._from_cache(domain, record_type)
+        if cached is not None:
+            return self._cached_result(domain, record_type, cached, as_string, delimiter, raise_errors)
+        async with self._in_flight_limit():
+            try:
+                answers = await self.async_resolver.resolve(domain, record_type.value)
+            except Exception as e:
+                self._log_failure(domain, record_type, e)
+                self._cache_failure(domain, record_type, e)
+                if raise_errors:
+                    raise self._error(domain, record_type, e) from e
+                return
+        records = self._records(answers)
+        self._cache_answers(domain, record_type, records, answers)
+        return self._as_result(records, as_string, delimiter)
+
+    def host_ip(self, host) -> Optional[str]:
+        # First A record of a crawled host for the per IP politeness limits, cached with the crawled records
+        cached = self.cache.get(host, "A") if self.cache is not None else None
+        if cached is not None:
+            return cached.records[0] if cached.records else None
+        try:
+            answers = self.resolver.resolve(host, "A")
+        except Exception as e:
+            if self.cache is not None and isinstance(e, (NoAnswer, NXDOMAIN)):
+                self.cache.put(host, "A", None)
+            logger.debug(f"Can't resolve {host}: {e}")
+            return None
+        records = self._records(answers)
+        if self.cache is not None:
+            self.cache.put(host, "A", records, ttl=answers.rrset.ttl)
+        return records[0] if records else None
+
+    # With raise_errors failed lookups map to their CrawlError instead of None
+    async def resolve_many(self, lookups: Iterable[Tuple[str, CrawlingType]], as_string=True,
+                           raise_errors=False) -> Dict[Tuple[str, CrawlingType], Optional[Union[List[str], str]]]:
+        lookups = list(dict.fromkeys(lookups))
+        results = await asyncio.gather(*[self.async_search(domain, record_type, as_string=as_string,
+                                                           raise_errors=raise_errors)
+                                         for domain, record_type in lookups],
+                                       return_exceptions=raise_errors)
+        for result in results:
+            if isinstance(result, Exception) and not isinstance(result, CrawlError):
+                raise result
+        return dict(zip(lookups, results))
+
+    def search_many(self, lookups: Iterable[Tuple[str, CrawlingType]], as_string=True,
+                    raise_errors=False) -> Dict[Tuple[str, CrawlingType], Optional[Union[List[str], str]]]:
+        # Lookups of all worker threads run on one loop, so max_in_flight holds across them
+        future = asyncio.run_coroutine_threadsafe(self.resolve_many(lookups, as_string=as_string,
+                                                                    raise_errors=raise_errors),
+                                                  self._lookups_loop())
+        return future.result()
+
+    @staticmethod
+    def request_domain(url):
         url_object = urlparse(url)
         domain = url_object.hostname or url_object.path or url
         if domain.startswith("www."):
             domain = domain[4:]
-        return self.search(domain, crawling_type)
+        return domain
+
+    def request(self, url, crawling_type):
+        return self.search(self.request_domain(url), crawling_type, raise_errors=True)
+
+    async def async_request(self, url, crawling_type):
+        return await self.async_search(self.request_domain(url), crawling_type, raise_errors=True)
+
+    @staticmethod
+    def records_result(domain, record_types: List[CrawlingType], results) -> Dict[str, Optional[str]]:
+        records = {}
+        errors = []
+        for record_type in record_types:
+            result = results[(domain, record_type)]
+            if isinstance(result, CrawlError):
+                errors.append(result)
+                result = None
+            records[record_type.value] = result
+        if errors and len(errors) == len(record_types):
+            # Nothing resolved, a transient failure of any type gets the message retried
+            raise next((error for error in errors if error.retryable), errors[0])
+        return records
+
+    def request_records(self, url, record_types: List[CrawlingType]) -> Dict[str, Optional[str]]:
+        domain = self.request_domain(url)
+        results = self.search_many([(domain, record_type) for record_type in record_types], raise_errors=True)
+        return self.records_result(domain, record_types, results)
+
+    async def async_request_records(self, url, record_types: List[CrawlingType]) -> Dict[str, Optional[str]]:
+        domain = self.request_domain(url)
+        results = await self.resolve_many([(domain, record_type) for record_type in record_types],
+                                          raise_errors=True)
+        return self.records_result(domain, record_types, results)
 
 
 class DNSRecordsCrawler(BaseCrawler):
+    @staticmethod
+    def records_response(records):
+        if all(value is None for value in records.values()):
+            return
+        return Response(text=json.dumps(records), records=records)
+
     def crawl(self, url: URLObject):
         url_ = "https://" + url.url
+        if url.crawling_type == CrawlingType.DNS:
+            return self.records_response(self._engine.request_records(url_, url.record_types or DNS_RECORD_TYPES))
         result = self._engine.request(url_, url.crawling_type)
         if result is None:
             return
         return Response(text=result)
+
+    async def async_crawl(self, url: URLObject):
+        url_ = "https://" + url.url
+        if url.crawling_type == CrawlingType.DNS:
+            records = await self._engine.async_request_records(url_, url.record_types or DNS_RECORD_TYPES)
+            return self.records_response(records)
+        result = await self._engine.async_request(url_, url.crawling_type)
+        if result is None:
+            return
+        return Response(text=result)
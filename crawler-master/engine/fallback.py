@@ -0,0 +1,236 @@
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Callable, List, Optional, Tuple
+
+from exceptions import CrawlError, HTTPStatusError, ParseError
+
+logger = logging.getLogger(__name__)
+
+# (schema, host prefix) in the order the engines used to try them
+DEFAULT_VARIANTS = [("https", ""), ("https", "www."), ("http", ""), ("http", "www.")]
+
+SEQUENTIAL = "sequential"
+RACE = "race"
+STAGGERED = "staggered"
+
+
+class WinnerCache:
+    def __init__(self, max_size=100000):
+        self._max_size = max_size
+        self._winners = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, domain) -> Optional[Tuple[str, str]]:
+        with self._lock:
+            variant = self._winners.get(domain)
+            if variant is not None:
+                self._winners.move_to_end(domain)
+            return variant
+
+    def set(self, domain, variant: Tuple[str, str]):
+        with self._lock:
+            self._winners[domain] = variant
+            self._winners.move_to_end(domain)
+            while len(self._winners) > self._max_size:
+                self._winners.popitem(last=False)
+
+    def forget(self, domain):
+        with self._lock:
+            self._winners.pop(domain, None)
+
+
+def close_response(response):
+    if response is not None and hasattr(response, "close"):
+        try:
+            response.close()
+        except Exception as e:
+            logger.warning(f"Fail to close losing response: {e}")
+
+
+def close_future(future):
+    if not future.cancelled() and future.exception() is None:
+        close_response(future.result())
+
+
+def preferred_error(current: Optional[CrawlError], error: CrawlError) -> CrawlError:
+    # An answer from the server says more about the domain than a variant that couldn't be reached
+    answered = (HTTPStatusError, ParseError)
+    if current is None or (isinstance(error, answered) and not isinstance(current, answered)):
+        return error
+    return current
+
+
+def raise_error(error: Optional[CrawlError]):
+    if error is not None:
+        raise error
+    return None
+
+
+class FallbackStrategy:
+
+    def __init__(self, mode=STAGGERED, stagger_delay=1.0, winners: WinnerCache = None,
+                 variants: List[Tuple[str, str]] = None, max_workers=20):
+        if mode not in (SEQUENTIAL, RACE, STAGGERED):
+            raise RuntimeError(f"Unknown fallback mode: {mode}")
+        self.mode = mode
+        self.stagger_delay = 0 if mode == RACE else stagger_delay
+        self.winners = winners if winners is not None else WinnerCache()
+        self._variants = variants if variants is not None else DEFAULT_VARIANTS
+        self._executor = None
+        if mode != SEQUENTIAL:
+            self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                                thread_name_prefix="fallback")
+
+    def variants(self, domain):
+        return [(schema, prefix + domain, (schema, prefix)) for schema, prefix in self._variants]
+
+    def _try_winner(self, domain, fetch):
+        variant = self.winners.get(domain)
+        if variant is None:
+            return None
+        schema, prefix = variant
+        try:
+            resp = fetch(schema, prefix + domain)
+        except CrawlError:
+            resp = None
+        if not resp:
+            self.winners.forget(domain)
+        return resp
+
+    @staticmethod
+    def _fetch_read(fetch, read):
+        if read is None:
+            return fetch
+
+        def fetch_read(schema, host):
+            resp = fetch(schema, host)
+            return read(resp) if resp else resp
+        return fetch_read
+
+    def fetch(self, domain, fetch: Callable, read: Callable = None):
+        # With read, fetch stops after the headers and read downloads the body,
+        # racing variants then only download the body of the winner
+        resp = self._try_winner(domain, self._fetch_read(fetch, read))
+        if resp:
+            return resp
+        if self.mode == SEQUENTIAL:
+            return self._fetch_sequential(domain, self._fetch_read(fetch, read))
+        return self._fetch_staggered(domain, fetch, read)
+
+    def _fetch_sequential(self, domain, fetch):
+        error = None
+        for schema, host, variant in self.variants(domain):
+            try:
+                resp = fetch(schema, host)
+            except CrawlError as e:
+                error = preferred_error(error, e)
+                continue
+            if resp:
+                self.winners.set(domain, variant)
+                return resp
+        return raise_error(error)
+
+    def _fetch_staggered(self, domain, fetch, read=None):
+        variants = self.variants(domain)
+        pending = {}
+        winner = None
+        error = None
+        while variants or pending:
+            if variants:
+                schema, host, variant = variants.pop(0)
+                pending[self._executor.submit(fetch, schema, host)] = variant
+            timeout = self.stagger_delay if variants else None
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                variant = pending.pop(future)
+                try:
+                    resp = future.result()
+                except CrawlError as e:
+                    error = preferred_error(error, e)
+                    continue
+                if resp and winner is None:
+                    winner = resp
+                    self.winners.set(domain, variant)
+                elif resp:
+                    close_response(resp)
+            if winner is not None:
+                break
+        for future in pending:
+            # Requests can't be interrupted once started, release their connections when they finish
+            if not future.cancel():
+                future.add_done_callback(close_future)
+        if winner is None:
+            return raise_error(error)
+        return winner if read is None else read(winner)
+
+    @staticmethod
+    def _async_fetch_read(fetch, read):
+        if read is None:
+            return fetch
+
+        async def fetch_read(schema, host):
+            resp = await fetch(schema, host)
+            return await read(resp) if resp else resp
+        return fetch_read
+
+    async def async_fetch(self, domain, fetch: Callable, read: Callable = None):
+        fetch_read = self._async_fetch_read(fetch, read)
+        variant = self.winners.get(domain)
+        if variant is not None:
+            schema, prefix = variant
+            try:
+                resp = await fetch_read(schema, prefix + domain)
+            except CrawlError:
+                resp = None
+            if resp:
+                return resp
+            self.winners.forget(domain)
+        error = None
+        if self.mode == SEQUENTIAL:
+            for schema, host, variant in self.variants(domain):
+                try:
+                    resp = await fetch_read(schema, host)
+                except CrawlError as e:
+                    error = preferred_error(error, e)
+                    continue
+                if resp:
+                    self.winners.set(domain, variant)
+                    return resp
+            return raise_error(error)
+
+        variants = self.variants(domain)
+        pending = {}
+        winner = None
+        try:
+            while variants or pending:
+                if variants:
+                    schema, host, variant = variants.pop(0)
+                    pending[asyncio.ensure_future(fetch(schema, host))] = variant
+                timeout = self.stagger_delay if variants else None
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    variant = pending.pop(task)
+                    try:
+                        resp = task.result()
+                    except CrawlError as e:
+                        error = preferred_error(error, e)
+                        continue
+                    if resp:
+                        winner = resp
+                        self.winners.set(domain, variant)
+                        break
+                if winner is not None:
+                    break
+        finally:
+            for task in pending:
+                if task.done() and not task.cancelled():
+                    # Retrieves a losing failure, asyncio would log it as never retrieved
+                    if task.exception() is None:
+                        close_response(task.result())
+                task.cancel()
+        if winner is None:
+            return raise_error(error)
+        return winner if read is None else await read(winner)
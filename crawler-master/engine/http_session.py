@@ -0,0 +1,69 @@
+import threading
+from http.cookiejar import DefaultCookiePolicy
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+# Keeps urllib3 pool counters of evicted host pools, so the totals survive pool eviction
+class CountingHTTPAdapter(HTTPAdapter):
+
+    def __init__(self, *args, **kwargs):
+        self._lock = threading.Lock()
+        self._evicted_requests = 0
+        self._evicted_connections = 0
+        super().__init__(*args, **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pools.dispose_func = self._dispose_pool
+
+    def _dispose_pool(self, pool):
+        with self._lock:
+            self._evicted_requests += pool.num_requests
+            self._evicted_connections += pool.num_connections
+        pool.close()
+
+    def counters(self):
+        with self._lock:
+            requests_num = self._evicted_requests
+            connections_num = self._evicted_connections
+        for key in list(self.poolmanager.pools.keys()):
+            pool = self.poolmanager.pools.get(key)
+            if pool is None:
+                continue
+            requests_num += pool.num_requests
+            connections_num += pool.num_connections
+        return requests_num, connections_num
+
+
+class PooledSession:
+
+    def __init__(self, pool_connections=100, pool_maxsize=10, keep_alive=True, max_retries=0):
+        self.session = requests.Session()
+        # The session is shared by all crawled sites: cookies would pile up forever and be sent across redirects
+        self.session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        self._adapter = CountingHTTPAdapter(pool_connections=pool_connections,
+                                            pool_maxsize=pool_maxsize,
+                                            max_retries=max_retries)
+        self.session.mount("http://", self._adapter)
+        self.session.mount("https://", self._adapter)
+        if not keep_alive:
+            self.session.headers["Connection"] = "close"
+
+    def get(self, url, **kwargs):
+        return self.session.get(url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.session.post(url, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+    def stats(self):
+        requests_num, connections_num = self._adapter.counters()
+        return {
+            "requests": requests_num,
+            "handshakes": connections_num,
+            "pool_hits": max(0, requests_num - connections_num),
+        }
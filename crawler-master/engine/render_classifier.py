@@ -0,0 +1,129 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+from tools.structures import CrawlingType
+
+# Reasons to render a fetched page
+SPA_SHELL = "spa_shell"
+NOSCRIPT = "noscript"
+EMPTY_BODY = "empty_body"
+LOW_TEXT_RATIO = "low_text_ratio"
+# Reasons to render after a failed source fetch
+BLOCKED = "blocked"
+UNSUPPORTED_CONTENT = "unsupported_content"
+# Bot walls and JavaScript challenges answer plain clients with them
+BLOCKED_STATUSES = frozenset((401, 403, 406, 503))
+
+SCRIPT_RE = re.compile(r"<script\b", re.I)
+HIDDEN_OPEN_RE = re.compile(r"<(script|style|noscript|template|svg)\b")
+JS_HINT_RE = re.compile(r"(enable|turn on|activate|requires?|needs?)\s+(your\s+)?javascript|javascript\s+is\s+"
+                        r"(required|disabled|needed)", re.I)
+# [^<>] stops at the next tag, a stray "<" doesn't make the scan run to the end of the page
+TAG_RE = re.compile(r"<[^<>]*>")
+SPACE_RE = re.compile(r"\s+")
+# Empty mount points of client side frameworks: React, Vue, Angular, Next.js, Nuxt, Gatsby, Ember, Svelte
+SPA_ROOT_RE = re.compile(
+    r"<(div|main|section|app-root)\b[^<>]*(id\s*=\s*[\"']?(root|app|__next|__nuxt|___gatsby|ember-app|svelte)[\"' >]"
+    r"|ng-app|ng-version)[^<>]*>\s*(<(div|span)\b[^<>]*>\s*</(div|span)>\s*)?</\1\s*>", re.I)
+SPA_MARKER_RE = re.compile(r"__NEXT_DATA__|window\.__NUXT__|data-reactroot|ng-version=|window\.__INITIAL_STATE__|"
+                           r"/_next/static/|/_nuxt/|ember-cli|webpackJsonp|/static/js/main\.", re.I)
+
+
+def split_hidden(html: str) -> Tuple[str, List[str]]:
+    # Markup without script, style, noscript, template and svg elements, and the bodies of the noscript ones.
+    # One pass with find of the closing tag: a page cut inside an element just ends there
+    lower = html.lower()
+    parts = []
+    noscripts = []
+    position = 0
+    while True:
+        match = HIDDEN_OPEN_RE.search(lower, position)
+        if match is None:
+            parts.append(html[position:])
+            break
+        parts.append(html[position:match.start()])
+        end = lower.find(f"</{match.group(1)}", match.end())
+        if match.group(1) == "noscript":
+            body_start = lower.find(">", match.end())
+            noscripts.append(html[body_start + 1:end if end >= 0 else len(html)] if body_start >= 0 else "")
+        if end < 0:
+            break
+        close = lower.find(">", end)
+        position = len(html) if close < 0 else close + 1
+    return " ".join(parts), noscripts
+
+
+def visible_text(markup: str) -> str:
+    return SPACE_RE.sub(" ", TAG_RE.sub(" ", markup)).strip()
+
+
+class RenderClassifier:
+    # Cheap checks of a fetched page: a page is rendered only when its content is likely built by JavaScript
+
+    def __init__(self, min_text_length=200, shell_text_length=1000, min_text_ratio=0.02, sample_size=512 * 1024):
+        self.min_text_length = min_text_length
+        self.shell_text_length = shell_text_length
+        self.min_text_ratio = min_text_ratio
+        self.sample_size = sample_size
+
+    def render_reason(self, html: Optional[str]) -> Optional[str]:
+        if not html:
+            return EMPTY_BODY
+        html = html[:self.sample_size]
+        if not SCRIPT_RE.search(html):
+            # Nothing would change the page in a browser
+            return None
+        markup, noscripts = split_hidden(html)
+        text_length = len(visible_text(markup))
+        if text_length < self.shell_text_length:
+            # Framework markers alone are not enough, server side rendered apps have them too
+            if SPA_ROOT_RE.search(markup) or (text_length < self.min_text_length and SPA_MARKER_RE.search(html)):
+                return SPA_SHELL
+            if any(JS_HINT_RE.search(noscript) for noscript in noscripts):
+                return NOSCRIPT
+        if text_length < self.min_text_length:
+            return EMPTY_BODY
+        # Inline scripts and styles don't count, hydration data of server side rendered pages is often most of them
+        if text_length / len(markup) < self.min_text_ratio:
+            return LOW_TEXT_RATIO
+        return None
+
+
+class RenderDecisionCache:
+    # Crawling type chosen for a domain, it is reused until max_age passes
+
+    def __init__(self, max_size=100000, max_age=7 * 86400):
+        self._max_size = max_size
+        self._max_age = max_age
+        self._decisions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, domain) -> Optional[CrawlingType]:
+        with self._lock:
+            entry = self._decisions.get(domain)
+            if entry is None:
+                return None
+            crawling_type, decided_at = entry
+            if time.monotonic() - decided_at > self._max_age:
+                del self._decisions[domain]
+                return None
+            self._decisions.move_to_end(domain)
+            return crawling_type
+
+    def set(self, domain, crawling_type: CrawlingType):
+        with self._lock:
+            self._decisions[domain] = (crawling_type, time.monotonic())
+            self._decisions.move_to_end(domain)
+            while len(self._decisions) > self._max_size:
+                self._decisions.popitem(last=False)
+
+    def forget(self, domain):
+        with self._lock:
+            self._decisions.pop(domain, None)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._decisions)
@@ -0,0 +1,114 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from engine.contract import EngineContract
+
+logger = logging.getLogger(__name__)
+
+
+# AIMD concurrency limit: grows by one per window of good results, shrinks on errors or slow results
+class AdaptiveLimit:
+
+    def __init__(self, initial=2, min_limit=1, max_limit=32, latency_target=20.0, backoff=0.5):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_target = latency_target
+        self.backoff = backoff
+        self._limit = float(min(max(initial, min_limit), max_limit))
+        self._in_flight = 0
+        self._condition = threading.Condition()
+
+    @property
+    def limit(self):
+        return int(self._limit)
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    def acquire(self):
+        with self._condition:
+            while self._in_flight >= int(self._limit):
+                self._condition.wait()
+            self._in_flight += 1
+
+    def release(self):
+        with self._condition:
+            self._in_flight -= 1
+            self._condition.notify_all()
+
+    def record(self, latency, ok):
+        with self._condition:
+            if not ok or latency > self.latency_target:
+                self._limit = max(self.min_limit, self._limit * self.backoff)
+            else:
+                self._limit = min(self.max_limit, self._limit + 1 / self._limit)
+            self._condition.notify_all()
+
+
+class RenderDispatcher(EngineContract):
+
+    def __init__(self, engine: EngineContract, limit: AdaptiveLimit = None, park_after=30.0, max_parked=16):
+        self._engine = engine
+        self._limit = limit if limit is not None else AdaptiveLimit()
+        self._park_after = park_after
+        self._max_parked = max_parked
+        self._parked = 0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=self._limit.max_limit + max_parked,
+                                            thread_name_prefix="render")
+        self._stats = {"completed": 0, "failed": 0, "parked": 0}
+
+    def stats(self):
+        stats = dict(self._stats)
+        stats.update(limit=self._limit.limit, in_flight=self._limit.in_flight, parked_now=self._parked)
+        if hasattr(self._engine, "stats"):
+            stats.update(self._engine.stats())
+        return stats
+
+    def _try_park(self):
+        with self._lock:
+            if self._parked >= self._max_parked:
+                return False
+            self._parked += 1
+            self._stats["parked"] += 1
+            return True
+
+    def _unpark(self):
+        with self._lock:
+            self._parked -= 1
+
+    def _finish(self, started, failed, overloaded):
+        with self._lock:
+            self._stats["failed" if failed else "completed"] += 1
+        self._limit.record(time.monotonic() - started, not overloaded)
+
+    def _result(self, future, started):
+        try:
+            response = future.result()
+        except Exception as e:
+            # Only transient failures mean an overloaded backend, a 404 of a site says nothing about it
+            self._finish(started, failed=True, overloaded=getattr(e, "retryable", True))
+            raise
+        self._finish(started, failed=response is None, overloaded=response is None)
+        return response
+
+    def request(self, domain, crawling_type=None):
+        self._limit.acquire()
+        started = time.monotonic()
+        future = self._executor.submit(self._engine.request, domain, crawling_type)
+        wait([future], timeout=self._park_after)
+        parked = not future.done() and self._try_park()
+        if parked:
+            # A parked render stops counting against the limit, so faster renders keep the backend busy
+            logger.warning(f"Render of {domain} takes longer than {self._park_after}s, parked")
+            self._limit.release()
+        try:
+            return self._result(future, started)
+        finally:
+            if parked:
+                self._unpark()
+            else:
+                self._limit.release()
@@ -3,17 +3,31 @@ import logging
 
 import requests
 
+from crawler.metrics import HTTP_PHASE_SECONDS
 from engine.contract import EngineContract
+from engine.fallback import FallbackStrategy, SEQUENTIAL
+from engine.http_session import PooledSession
+from exceptions import CrawlError, CrawlConnectionError, CrawlTimeoutError, HTTPStatusError
 
 
 logger = logging.getLogger(__name__)
 
 
 class RenderAPIEngine(EngineContract):
+    # The render API gives up this many seconds before the read timeout, so its error comes back instead of ours
+    RENDER_TIMEOUT_MARGIN = 5
 
-    def __init__(self, render_api_url, headers):
+    def __init__(self, render_api_url, headers, fallback: FallbackStrategy = None, session: PooledSession = None,
+                 connect_timeout=10, read_timeout=300):
         self._render_api_url = render_api_url
         self.headers = headers if headers is not None else {}
+        self.fallback = fallback if fallback is not None else FallbackStrategy(mode=SEQUENTIAL)
+        self.session = session if session is not None else PooledSession(pool_connections=1)
+        self.timeout = (connect_timeout, read_timeout)
+        self.render_timeout = max(1, int(read_timeout - self.RENDER_TIMEOUT_MARGIN))
+
+    def stats(self):
+        return self.session.stats()
 
     def _get_response(self, _schema, domain):
         url = f"{_schema}://{domain}"
@@ -21,55 +35,53 @@ class RenderAPIEngine(EngineContract):
             "url": url,
             "headers": self.headers,
             "html": 1,
-            "timeout": 300,
+            "timeout": self.render_timeout,
             "images": 0,
             "wait": 1.5,
             "har": 1,
             "history": 1,
         }
         try:
-            response = requests.post(
-                self._render_api_url,
-                headers={'Content-Type': 'application/json'},
-                data=json.dumps(request_params)
-            )
+            # Time to first byte of the render API is the render time, the body is read by the parser
+            with HTTP_PHASE_SECONDS.time(engine="render", phase="ttfb"):
+                response = self.session.post(
+                    self._render_api_url,
+                    headers={'Content-Type': 'application/json'},
+                    data=json.dumps(request_params),
+                    timeout=self.timeout,
+                    stream=True,
+                )
             response_status = response.status_code
             if response_status < 200 or response_status >= 400:
                 logger.warning(f"Response {response_status} from {url}")
-                return None
+                response.close()
+                raise HTTPStatusError(response_status, f"Response {response_status} from {url}")
             if response_status == 204:
                 logger.warning(f"Response {response_status} from {url}")
-                return None
+                response.close()
+                raise HTTPStatusError(response_status, f"Empty render of {url}")
+            # The body is left unread, output_message parses it as a stream
             return response
+        except CrawlError:
+            raise
         except requests.exceptions.SSLError as e:
             logger.warning(f"SSLError occurred for {url}: {e}")
-            return None
+            raise CrawlConnectionError(f"SSLError for {url}: {e}", retryable=False) from e
         except requests.exceptions.ReadTimeout as e:
             logger.warning(f"Read timeout occurred. for {url}: {e}")
-            return None
+            raise CrawlTimeoutError(f"Read timeout for {url}: {e}") from e
         except requests.exceptions.ConnectTimeout as e:
             logger.warning(f"Connection timeout occurred for {url}: {e}")
-            return None
+            raise CrawlTimeoutError(f"Connection timeout for {url}: {e}") from e
         except requests.exceptions.ConnectionError as e:
             logger.warning(f"ConnectionError occurred for {url}: {e}")
-            return None
+            raise CrawlConnectionError(f"ConnectionError for {url}: {e}") from e
         except requests.exceptions.HTTPError as e:
             logger.warning(f"HTTPError occurred for url {url}: {e}")
-            return None
+            raise CrawlConnectionError(f"HTTPError for {url}: {e}") from e
         except Exception as e:
             logger.warning(f"Exception for url: {url}. {e}")
-            return None
+            raise CrawlError(f"Exception for {url}: {e}") from e
 
     def request(self, domain, crawling_type=None):
-        _schema = "https"
-        resp = self._get_response(_schema, domain)
-        if not resp:
-            _schema = "https"
-            resp = self._get_response(_schema, "www." + domain)
-            if not resp:
-                _schema = "http"
-                resp = self._get_response(_schema, domain)
-                if not resp:
-                    _schema = "http"
-                    resp = self._get_response(_schema, "www." + domain)
-        return resp
+        return self.fallback.fetch(domain, self._get_response)
@@ -0,0 +1,71 @@
+import io
+import json
+from typing import NamedTuple, Optional
+
+import ijson
+
+from exceptions import ParseError
+
+ENTRY_PREFIX = "har.log.entries.item"
+HEADERS_PREFIX = "har.log.entries.item.response.headers"
+REQUEST_URL_PREFIX = "har.log.entries.item.request.url"
+
+
+class RenderResult(NamedTuple):
+    page_url: str
+    html: str
+    headers: str
+    web_requests: str
+
+
+def render_payload_stream(response):
+    raw = getattr(response, "raw", None)
+    if raw is not None and not getattr(response, "_content_consumed", False):
+        raw.decode_content = True
+        return raw
+    return io.BytesIO(response.content)
+
+
+def parse_render_payload(stream) -> RenderResult:
+    page_url: Optional[str] = None
+    html: Optional[str] = None
+    headers = None
+    headers_builder = None
+    web_requests = []
+    entry_index = -1
+
+    for prefix, event, value in ijson.parse(stream, use_float=True):
+        if headers_builder is not None:
+            headers_builder.event(event, value)
+            if prefix == HEADERS_PREFIX and event in ("end_array", "end_map"):
+                headers = headers_builder.value
+                headers_builder = None
+        elif prefix == "requestedUrl" and event == "string":
+            page_url = value
+        elif prefix == "html" and event == "string":
+            html = value
+        elif prefix == ENTRY_PREFIX and event == "start_map":
+            entry_index += 1
+        elif prefix == REQUEST_URL_PREFIX and event == "string":
+            web_requests.append(value)
+        elif prefix == HEADERS_PREFIX and entry_index == 0 and event in ("start_array", "start_map"):
+            # Only the first response headers are kept, the rest of the HAR is never built into objects
+            headers_builder = ijson.ObjectBuilder()
+            headers_builder.event(event, value)
+
+    if page_url is None or html is None:
+        raise ParseError("Render payload has no requestedUrl or html")
+    return RenderResult(page_url=page_url,
+                        html=html,
+                        headers=json.dumps(headers if headers is not None else {}),
+                        web_requests=json.dumps(web_requests))
+
+
+def parse_render_response(response) -> RenderResult:
+    try:
+        return parse_render_payload(render_payload_stream(response))
+    except ijson.JSONError as e:
+        raise ParseError(f"Broken render payload: {e}") from e
+    finally:
+        if hasattr(response, "close"):
+            response.close()
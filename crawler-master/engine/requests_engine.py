@@ -1,8 +1,16 @@
 import logging
+from contextlib import contextmanager
 
 import requests
 
+from crawler.metrics import HTTP_PHASE_SECONDS
+from engine.body_reader import DEFAULT_ALLOWED_CONTENT_TYPES, is_allowed_content_type, read_limited
+from engine.charset import DEFAULT_SNIFF_SIZE, detect_encoding
 from engine.contract import EngineContract
+from engine.fallback import FallbackStrategy, SEQUENTIAL
+from engine.http_session import PooledSession
+from engine.validator_store import ValidatorStore
+from exceptions import CrawlError, CrawlConnectionError, CrawlTimeoutError, HTTPStatusError, ParseError
 
 
 logger = logging.getLogger(__name__)
@@ -10,55 +18,125 @@ logger = logging.getLogger(__name__)
 
 class RequestsEngine(EngineContract):
 
-    def __init__(self, headers: dict = None):
+    def __init__(self, headers: dict = None, fallback: FallbackStrategy = None, session: PooledSession = None,
+                 connect_timeout=10, read_timeout=200, max_body_size=5 * 1024 * 1024, chunk_size=64 * 1024,
+                 allowed_content_types=DEFAULT_ALLOWED_CONTENT_TYPES, validators: ValidatorStore = None,
+                 charset_sniff_size=DEFAULT_SNIFF_SIZE):
+        self.validators = validators
+        self.charset_sniff_size = charset_sniff_size
         self.headers = headers if headers is not None else {}
+        self.fallback = fallback if fallback is not None else FallbackStrategy(mode=SEQUENTIAL)
+        self.session = session if session is not None else PooledSession()
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_body_size = max_body_size
+        self.chunk_size = chunk_size
+        self.allowed_content_types = allowed_content_types
 
-    def _get_response(self, _schema, domain):
-        url = f"{_schema}://{domain}"
-        request_params = {
-            'timeout': 200,
-            'headers': self.headers,
-        }
+    def stats(self):
+        return self.session.stats()
+
+    def _read_body(self, response):
         try:
-            response = requests.get(
-                url,
-                **request_params,
-            )
-            response_status = response.status_code
-            if response_status < 200 or response_status >= 400:
-                logger.warning(f"Response {response_status} from {url}")
-                return None
-            response.url = url
-            return response
+            with HTTP_PHASE_SECONDS.time(engine="requests", phase="download"):
+                content, truncated = read_limited(response.iter_content(chunk_size=self.chunk_size),
+                                                  self.max_body_size)
+        finally:
+            # Releases the connection back to the pool, or drops it if the body was cut
+            response.close()
+        response._content = content
+        response._content_consumed = True
+        response.truncated = truncated
+        response.body_size = len(content)
+        # Set explicitly, so response.text never falls back to chardet over the whole body
+        response.encoding = detect_encoding(content, response.headers.get("Content-Type"), self.charset_sniff_size)
+        if truncated:
+            logger.warning(f"Body of {response.url} is truncated to {self.max_body_size} bytes")
+        return response
+
+    def _request_headers(self, url):
+        if self.validators is None:
+            return self.headers
+        return {**self.headers, **self.validators.conditional_headers(url)}
+
+    @staticmethod
+    def _not_modified(response, url):
+        response.close()
+        response.url = url
+        response._content = b""
+        response._content_consumed = True
+        response.not_modified = True
+        return response
+
+    def _attach_validators(self, response, url):
+        # Saved by the output queue once the page is indexed, a lost write must not turn into a 304 next time
+        response.validators = None
+        if self.validators is not None:
+            response.validators = self.validators.from_headers(url, response.headers)
+
+    @staticmethod
+    @contextmanager
+    def _request_errors(url):
+        try:
+            yield
+        except CrawlError:
+            raise
         except requests.exceptions.SSLError as e:
             logger.warning(f"SSLError occurred for {url}: {e}")
-            return None
+            raise CrawlConnectionError(f"SSLError for {url}: {e}", retryable=False) from e
         except requests.exceptions.ReadTimeout as e:
             logger.warning(f"Read timeout occurred. for {url}: {e}")
-            return None
+            raise CrawlTimeoutError(f"Read timeout for {url}: {e}") from e
         except requests.exceptions.ConnectTimeout as e:
             logger.warning(f"Connection timeout occurred for {url}: {e}")
-            return None
+            raise CrawlTimeoutError(f"Connection timeout for {url}: {e}") from e
         except requests.exceptions.ConnectionError as e:
             logger.warning(f"ConnectionError occurred for {url}: {e}")
-            return None
+            raise CrawlConnectionError(f"ConnectionError for {url}: {e}") from e
         except requests.exceptions.HTTPError as e:
             logger.warning(f"HTTPError occurred for url {url}: {e}")
-            return None
+            raise CrawlConnectionError(f"HTTPError for {url}: {e}") from e
         except Exception as e:
             logger.warning(f"Exception for url: {url}. {e}")
-            return None
+            raise CrawlError(f"Exception for {url}: {e}") from e
+
+    def _open_response(self, _schema, domain):
+        # Stops after the headers, the body is left unread for _finish_response
+        url = f"{_schema}://{domain}"
+        request_params = {
+            'timeout': self.timeout,
+            'headers': self._request_headers(url),
+            'stream': True,
+        }
+        with self._request_errors(url):
+            # requests exposes no connection phases, time to first byte includes DNS, connect and TLS
+            with HTTP_PHASE_SECONDS.time(engine="requests", phase="ttfb"):
+                response = self.session.get(
+                    url,
+                    **request_params,
+                )
+            response_status = response.status_code
+            if response_status == 304:
+                return self._not_modified(response, url)
+            if response_status < 200 or response_status >= 400:
+                logger.warning(f"Response {response_status} from {url}")
+                response.close()
+                raise HTTPStatusError(response_status, f"Response {response_status} from {url}")
+            content_type = response.headers.get("Content-Type")
+            if not is_allowed_content_type(content_type, self.allowed_content_types):
+                logger.warning(f"Skip {content_type} content from {url}")
+                response.close()
+                raise ParseError(f"Unsupported {content_type} content from {url}")
+            response.url = url
+            return response
+
+    def _finish_response(self, response):
+        if getattr(response, "not_modified", False):
+            return response
+        with self._request_errors(response.url):
+            response = self._read_body(response)
+        self._attach_validators(response, response.url)
+        return response
 
     def request(self, domain, crawling_type=None):
-        _schema = "https"
-        resp = self._get_response(_schema, domain)
-        if not resp:
-            _schema = "https"
-            resp = self._get_response(_schema, "www." + domain)
-            if not resp:
-                _schema = "http"
-                resp = self._get_response(_schema, domain)
-                if not resp:
-                    _schema = "http"
-                    resp = self._get_response(_schema, "www." + domain)
-        return resp
+        # Racing variants only download the body of the winner, the losers are closed after their headers
+        return self.fallback.fetch(domain, self._open_response, self._finish_response)
@@ -0,0 +1,52 @@
+import sqlite3
+import threading
+import time
+from typing import Optional, Tuple
+
+
+class ValidatorStore:
+
+    def __init__(self, path):
+        self._path = path
+        self._local = threading.local()
+        self._connection().execute(
+            "CREATE TABLE IF NOT EXISTS validators ("
+            "url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, updated_at REAL NOT NULL) WITHOUT ROWID"
+        )
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self._path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def get(self, url) -> Optional[Tuple[Optional[str], Optional[str]]]:
+        return self._connection().execute(
+            "SELECT etag, last_modified FROM validators WHERE url = ?", (url,)).fetchone()
+
+    def conditional_headers(self, url) -> dict:
+        validators = self.get(url)
+        if validators is None:
+            return {}
+        etag, last_modified = validators
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+        return headers
+
+    @staticmethod
+    def from_headers(url, headers) -> dict:
+        return {"url": url, "etag": headers.get("ETag"), "last_modified": headers.get("Last-Modified")}
+
+    def save(self, url, etag: Optional[str], last_modified: Optional[str]):
+        if not etag and not last_modified:
+            self._connection().execute("DELETE FROM validators WHERE url = ?", (url,))
+            return
+        self._connection().execute(
+            "INSERT OR REPLACE INTO validators (url, etag, last_modified, updated_at) VALUES (?, ?, ?, ?)",
+            (url, etag, last_modified, time.time()))
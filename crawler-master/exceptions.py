@@ -1,5 +1,51 @@
+from typing import Optional, Tuple
+
+TIMEOUT = "timeout"
+CONNECTION = "connection"
+DNS = "dns"
+HTTP_STATUS = "http_status"
+PARSE = "parse"
+INTERNAL = "internal"
+
+
 class CrawlError(Exception):
-    pass
+    # Reason and retryable route a failed message: transient failures are retried later, permanent ones are not
+    reason = INTERNAL
+    retryable = False
+
+    def __init__(self, message="", retryable: Optional[bool] = None):
+        super().__init__(message)
+        if retryable is not None:
+            self.retryable = retryable
+
+
+class CrawlTimeoutError(CrawlError):
+    reason = TIMEOUT
+    retryable = True
+
+
+class CrawlConnectionError(CrawlError):
+    reason = CONNECTION
+    retryable = True
+
+
+class DNSError(CrawlError):
+    reason = DNS
+    retryable = True
+
+
+class HTTPStatusError(CrawlError):
+    reason = HTTP_STATUS
+
+    def __init__(self, status_code, message=""):
+        # Rate limits and server errors pass, client errors stay
+        super().__init__(message or f"Response {status_code}",
+                         retryable=status_code is not None and (status_code == 429 or status_code >= 500))
+        self.status_code = status_code
+
+
+class ParseError(CrawlError):
+    reason = PARSE
 
 
 class EngineError(Exception):
@@ -16,3 +62,15 @@ class WrongFormatError(Exception):
 
 class WrongCrawlingType(Exception):
     pass
+
+
+def classify_error(error: Exception) -> Tuple[str, bool]:
+    if isinstance(error, CrawlError):
+        return error.reason, error.retryable
+    if isinstance(error, (WrongCrawlingType, WrongFormatError, ValueError, KeyError)):
+        return PARSE, False
+    if isinstance(error, TimeoutError):
+        return TIMEOUT, True
+    if isinstance(error, ConnectionError):
+        return CONNECTION, True
+    return INTERNAL, False
@@ -0,0 +1,102 @@
+import hashlib
+import re
+import sqlite3
+import threading
+from collections import Counter
+from typing import Iterable, NamedTuple, Optional, Tuple
+
+TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+SIMHASH_MAX_TEXT = 200000
+SIMHASH_MAX_TOKENS = 4096
+
+
+def _signed(value):
+    # sqlite INTEGER is a signed 64-bit value
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def content_digest(text: str) -> int:
+    digest = hashlib.blake2b(text.encode("utf-8", errors="replace"), digest_size=8).digest()
+    return _signed(int.from_bytes(digest, "big"))
+
+
+def simhash(text: str) -> int:
+    tokens = Counter(TOKEN_RE.findall(text[:SIMHASH_MAX_TEXT].lower()))
+    weights = [0] * 64
+    for token, weight in tokens.most_common(SIMHASH_MAX_TOKENS):
+        token_hash = int.from_bytes(hashlib.blake2b(token.encode("utf-8"), digest_size=8).digest(), "big")
+        for bit in range(64):
+            if token_hash >> bit & 1:
+                weights[bit] += weight
+            else:
+                weights[bit] -= weight
+    value = 0
+    for bit, weight in enumerate(weights):
+        if weight > 0:
+            value |= 1 << bit
+    return _signed(value)
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return bin((a ^ b) & ((1 << 64) - 1)).count("1")
+
+
+class Fingerprint(NamedTuple):
+    digest: int
+    simhash: Optional[int] = None
+
+
+class FingerprintStore:
+
+    def __init__(self, path, max_distance=3):
+        self._path = path
+        self.max_distance = max_distance
+        self._local = threading.local()
+        self._connection().execute(
+            "CREATE TABLE IF NOT EXISTS fingerprints ("
+            "doc_id BLOB NOT NULL, crawling_type TEXT NOT NULL, digest INTEGER NOT NULL, simhash INTEGER, "
+            "PRIMARY KEY (doc_id, crawling_type)) WITHOUT ROWID"
+        )
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self._path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def get(self, doc_id: str, crawling_type: str) -> Optional[Fingerprint]:
+        row = self._connection().execute(
+            "SELECT digest, simhash FROM fingerprints WHERE doc_id = ? AND crawling_type = ?",
+            (bytes.fromhex(doc_id), crawling_type)).fetchone()
+        if row is None:
+            return None
+        return Fingerprint(*row)
+
+    def changed_fingerprint(self, doc_id: str, crawling_type: str, text: str,
+                            near_duplicates=False) -> Optional[Fingerprint]:
+        # None for content unchanged since the stored fingerprint. The simhash costs tens of milliseconds
+        # for a large page, it is only computed once the exact digest differs
+        digest = content_digest(text)
+        previous = self.get(doc_id, crawling_type)
+        if previous is not None and previous.digest == digest:
+            return None
+        fingerprint = Fingerprint(digest, simhash(text) if near_duplicates else None)
+        if previous is not None and previous.simhash is not None and fingerprint.simhash is not None \
+                and hamming_distance(previous.simhash, fingerprint.simhash) <= self.max_distance:
+            return None
+        return fingerprint
+
+    def save(self, fingerprints: Iterable[Tuple[str, str, Fingerprint]]):
+        connection = self._connection()
+        rows = [(bytes.fromhex(doc_id), crawling_type, fingerprint.digest, fingerprint.simhash)
+                for doc_id, crawling_type, fingerprint in fingerprints]
+        if not rows:
+            return
+        with connection:
+            connection.execute("BEGIN")
+            connection.executemany(
+                "INSERT OR REPLACE INTO fingerprints (doc_id, crawling_type, digest, simhash) VALUES (?, ?, ?, ?)",
+                rows)
@@ -1,11 +1,17 @@
 import hashlib
 import json
 import logging
+import threading
+import time
 from abc import ABCMeta, abstractmethod
 from datetime import datetime
+from typing import Callable
 
 from elasticsearch.helpers import bulk
 
+from engine.validator_store import ValidatorStore
+from queues.fingerprint_store import FingerprintStore
+
 logger = logging.getLogger(__name__)
 
 
@@ -14,6 +20,12 @@ class OutputQueue(metaclass=ABCMeta):
     def put(self, message: str):
         pass
 
+    def flush(self):
+        pass
+
+    def close(self):
+        self.flush()
+
 
 class OutputQueueComposite(OutputQueue):
     def __init__(self):
@@ -26,6 +38,107 @@ class OutputQueueComposite(OutputQueue):
         for queue in self._queues:
             queue.put(message)
 
+    def flush(self):
+        for queue in self._queues:
+            queue.flush()
+
+    def close(self):
+        for queue in self._queues:
+            queue.close()
+
+
+class BufferedQueue(OutputQueue):
+    # Callers only append to a buffer, a background thread writes batches to the wrapped queue and flushes it.
+    # A failed batch is written again until it succeeds, on_written callbacks run once their message is written
+
+    def __init__(self, queue: OutputQueue, batch_size=100, max_latency=1.0, max_buffer=10000, retry_delay=1.0,
+                 max_retry_delay=60.0, close_retries=3):
+        self._queue = queue
+        self._batch_size = batch_size
+        self._max_latency = max_latency
+        self._max_buffer = max_buffer
+        self._retry_delay = retry_delay
+        self._max_retry_delay = max_retry_delay
+        self._close_retries = close_retries
+        self._buffer = []
+        self._closed = False
+        self._condition = threading.Condition()
+        self._flusher = threading.Thread(target=self._run, name="buffered-queue", daemon=True)
+        self._flusher.start()
+
+    def stats(self):
+        return self._queue.stats() if hasattr(self._queue, "stats") else {}
+
+    def put(self, message, on_written: Callable[[], None] = None):
+        with self._condition:
+            while len(self._buffer) >= self._max_buffer and not self._closed:
+                # Back-pressure when the wrapped queue can't keep up
+                self._condition.wait()
+            self._buffer.append((message, on_written))
+            if len(self._buffer) >= self._batch_size:
+                self._condition.notify_all()
+
+    def _take(self):
+        with self._condition:
+            if not self._closed and len(self._buffer) < self._batch_size:
+                self._condition.wait(self._max_latency)
+            # No more than a batch: a wrapped queue committing every batch_size would republish
+            # its committed part when a larger batch fails partway and is written again
+            batch, self._buffer = self._buffer[:self._batch_size], self._buffer[self._batch_size:]
+            self._condition.notify_all()
+            return batch, self._closed and not self._buffer
+
+    def _write_once(self, batch) -> bool:
+        try:
+            for message, _ in batch:
+                self._queue.put(message)
+            self._queue.flush()
+        except Exception as e:
+            logger.error(f"Can't write {len(batch)} buffered messages: {e}", exc_info=True)
+            return False
+        return True
+
+    def _write(self, batch):
+        retry_delay = self._retry_delay
+        failures = 0
+        while not self._write_once(batch):
+            failures += 1
+            with self._condition:
+                if self._closed and failures > self._close_retries:
+                    # Their input messages stay unacked and are delivered again
+                    logger.error(f"Give up writing {len(batch)} buffered messages")
+                    return
+                deadline = time.monotonic() + retry_delay
+                while not self._closed and time.monotonic() < deadline:
+                    self._condition.wait(deadline - time.monotonic())
+            retry_delay = min(retry_delay * 2, self._max_retry_delay)
+        for _, on_written in batch:
+            if on_written is None:
+                continue
+            try:
+                on_written()
+            except Exception as e:
+                logger.error(f"Callback of a written message failed: {e}", exc_info=True)
+
+    def _run(self):
+        while True:
+            batch, closed = self._take()
+            if batch:
+                self._write(batch)
+            if closed:
+                return
+
+    def flush(self):
+        with self._condition:
+            self._condition.notify_all()
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._flusher.join()
+        self._queue.close()
+
 
 class PrintingQueue(OutputQueue):
     def put(self, message: str):
@@ -44,12 +157,48 @@ class RMQQueue(OutputQueue):
                          exc_info=True)
 
 
+UNCHANGED_LAST_SEEN = "last_seen"
+UNCHANGED_SKIP = "skip"
+
+
 class ESIndexQueue(OutputQueue):
-    def __init__(self, elastic_search, index, batch_size=1):
+    # Crawling types whose body is compared with simhash, small markup changes don't count as changes
+    NEAR_DUPLICATE_TYPES = {"source", "render", "careers"}
+
+    # Statuses of bulk items which are worth sending again
+    RETRY_STATUSES = {409, 429, 500, 502, 503, 504, "N/A", None}
+
+    def __init__(self, elastic_search, index, batch_size=1, max_batch_bytes=10 * 1024 * 1024,
+                 max_latency=5.0, max_retries=3, retry_backoff=1.0, fingerprints: FingerprintStore = None,
+                 unchanged_mode=UNCHANGED_LAST_SEEN, validators: ValidatorStore = None):
+        if unchanged_mode not in (UNCHANGED_LAST_SEEN, UNCHANGED_SKIP):
+            raise RuntimeError(f"Unknown unchanged documents mode: {unchanged_mode}")
+        self._fingerprints = fingerprints
+        self._unchanged_mode = unchanged_mode
+        self.__batch_fingerprints = []
+        self._validators = validators
+        self.__batch_validators = []
         self._elastic_search = elastic_search
         self._batch_size = batch_size
+        self._max_batch_bytes = max_batch_bytes
+        self._max_latency = max_latency
+        self._max_retries = max_retries
+        self._retry_backoff = retry_backoff
         self._index = index
         self.__batch = []
+        self.__batch_bytes = 0
+        self.__batch_started = None
+        self._batch_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stats = {"flushes": 0, "indexed": 0, "failed": 0, "retried": 0, "unchanged": 0,
+                       "last_flush_seconds": 0.0}
+        self._closed = threading.Event()
+        self._flusher = None
+        if batch_size > 1 and max_latency:
+            self._flusher = threading.Thread(target=self._flush_periodically,
+                                             name="es-flusher",
+                                             daemon=True)
+            self._flusher.start()
 
     @staticmethod
     def crawling_types_mapping():
@@ -77,63 +226,262 @@ class ESIndexQueue(OutputQueue):
 
         return mapped_type
 
+    def map_records_fields(self, records):
+        fields = {}
+        for record_type, value in records.items():
+            if value is None:
+                continue
+            fields[self.map_crawling_type_field({"crawling_type": record_type})] = value
+        return fields
+
     def create_document_to_index(self, document):
-        mapped_field = self.map_crawling_type_field(document)
         doc_to_index = {
             "doc": {
-                mapped_field: document["response"],
                 "domain": document["domain"],
                 "timestamp": datetime.utcnow()
             },
             "doc_as_upsert": True
         }
+        if document.get("records") is not None:
+            doc_to_index["doc"].update(self.map_records_fields(document["records"]))
+        else:
+            mapped_field = self.map_crawling_type_field(document)
+            doc_to_index["doc"][mapped_field] = document["response"]
         if document["page_url"]:
             doc_to_index["doc"]["page_url"] = document["page_url"]
         if document["headers"]:
             doc_to_index["doc"]["headers"] = document["headers"]
         if document["web_requests"]:
             doc_to_index["doc"]["web_requests"] = document["web_requests"]
+        if document.get("truncated") is not None:
+            doc_to_index["doc"]["truncated"] = document["truncated"]
+            doc_to_index["doc"]["body_size"] = document["body_size"]
 
         return doc_to_index
 
     @staticmethod
-    def _is_indexed(response):
-        if "errors" in response and "items" in response \
-                and response["errors"]:
-            errors_string = ""
-            for item in response["items"]:
-                item_error = item.get("index", {}).get("error", "")
-                errors_string += item_error + "; " if item_error else ""
-            logger.error("Fail to index: ", errors_string)
-            return False
-        return True
+    def document_id(domain):
+        domain = str(domain)
+        if domain.endswith('/'):
+            domain = domain.strip('/')
+        return hashlib.md5(domain.encode("utf-8")).hexdigest()
+
+    def create_action(self, doc: dict):
+        action = {
+            "_op_type": "update",
+            "_index": self._index,
+            "_id": self.document_id(doc["domain"]),
+            "retry_on_conflict": 3,
+        }
+        action.update(self.create_document_to_index(doc))
+        return action
+
+    def create_last_seen_action(self, doc: dict):
+        return {
+            "_op_type": "update",
+            "_index": self._index,
+            "_id": self.document_id(doc["domain"]),
+            "retry_on_conflict": 3,
+            "doc": {
+                "domain": doc["domain"],
+                "last_seen": datetime.utcnow(),
+            },
+            "doc_as_upsert": True,
+        }
+
+    @staticmethod
+    def fingerprint_content(doc: dict):
+        if doc.get("records") is not None:
+            return json.dumps(doc["records"], sort_keys=True)
+        return doc.get("response") or ""
+
+    @staticmethod
+    def estimate_size(doc: dict):
+        return sum(len(value) for value in doc.values() if isinstance(value, str)) + 256
+
+    def stats(self):
+        with self._batch_lock:
+            stats = dict(self._stats)
+            stats["buffered"] = len(self.__batch)
+        return stats
+
+    def _take_batch(self):
+        batch, fingerprints, validators = self.__batch, self.__batch_fingerprints, self.__batch_validators
+        self.__batch = []
+        self.__batch_fingerprints = []
+        self.__batch_validators = []
+        self.__batch_bytes = 0
+        self.__batch_started = None
+        return batch, fingerprints, validators
+
+    def _flush_periodically(self):
+        while not self._closed.wait(self._max_latency / 2):
+            with self._batch_lock:
+                expired = self.__batch_started is not None \
+                    and time.monotonic() - self.__batch_started >= self._max_latency
+            if expired:
+                self.flush()
 
-    def process_es_bulk(self):
+    def _failed_ids(self, errors):
+        retry_ids, failed_ids = set(), set()
+        for error in errors:
+            for op_type, item in error.items():
+                if item.get("status") in self.RETRY_STATUSES:
+                    retry_ids.add(item.get("_id"))
+                else:
+                    failed_ids.add(item.get("_id"))
+                    logger.error(f"Fail to index document {item.get('_id')}: {item.get('error')}")
+        return retry_ids, failed_ids
+
+    def process_es_bulk(self, actions):
+        started = time.monotonic()
+        attempt = 0
+        indexed = failed = retried = 0
+        not_indexed_ids = set()
+        given_up_ids = set()
+        while actions:
+            try:
+                success, errors = bulk(self._elastic_search, actions,
+                                       raise_on_error=False,
+                                       raise_on_exception=False)
+            except Exception as e:
+                logger.error("Fail to bulk process: {}".format(e))
+                success, errors = 0, [{"update": {"_id": action["_id"], "status": None}} for action in actions]
+            indexed += success
+            retry_ids, failed_ids = self._failed_ids(errors)
+            failed += len(failed_ids)
+            not_indexed_ids.update(failed_ids)
+            actions = [action for action in actions if action["_id"] in retry_ids]
+            if not actions:
+                break
+            if attempt >= self._max_retries:
+                logger.error(f"Give up indexing {len(actions)} documents after {attempt} retries")
+                failed += len(actions)
+                given_up_ids = {action["_id"] for action in actions}
+                not_indexed_ids.update(given_up_ids)
+                break
+            attempt += 1
+            retried += len(actions)
+            time.sleep(self._retry_backoff * 2 ** (attempt - 1))
+        elapsed = time.monotonic() - started
+        with self._batch_lock:
+            self._stats["flushes"] += 1
+            self._stats["indexed"] += indexed
+            self._stats["failed"] += failed
+            self._stats["retried"] += retried
+            self._stats["last_flush_seconds"] = elapsed
+        logger.info(f"Bulk is inserted: {indexed} indexed, {failed} failed, {retried} retried in {elapsed:.2f}s")
+        # Given up ones failed with retryable statuses only, they are worth writing again later
+        return not_indexed_ids, given_up_ids
+
+    def save_fingerprints(self, fingerprints, not_indexed_ids):
+        # A fingerprint is only stored once its document is in the index, otherwise a failed write would be skipped forever
         try:
-            bulk_response = bulk(self._elastic_search, self.__batch,
-                                 raise_on_error=False)
+            self._fingerprints.save(fingerprint for fingerprint in fingerprints
+                                    if fingerprint[0] not in not_indexed_ids)
         except Exception as e:
-            logger.error("Fail to bulk process: {}".format(e))
-            return
-        if self._is_indexed(bulk_response):
-            logger.info("Bulk is inserted")
-            self.__batch = []
-            return
-        else:
-            logger.error(
-                "Domains data indexed with errors: {}".format(bulk_response),
-                exc_info=True)
+            logger.error(f"Fail to save fingerprints: {e}", exc_info=True)
+
+    def doc_validators(self, _id, doc: dict):
+        if self._validators is None or not doc.get("validators"):
+            return None
+        return _id, doc["validators"]
+
+    def save_validators(self, validators, not_indexed_ids):
+        # Like fingerprints: validators of a page ES didn't take would make the next crawl a 304 and lose it
+        try:
+            for _id, page_validators in validators:
+                if _id not in not_indexed_ids:
+                    self._validators.save(page_validators["url"], page_validators.get("etag"),
+                                          page_validators.get("last_modified"))
+        except Exception as e:
+            logger.error(f"Fail to save validators: {e}", exc_info=True)
+
+    def flush(self):
+        with self._flush_lock:
+            with self._batch_lock:
+                batch, fingerprints, validators = self._take_batch()
+            if batch:
+                not_indexed_ids, _ = self.process_es_bulk(batch)
+                if fingerprints:
+                    self.save_fingerprints(fingerprints, not_indexed_ids)
+                if validators:
+                    self.save_validators(validators, not_indexed_ids)
+
+    def write_batch(self, docs) -> list:
+        # Indexes the documents in one bulk right away, bypassing the buffer.
+        # Returns the documents ES couldn't take after all retries, for a SpoolQueue to write them again later
+        actions, fingerprints, validators, ids = [], [], [], []
+        for doc in docs:
+            try:
+                action, size, fingerprint = self.create_action_to_buffer(doc)
+            except Exception as e:
+                logger.error(f"Fail to index document: {e}", exc_info=True)
+                continue
+            if action is None:
+                continue
+            actions.append(action)
+            ids.append((action["_id"], doc))
+            if fingerprint is not None:
+                fingerprints.append((action["_id"], doc["crawling_type"], fingerprint))
+            page_validators = self.doc_validators(action["_id"], doc)
+            if page_validators is not None:
+                validators.append(page_validators)
+        if not actions:
+            return []
+        with self._flush_lock:
+            not_indexed_ids, given_up_ids = self.process_es_bulk(actions)
+        if fingerprints:
+            self.save_fingerprints(fingerprints, not_indexed_ids)
+        if validators:
+            self.save_validators(validators, not_indexed_ids)
+        return [doc for _id, doc in ids if _id in given_up_ids]
+
+    def close(self):
+        self._closed.set()
+        if self._flusher is not None:
+            self._flusher.join()
+        self.flush()
+
+    def create_unchanged_action(self, doc: dict):
+        with self._batch_lock:
+            self._stats["unchanged"] += 1
+        if self._unchanged_mode == UNCHANGED_SKIP:
+            return None, 0, None
+        return self.create_last_seen_action(doc), 256, None
+
+    def create_action_to_buffer(self, doc: dict):
+        if doc.get("not_modified"):
+            return self.create_unchanged_action(doc)
+        action = self.create_action(doc)
+        size = self.estimate_size(doc)
+        if self._fingerprints is None:
+            return action, size, None
+        fingerprint = self._fingerprints.changed_fingerprint(
+            action["_id"], doc["crawling_type"], self.fingerprint_content(doc),
+            near_duplicates=doc["crawling_type"] in self.NEAR_DUPLICATE_TYPES)
+        if fingerprint is None:
+            return self.create_unchanged_action(doc)
+        return action, size, fingerprint
 
     def put(self, doc: dict):
         try:
-            document_to_index = self.create_document_to_index(doc)
-            domain = str(doc["domain"])
-            if domain.endswith('/'):
-                domain = domain.strip('/')
-            _ = self._elastic_search.update(
-                index=self._index,
-                id=hashlib.md5(domain.encode("utf-8")).hexdigest(),
-                body=document_to_index)
+            action, size, fingerprint = self.create_action_to_buffer(doc)
         except Exception as e:
             logger.error(f"Fail to index document: {e}", exc_info=True)
             return
+        if action is None:
+            return
+        with self._batch_lock:
+            if self.__batch_started is None:
+                self.__batch_started = time.monotonic()
+            self.__batch.append(action)
+            if fingerprint is not None:
+                self.__batch_fingerprints.append((action["_id"], doc["crawling_type"], fingerprint))
+            page_validators = self.doc_validators(action["_id"], doc)
+            if page_validators is not None:
+                self.__batch_validators.append(page_validators)
+            self.__batch_bytes += size
+            is_full = len(self.__batch) >= self._batch_size or self.__batch_bytes >= self._max_batch_bytes
+        if is_full:
+            self.flush()
@@ -0,0 +1,153 @@
+import logging
+import queue
+import threading
+import time
+from collections import deque
+
+from amqpstorm import UriConnection, AMQPError
+
+logger = logging.getLogger(__name__)
+
+
+class RMQConsumer:
+    # Push based consumer: the broker delivers up to prefetch_count unacked messages, a consumer thread
+    # owns the channel, buffers deliveries for the workers and acks finished ones in batches.
+    # Messages are acked only after processing, so prefetch_count also bounds the work in flight.
+
+    def __init__(self, uri, queue_name, prefetch_count=100, ack_batch_size=50, ack_interval=0.2,
+                 poll_interval=0.01, receive_timeout=1.0, reconnect_delay=5.0):
+        self._uri = uri
+        self._queue_name = queue_name
+        self._prefetch_count = prefetch_count
+        self._ack_batch_size = ack_batch_size
+        self._ack_interval = ack_interval
+        self._poll_interval = poll_interval
+        self._receive_timeout = receive_timeout
+        self._reconnect_delay = reconnect_delay
+        self._buffer = queue.Queue()
+        self._lock = threading.Lock()
+        # Delivery tags of the current channel in delivery order, and the ones already processed
+        self._delivered = deque()
+        self._completed = set()
+        self._last_ack = time.monotonic()
+        self._connection = None
+        self._channel = None
+        self._stopping = threading.Event()
+        self._stats = {"delivered": 0, "acked": 0, "acks_sent": 0, "reconnects": 0}
+        self._thread = threading.Thread(target=self._run, name="rmq-consumer", daemon=True)
+        self._thread.start()
+
+    def queue(self):
+        return self._queue_name
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update(unacked=len(self._delivered), buffered=self._buffer.qsize())
+        return stats
+
+    def _connect(self):
+        connection = UriConnection(self._uri)
+        channel = connection.channel()
+        channel.basic.qos(prefetch_count=self._prefetch_count)
+        with self._lock:
+            # Unacked messages of a closed channel are redelivered by the broker, the old copies are dropped
+            self._delivered.clear()
+            self._completed.clear()
+            while not self._buffer.empty():
+                self._buffer.get_nowait()
+            self._connection = connection
+            self._channel = channel
+        channel.basic.consume(self._on_message, self._queue_name, no_ack=False)
+
+    def _close(self):
+        for closable in (self._channel, self._connection):
+            if closable is None:
+                continue
+            try:
+                closable.close()
+            except AMQPError as e:
+                logger.warning(f"Can't close RabbitMQ consumer: {e}")
+        self._channel = None
+        self._connection = None
+
+    def _on_message(self, message):
+        with self._lock:
+            self._delivered.append(message.delivery_tag)
+            self._stats["delivered"] += 1
+        self._buffer.put(message)
+
+    def _flush_acks(self, force=False):
+        with self._lock:
+            if not self._completed or self._channel is None:
+                return
+            if not force and len(self._completed) < self._ack_batch_size \
+                    and time.monotonic() - self._last_ack < self._ack_interval:
+                return
+            self._last_ack = time.monotonic()
+            # The finished prefix goes in one multiple ack
+            acked = len(self._completed)
+            last_tag = None
+            while self._delivered and self._delivered[0] in self._completed:
+                last_tag = self._delivered.popleft()
+                self._completed.discard(last_tag)
+            # Finished messages behind a slow one are acked one by one, so they don't hold the prefetch window
+            single_tags = sorted(self._completed)
+            for tag in single_tags:
+                self._delivered.remove(tag)
+            self._completed.clear()
+            if last_tag is not None:
+                self._stats["acks_sent"] += 1
+            self._stats["acks_sent"] += len(single_tags)
+            channel = self._channel
+        if last_tag is not None:
+            channel.basic.ack(delivery_tag=last_tag, multiple=True)
+        for tag in single_tags:
+            channel.basic.ack(delivery_tag=tag)
+        with self._lock:
+            self._stats["acked"] += acked
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                if self._channel is None:
+                    self._connect()
+                self._channel.process_data_events(to_tuple=False)
+                self._flush_acks()
+            except AMQPError as e:
+                logger.error(f"RabbitMQ consumer failed, reconnect in {self._reconnect_delay}s: {e}")
+                self._close()
+                with self._lock:
+                    self._stats["reconnects"] += 1
+                self._stopping.wait(self._reconnect_delay)
+                continue
+            self._stopping.wait(self._poll_interval)
+        try:
+            self._flush_acks(force=True)
+        except AMQPError as e:
+            logger.error(f"Can't send the last acks: {e}")
+        self._close()
+
+    def receive(self, messages_number: int = 1, break_on_empty=True):
+        # Blocks for the first message only, an empty queue doesn't make the caller spin
+        try:
+            messages = [self._buffer.get(timeout=self._receive_timeout)]
+        except queue.Empty:
+            return []
+        while len(messages) < messages_number:
+            try:
+                messages.append(self._buffer.get_nowait())
+            except queue.Empty:
+                break
+        return messages
+
+    def ack_message(self, message):
+        with self._lock:
+            if message.channel is not self._channel:
+                # Delivered on a channel which is closed already, the broker redelivers it
+                return
+            self._completed.add(message.delivery_tag)
+
+    def close(self):
+        self._stopping.set()
+        self._thread.join()
@@ -0,0 +1,132 @@
+import json
+import logging
+
+from amqpstorm import UriConnection, AMQPError
+
+from queues.output_queue import OutputQueue
+
+logger = logging.getLogger(__name__)
+
+
+class BatchRMQPublisher(OutputQueue):
+    # Messages are published inside a channel transaction, the broker confirms a whole batch on commit
+    # instead of one round trip per message. A broken connection is dropped with its uncommitted messages
+    # and the error is raised, the caller publishes them again and the next publish reconnects
+
+    def __init__(self, uri, exchange, routing_key, batch_size=1000, persistent=True):
+        self._exchange = exchange
+        self._routing_key = routing_key
+        self._batch_size = batch_size
+        self._properties = {"content_type": "application/json"}
+        if persistent:
+            self._properties["delivery_mode"] = 2
+        self._uri = uri
+        self._connection = None
+        self._channel = None
+        self._pending = 0
+        self.published = 0
+        self.reconnects = 0
+        self._open()
+
+    def _declare(self, channel):
+        pass
+
+    def _open(self):
+        if self._channel is None:
+            connection = UriConnection(self._uri)
+            channel = connection.channel()
+            channel.tx.select()
+            self._connection = connection
+            self._declare(channel)
+            self._channel = channel
+        return self._channel
+
+    def _reset(self):
+        for closable in (self._channel, self._connection):
+            if closable is None:
+                continue
+            try:
+                closable.close()
+            except AMQPError as e:
+                logger.warning(f"Can't close RabbitMQ publisher: {e}")
+        if self._connection is not None:
+            self.reconnects += 1
+        self._channel = None
+        self._connection = None
+        # The broker drops uncommitted messages of a closed channel
+        self._pending = 0
+
+    def publish(self, message_json: dict, exchange, routing_key):
+        try:
+            self._open().basic.publish(body=json.dumps(message_json),
+                                       routing_key=routing_key,
+                                       exchange=exchange,
+                                       properties=self._properties)
+        except AMQPError:
+            self._reset()
+            raise
+        self._pending += 1
+        if self._pending >= self._batch_size:
+            self.flush()
+
+    def put(self, message_json: dict):
+        self.publish(message_json, self._exchange, self._routing_key)
+
+    def flush(self):
+        if not self._pending:
+            return
+        try:
+            self._channel.tx.commit()
+        except AMQPError:
+            self._reset()
+            raise
+        self.published += self._pending
+        self._pending = 0
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self._reset()
+
+
+class RMQErrorPublisher(BatchRMQPublisher):
+    # Retryable failures wait in a TTL queue per attempt and are dead-lettered back to the domains exchange,
+    # the rest and the ones out of attempts go to the errors queue
+
+    def __init__(self, uri, exchange, routing_key, retry_exchange, retry_routing_key, retry_queue_prefix,
+                 max_attempts=5, retry_delay=60.0, max_retry_delay=3600.0, batch_size=100):
+        self._retry_queue_prefix = retry_queue_prefix
+        self._retry_exchange = retry_exchange
+        self._retry_routing_key = retry_routing_key
+        self._retry_delay = retry_delay
+        self._max_retry_delay = max_retry_delay
+        self.max_attempts = max_attempts
+        self._stats = {"errors": 0, "retries": 0}
+        super().__init__(uri, exchange, routing_key, batch_size=batch_size)
+
+    def _declare(self, channel):
+        # Declared on every connect, a restarted broker may have lost non-durable state
+        for attempt in range(1, self.max_attempts):
+            delay = min(self._retry_delay * 2 ** (attempt - 1), self._max_retry_delay)
+            channel.queue.declare(self.retry_queue(attempt), durable=True, arguments={
+                "x-message-ttl": int(delay * 1000),
+                "x-dead-letter-exchange": self._retry_exchange,
+                "x-dead-letter-routing-key": self._retry_routing_key,
+            })
+
+    def stats(self):
+        return dict(self._stats, published=self.published, reconnects=self.reconnects)
+
+    def retry_queue(self, attempt):
+        return f"{self._retry_queue_prefix}.{attempt}"
+
+    def put(self, message_json: dict):
+        attempt = message_json.get("attempt", 1)
+        if message_json.get("error", {}).get("retryable") and attempt < self.max_attempts:
+            # The default exchange routes by queue name
+            self.publish(message_json, "", self.retry_queue(attempt))
+            self._stats["retries"] += 1
+        else:
+            self.publish(message_json, self._exchange, self._routing_key)
+            self._stats["errors"] += 1
@@ -0,0 +1,313 @@
+import fcntl
+import json
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+from collections import deque
+from typing import List, Optional, Tuple
+
+from queues.output_queue import OutputQueue
+from repository.checkpoint import FileCheckpoint
+
+logger = logging.getLogger(__name__)
+
+# Record frame: payload length, crc32 of the payload
+RECORD_HEADER = struct.Struct(">II")
+SEGMENT_SUFFIX = ".log"
+
+
+def segment_numbers(directory) -> List[int]:
+    numbers = []
+    for name in os.listdir(directory):
+        if name.endswith(SEGMENT_SUFFIX) and name[:-len(SEGMENT_SUFFIX)].isdigit():
+            numbers.append(int(name[:-len(SEGMENT_SUFFIX)]))
+    return sorted(numbers)
+
+
+def segment_path(directory, seq):
+    return os.path.join(directory, f"{seq:020d}{SEGMENT_SUFFIX}")
+
+
+def lock_directory(directory):
+    # One process per directory, a second one would interleave writes and ship segments twice
+    lock_file = open(os.path.join(directory, "LOCK"), "w")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        raise RuntimeError(f"Spool {directory} is used by another process")
+    return lock_file
+
+
+def load_position(checkpoint: FileCheckpoint) -> Tuple[int, int]:
+    position = checkpoint.load()
+    if position is None:
+        return -1, 0
+    seq, offset = position.split()
+    return int(seq), int(offset)
+
+
+class SpoolQueue(OutputQueue):
+    # Write-ahead spool in front of an output queue. put appends the message to a local segment file and returns,
+    # a drainer thread ships sealed segments to the wrapped queue in batches and deletes them once written.
+    # Segments left by a stopped or crashed process are shipped after a restart, from the drained position on.
+    # Writes reach the OS on every put, so they survive a crash of the process; fsync runs every fsync_interval.
+    # Spools of workers which no longer run are passed as orphans, their messages are moved into this one first
+
+    def __init__(self, queue: OutputQueue, directory, segment_bytes=64 * 1024 * 1024, max_bytes=10 * 1024 ** 3,
+                 batch_size=500, max_latency=5.0, fsync_interval=1.0, retry_delay=1.0, max_retry_delay=60.0,
+                 close_timeout=30.0, orphans: List[str] = ()):
+        os.makedirs(directory, exist_ok=True)
+        self._queue = queue
+        self._directory = directory
+        self._segment_bytes = segment_bytes
+        self._max_bytes = max_bytes
+        self._batch_size = batch_size
+        self._max_latency = max_latency
+        self._fsync_interval = fsync_interval
+        self._retry_delay = retry_delay
+        self._max_retry_delay = max_retry_delay
+        self._close_timeout = close_timeout
+        self._orphans = list(orphans)
+        self._lock_file = lock_directory(directory)
+        self._checkpoint = FileCheckpoint(os.path.join(directory, "drained"))
+        self._condition = threading.Condition()
+        self._sealed = deque(segment_numbers(directory))
+        self._bytes = sum(os.path.getsize(self._path(seq)) for seq in self._sealed)
+        # Numbers keep growing over restarts, a new segment never takes the number of a drained one
+        self._seq = max(self._sealed[-1] + 1 if self._sealed else 0, self._load_checkpoint()[0])
+        self._file = None
+        self._opened_at = None
+        self._synced_at = time.monotonic()
+        self._closing = False
+        self._stopped = threading.Event()
+        self._stats = {"spooled": 0, "drained": 0, "requeued": 0, "corrupted": 0, "retries": 0, "adopted": 0}
+        if self._sealed:
+            logger.info(f"Spool {directory} replays {len(self._sealed)} segments, {self._bytes} bytes")
+        self._drainer = threading.Thread(target=self._run, name="spool-drainer", daemon=True)
+        self._drainer.start()
+
+    def _path(self, seq):
+        return segment_path(self._directory, seq)
+
+    @property
+    def wrapped(self) -> OutputQueue:
+        return self._queue
+
+    def stats(self):
+        with self._condition:
+            stats = dict(self._stats)
+            stats.update(segments=len(self._sealed) + (self._file is not None), bytes=self._bytes)
+        return stats
+
+    @staticmethod
+    def encode(message) -> bytes:
+        payload = json.dumps(message, default=str).encode("utf-8")
+        return RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+    def _seal(self):
+        # Called with the condition held
+        if self._file is None:
+            return
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        self._file = None
+        self._sealed.append(self._seq)
+        self._seq += 1
+        self._condition.notify_all()
+
+    def _append(self, records: List[bytes], block=True):
+        size = sum(len(record) for record in records)
+        with self._condition:
+            while block and self._bytes + size > self._max_bytes and self._bytes and not self._closing:
+                # Back-pressure: the drainer doesn't keep up, the crawler waits instead of filling the disk
+                self._condition.wait(1.0)
+            if self._file is None:
+                self._file = open(self._path(self._seq), "ab")
+                self._opened_at = time.monotonic()
+            self._file.write(b"".join(records))
+            self._file.flush()
+            self._bytes += size
+            if self._file.tell() >= self._segment_bytes:
+                self._seal()
+
+    def put(self, message):
+        try:
+            record = self.encode(message)
+        except (TypeError, ValueError) as e:
+            logger.error(f"Can't spool message: {e}", exc_info=True)
+            return
+        self._append([record])
+        with self._condition:
+            self._stats["spooled"] += 1
+
+    def flush(self):
+        with self._condition:
+            self._seal()
+
+    def _maintain(self):
+        with self._condition:
+            if self._file is None:
+                return
+            now = time.monotonic()
+            if now - self._opened_at >= self._max_latency:
+                # An idle segment is shipped after max_latency, not when it's full
+                self._seal()
+            elif now - self._synced_at >= self._fsync_interval:
+                os.fsync(self._file.fileno())
+                self._synced_at = now
+
+    def _load_checkpoint(self) -> Tuple[int, int]:
+        return load_position(self._checkpoint)
+
+    def _read_batch(self, file, seq) -> Tuple[list, bool]:
+        messages = []
+        while len(messages) < self._batch_size:
+            header = file.read(RECORD_HEADER.size)
+            if not header:
+                return messages, True
+            if len(header) == RECORD_HEADER.size:
+                length, crc = RECORD_HEADER.unpack(header)
+                payload = file.read(length)
+                if len(payload) == length and zlib.crc32(payload) == crc:
+                    messages.append(json.loads(payload.decode("utf-8")))
+                    continue
+            # A torn write of a crash, nothing after it can be framed
+            logger.error(f"Spool segment {seq} is corrupted at {file.tell()}, the rest of it is dropped")
+            with self._condition:
+                self._stats["corrupted"] += 1
+            return messages, True
+        return messages, False
+
+    def _write(self, messages) -> list:
+        # Returns the messages to write again later
+        if hasattr(self._queue, "write_batch"):
+            return self._queue.write_batch(messages)
+        for message in messages:
+            self._queue.put(message)
+        self._queue.flush()
+        return []
+
+    def _ship(self, messages) -> bool:
+        retry_delay = self._retry_delay
+        while True:
+            try:
+                failed = self._write(messages)
+            except Exception as e:
+                logger.error(f"Can't write {len(messages)} spooled messages: {e}", exc_info=True)
+                failed = messages
+            if len(failed) < len(messages):
+                if failed:
+                    # Written around the failed ones, they go to the end of the spool and don't block the rest
+                    self._append([self.encode(message) for message in failed], block=False)
+                    with self._condition:
+                        self._stats["requeued"] += len(failed)
+                with self._condition:
+                    self._stats["drained"] += len(messages) - len(failed)
+                return True
+            if self._stopped.is_set():
+                return False
+            with self._condition:
+                self._stats["retries"] += 1
+            logger.warning(f"Output is unavailable, retry {len(messages)} spooled messages in {retry_delay:.1f}s")
+            if self._stopped.wait(retry_delay):
+                return False
+            retry_delay = min(retry_delay * 2, self._max_retry_delay)
+
+    def _drain_segment(self, seq) -> bool:
+        path = self._path(seq)
+        checkpoint_seq, offset = self._load_checkpoint()
+        with open(path, "rb") as file:
+            if checkpoint_seq == seq:
+                file.seek(offset)
+            while True:
+                messages, finished = self._read_batch(file, seq)
+                if messages and not self._ship(messages):
+                    return False
+                if finished:
+                    break
+                self._checkpoint.save(f"{seq} {file.tell()}")
+        size = os.path.getsize(path)
+        os.remove(path)
+        self._checkpoint.save(f"{seq + 1} 0")
+        with self._condition:
+            self._sealed.popleft()
+            self._bytes -= size
+            self._condition.notify_all()
+        return True
+
+    def _next_segment(self) -> Optional[int]:
+        with self._condition:
+            if not self._sealed:
+                if self._closing:
+                    return None
+                self._condition.wait(min(self._max_latency, self._fsync_interval) / 2)
+            return self._sealed[0] if self._sealed else -1
+
+    def _adopt(self, directory):
+        try:
+            lock_file = lock_directory(directory)
+        except RuntimeError as e:
+            logger.warning(f"{e}, it is not adopted")
+            return
+        try:
+            checkpoint = FileCheckpoint(os.path.join(directory, "drained"))
+            checkpoint_seq, offset = load_position(checkpoint)
+            adopted = 0
+            for seq in segment_numbers(directory):
+                path = segment_path(directory, seq)
+                with open(path, "rb") as file:
+                    if checkpoint_seq == seq:
+                        file.seek(offset)
+                    while True:
+                        if self._stopped.is_set():
+                            return
+                        messages, finished = self._read_batch(file, seq)
+                        if messages:
+                            # A crash before the checkpoint is saved copies the batch again, writes are idempotent
+                            self._append([self.encode(message) for message in messages], block=False)
+                            adopted += len(messages)
+                            with self._condition:
+                                self._stats["adopted"] += len(messages)
+                        if finished:
+                            break
+                        checkpoint.save(f"{seq} {file.tell()}")
+                os.remove(path)
+                checkpoint.save(f"{seq + 1} 0")
+            logger.info(f"Adopted {adopted} messages of spool {directory}")
+        finally:
+            lock_file.close()
+
+    def _run(self):
+        for directory in self._orphans:
+            try:
+                self._adopt(directory)
+            except Exception as e:
+                logger.error(f"Can't adopt spool {directory}: {e}", exc_info=True)
+        while not self._stopped.is_set():
+            self._maintain()
+            seq = self._next_segment()
+            if seq is None:
+                return
+            if seq >= 0 and not self._drain_segment(seq):
+                return
+
+    def close(self):
+        with self._condition:
+            self._closing = True
+            self._seal()
+            self._condition.notify_all()
+        self._drainer.join(self._close_timeout)
+        if self._drainer.is_alive():
+            logger.warning(f"Spool isn't drained in {self._close_timeout}s, the rest is written after a restart")
+            self._stopped.set()
+            self._drainer.join()
+        with self._condition:
+            # Messages requeued while closing
+            self._seal()
+        self._queue.close()
+        self._lock_file.close()
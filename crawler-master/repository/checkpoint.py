@@ -0,0 +1,29 @@
+import logging
+import os
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+class FileCheckpoint:
+    # Keeps the last domain a loader has sent, so a restarted loader continues after it
+
+    def __init__(self, path):
+        self._path = path
+
+    def load(self) -> Optional[str]:
+        try:
+            with open(self._path, encoding="utf-8") as file:
+                domain = file.read().strip()
+        except FileNotFoundError:
+            return None
+        return domain or None
+
+    def save(self, domain: str):
+        # Written aside and renamed, a crash never leaves a half written checkpoint
+        tmp_path = f"{self._path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            file.write(domain)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self._path)
@@ -1,6 +1,9 @@
+import csv
 import logging
-from typing import NamedTuple, Iterable
+import zlib
+from typing import NamedTuple, Iterable, List
 
+from psycopg2 import sql
 from psycopg2.extras import DictCursor
 
 from repository.repository import RepositoryContract
@@ -15,25 +18,143 @@ class DomainEntity(NamedTuple):
 
 
 class DBDomainRepository(RepositoryContract):
-    def __init__(self, db):
+    # Reads one slice of the domains table page by page, ordered by domain, so a loader can resume after
+    # the last domain it sent and several loaders can read disjoint shards in parallel
+
+    def __init__(self, db, page_size=10000, shard=0, shards=1, start=None, end=None,
+                 crawled_before=None, crawled_column="last_crawled_at"):
+        if not 0 <= shard < shards:
+            raise RuntimeError(f"Shard {shard} is out of range for {shards} shards")
         self.__db = db
+        self._page_size = page_size
+        self._shard = shard
+        self._shards = shards
+        self._start = start
+        self._end = end
+        self._crawled_before = crawled_before
+        self._crawled_column = crawled_column
+
+    def _page_query(self, after, page_size):
+        conditions = []
+        params = []
+        if after is not None:
+            conditions.append(sql.SQL("domain > %s"))
+            params.append(after)
+        if self._start is not None:
+            conditions.append(sql.SQL("domain >= %s"))
+            params.append(self._start)
+        if self._end is not None:
+            conditions.append(sql.SQL("domain < %s"))
+            params.append(self._end)
+        if self._shards > 1:
+            # hashtext is a signed int4, the shift keeps the modulo positive
+            conditions.append(sql.SQL("mod(hashtext(domain)::bigint + 2147483648, %s) = %s"))
+            params.extend((self._shards, self._shard))
+        if self._crawled_before is not None:
+            conditions.append(sql.SQL("({column} IS NULL OR {column} < %s)").format(
+                column=sql.Identifier(self._crawled_column)))
+            params.append(self._crawled_before)
+        query = sql.SQL("SELECT domain FROM domains")
+        if conditions:
+            query += sql.SQL(" WHERE ") + sql.SQL(" AND ").join(conditions)
+        query += sql.SQL(" ORDER BY domain LIMIT %s")
+        params.append(page_size)
+        return query, params
+
+    def domains(self, limit=None, after=None) -> Iterable[str]:
+        count = 0
+        while limit is None or count < limit:
+            page_size = self._page_size if limit is None else min(self._page_size, limit - count)
+            query, params = self._page_query(after, page_size)
+            with self.__db.cursor(cursor_factory=DictCursor) as cursor:
+                try:
+                    cursor.execute(query, params)
+                    rows = cursor.fetchall()
+                except Exception:
+                    logger.error(f"Fail to get domains after {after}", exc_info=True)
+                    self.__db.rollback()
+                    return
+            # Each page is its own short transaction, no snapshot is held open for the whole table
+            self.__db.rollback()
+            for row in rows:
+                yield row["domain"]
+            count += len(rows)
+            if len(rows) < page_size:
+                return
+            after = rows[-1]["domain"]
 
     def all(self, crawling_type, limit=10) -> Iterable[DomainEntity]:
-        with self.__db.cursor(cursor_factory=DictCursor) as cursor:
-            try:
-                cursor.execute('SELECT domain FROM domains LIMIT {}'.format(limit))
-            except Exception:
-                logger.error("Fail to get all domains")
-                return []
-            for row in cursor:
-                yield DomainEntity(domain=row["domain"], crawling_type=crawling_type)
+        for domain in self.domains(limit):
+            yield DomainEntity(domain=domain, crawling_type=crawling_type)
+
+
+class CSVDomainRepository(RepositoryContract):
+    def __init__(self, paths: List[str], column="domain", shard=0, shards=1):
+        if not 0 <= shard < shards:
+            raise RuntimeError(f"Shard {shard} is out of range for {shards} shards")
+        self._paths = paths
+        self._column = column
+        self._shard = shard
+        self._shards = shards
+
+    def _read(self, path) -> Iterable[str]:
+        with open(path, newline="", encoding="utf-8") as file:
+            reader = csv.reader(file)
+            header = next(reader, None)
+            if header is None:
+                return
+            if self._column in header:
+                index = header.index(self._column)
+            else:
+                # No header row, the first column holds the domains
+                index = 0
+                if header and header[0].strip():
+                    yield header[0].strip()
+            for row in reader:
+                if len(row) > index and row[index].strip():
+                    yield row[index].strip()
+
+    def in_shard(self, domain):
+        return self._shards == 1 or zlib.crc32(domain.encode("utf-8")) % self._shards == self._shard
+
+    def domains(self, limit=None, after=None) -> Iterable[str]:
+        # Files are not sorted, resuming skips everything up to the domain sent last
+        skipping = after is not None
+        count = 0
+        for path in self._paths:
+            for domain in self._read(path):
+                if skipping:
+                    skipping = domain != after
+                    continue
+                if not self.in_shard(domain):
+                    continue
+                if limit is not None and count >= limit:
+                    return
+                count += 1
+                yield domain
+        if skipping:
+            # The files changed since the checkpoint, nothing would be loaded at all
+            logger.warning(f"Checkpointed domain {after} is not in {', '.join(self._paths)}, loading from the start")
+            yield from self.domains(limit)
+
+    def all(self, crawling_type, limit=None) -> Iterable[DomainEntity]:
+        for domain in self.domains(limit):
+            yield DomainEntity(domain=domain, crawling_type=crawling_type)
 
 
 class FakeDomainRepository(RepositoryContract):
+    DOMAINS = ["stores.jtb.co.jp",
+               "kuronekoyamato.co.jp",
+               "yoshinoya.com",
+               "e-welcia.com",
+               ]
+
+    def domains(self, limit=None, after=None) -> Iterable[str]:
+        domains = self.DOMAINS
+        if after in domains:
+            domains = domains[domains.index(after) + 1:]
+        yield from domains[:limit]
+
     def all(self, crawling_type, limit=None) -> Iterable[DomainEntity]:
-        for domain, _type in [("stores.jtb.co.jp", crawling_type),
-                              ("kuronekoyamato.co.jp", crawling_type),
-                              ("yoshinoya.com", crawling_type),
-                              ("e-welcia.com", crawling_type),
-                              ]:
-            yield DomainEntity(domain=domain, crawling_type=_type)
+        for domain in self.domains():
+            yield DomainEntity(domain=domain, crawling_type=crawling_type)
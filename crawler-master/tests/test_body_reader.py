@@ -0,0 +1,38 @@
+import unittest
+
+from engine.body_reader import is_allowed_content_type, read_limited
+
+
+class ReadLimitedTest(unittest.TestCase):
+
+    def test_body_under_the_limit(self):
+        self.assertEqual(read_limited([b"ab", b"cd"], 10), (b"abcd", False))
+
+    def test_body_at_the_limit_is_not_truncated(self):
+        self.assertEqual(read_limited([b"ab", b"cd"], 4), (b"abcd", False))
+
+    def test_body_over_the_limit_is_cut(self):
+        self.assertEqual(read_limited([b"ab", b"cd", b"ef"], 3), (b"abc", True))
+
+    def test_chunks_after_the_limit_are_not_read(self):
+        read = []
+
+        def chunks():
+            for chunk in (b"abc", b"def", b"ghi"):
+                read.append(chunk)
+                yield chunk
+
+        self.assertEqual(read_limited(chunks(), 4), (b"abcd", True))
+        self.assertEqual(read, [b"abc", b"def"])
+
+
+class ContentTypeTest(unittest.TestCase):
+
+    def test_allowed_content_types(self):
+        self.assertTrue(is_allowed_content_type("text/html; charset=utf-8"))
+        self.assertTrue(is_allowed_content_type("Application/XHTML+XML"))
+        self.assertTrue(is_allowed_content_type(None))
+
+    def test_binary_content_types(self):
+        self.assertFalse(is_allowed_content_type("image/png"))
+        self.assertFalse(is_allowed_content_type("application/pdf", allowed=("text/",)))
@@ -0,0 +1,73 @@
+import json
+import threading
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from amqpstorm import AMQPConnectionError
+
+from queues.output_queue import BufferedQueue
+from queues.rmq_publisher import BatchRMQPublisher
+
+
+class FakeBroker:
+    # Keeps what each channel transaction committed, uncommitted messages of a failed commit are dropped
+
+    def __init__(self, fail_commits=()):
+        self.committed = []
+        self.commits = 0
+        self._fail_commits = set(fail_commits)
+        self._lock = threading.Lock()
+
+    def connection(self, uri):
+        uncommitted = []
+
+        def publish(body, routing_key, exchange, properties):
+            uncommitted.append(json.loads(body)["id"])
+
+        def commit():
+            with self._lock:
+                self.commits += 1
+                if self.commits in self._fail_commits:
+                    uncommitted.clear()
+                    raise AMQPConnectionError("connection lost")
+                self.committed.extend(uncommitted)
+                uncommitted.clear()
+
+        channel = SimpleNamespace(basic=SimpleNamespace(publish=publish),
+                                  tx=SimpleNamespace(select=lambda: None, commit=commit),
+                                  close=lambda: None)
+        return SimpleNamespace(channel=lambda: channel, close=lambda: None)
+
+
+class BufferedQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.broker = FakeBroker(fail_commits={2})
+        patcher = mock.patch("queues.rmq_publisher.UriConnection", self.broker.connection)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_failed_commit_does_not_republish_committed_messages(self):
+        publisher = BatchRMQPublisher("amqp://", "errors", "errors", batch_size=3)
+        queue = BufferedQueue(publisher, batch_size=3, max_latency=0.05, retry_delay=0.01)
+        written = []
+        # Buffered at once, more than a batch is waiting when the flusher takes
+        with queue._condition:
+            for i in range(9):
+                queue.put({"id": i}, on_written=lambda i=i: written.append(i))
+        queue.close()
+
+        self.assertEqual(sorted(self.broker.committed), list(range(9)))
+        self.assertEqual(sorted(written), list(range(9)))
+        self.assertEqual(self.broker.commits, 4)
+
+    def test_close_writes_everything_buffered(self):
+        publisher = BatchRMQPublisher("amqp://", "errors", "errors", batch_size=2)
+        queue = BufferedQueue(publisher, batch_size=2, max_latency=10.0, retry_delay=0.01)
+        with queue._condition:
+            for i in range(5):
+                queue.put({"id": i})
+        queue.close()
+
+        self.assertEqual(sorted(self.broker.committed), list(range(5)))
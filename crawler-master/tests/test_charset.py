@@ -0,0 +1,45 @@
+import codecs
+import unittest
+
+from engine.charset import detect_encoding, header_encoding, meta_encoding, normalize_encoding, sniff_encoding
+
+
+class CharsetTest(unittest.TestCase):
+
+    def test_labels_are_normalized_to_supersets(self):
+        self.assertEqual(normalize_encoding("ISO-8859-1"), "cp1252")
+        self.assertEqual(normalize_encoding(b"Shift_JIS"), "cp932")
+        self.assertIsNone(normalize_encoding("no-such-charset"))
+
+    def test_header_charset(self):
+        self.assertEqual(header_encoding('text/html; charset="UTF-8"'), "utf-8")
+        self.assertIsNone(header_encoding("text/html"))
+
+    def test_meta_utf16_is_read_as_utf8(self):
+        self.assertEqual(meta_encoding(b'<meta charset="utf-16">'), "utf-8")
+        self.assertEqual(meta_encoding(b'<?xml version="1.0" encoding="windows-1251"?>'), "cp1251")
+
+    def test_bom_wins_over_declarations(self):
+        content = codecs.BOM_UTF8 + '<meta charset="koi8-r">привет'.encode("utf-8")
+        self.assertEqual(detect_encoding(content, "text/html; charset=cp1251"), "utf-8-sig")
+
+    def test_header_wins_over_meta(self):
+        self.assertEqual(detect_encoding(b'<meta charset="koi8-r">x', "text/html; charset=cp1251"), "cp1251")
+
+    def test_empty_body_uses_header_or_default(self):
+        self.assertEqual(detect_encoding(b"", "text/html; charset=latin1"), "cp1252")
+        self.assertEqual(detect_encoding(b""), "utf-8")
+
+    def test_non_ascii_after_sniff_window_is_sniffed(self):
+        content = b"<html>" + b"a" * 100 + "é".encode("utf-8") * 50
+        self.assertEqual(sniff_encoding(content, sniff_size=16), "utf-8")
+        self.assertEqual(detect_encoding(b"ascii only " * 100, sniff_size=16), "utf-8")
+
+    def test_utf8_cut_in_a_character_is_utf8(self):
+        content = "страница".encode("utf-8")[:-1]
+        self.assertEqual(sniff_encoding(content), "utf-8")
+
+    def test_undeclared_legacy_encoding_is_detected(self):
+        content = ("日本語のテキストです。これはテストの文章になります。" * 20).encode("shift_jis")
+        # Detected as Shift_JIS, decoded with its superset
+        self.assertEqual(detect_encoding(content), "cp932")
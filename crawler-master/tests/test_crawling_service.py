@@ -0,0 +1,28 @@
+import unittest
+
+from crawler.crawling_service import CrawlingService
+from exceptions import WrongCrawlingType, classify_error, PARSE
+from tools.structures import CrawlingType, DNS_RECORD_TYPES
+
+
+class MapRecordTypesTest(unittest.TestCase):
+
+    def test_missing_record_types_resolve_all(self):
+        self.assertEqual(CrawlingService.map_record_types({"domain": "example.com"}), DNS_RECORD_TYPES)
+
+    def test_record_types_are_mapped(self):
+        record_types = CrawlingService.map_record_types({"record_types": ["mx", "txt"]})
+        self.assertEqual(record_types, [CrawlingType.MX, CrawlingType.TXT])
+
+    def test_string_is_rejected(self):
+        with self.assertRaises(WrongCrawlingType):
+            CrawlingService.map_record_types({"record_types": "mx,txt"})
+
+    def test_unknown_type_is_a_parse_error(self):
+        with self.assertRaises(WrongCrawlingType) as raised:
+            CrawlingService.map_record_types({"record_types": ["mx", "aaaa"]})
+        self.assertEqual(classify_error(raised.exception), (PARSE, False))
+
+    def test_non_dns_type_is_rejected(self):
+        with self.assertRaises(WrongCrawlingType):
+            CrawlingService.map_record_types({"record_types": ["render"]})
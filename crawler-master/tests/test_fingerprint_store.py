@@ -0,0 +1,46 @@
+import os
+import tempfile
+import unittest
+
+from queues.fingerprint_store import FingerprintStore, hamming_distance, simhash
+
+DOC_ID = "0123456789abcdef0123456789abcdef"
+PAGE = " ".join(f"word{i}" for i in range(300))
+
+
+class FingerprintStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.store = FingerprintStore(os.path.join(directory.name, "fingerprints.db"), max_distance=3)
+
+    def remember(self, text, near_duplicates=False):
+        fingerprint = self.store.changed_fingerprint(DOC_ID, "source", text, near_duplicates)
+        self.assertIsNotNone(fingerprint)
+        self.store.save([(DOC_ID, "source", fingerprint)])
+        return fingerprint
+
+    def test_new_document_is_changed(self):
+        fingerprint = self.store.changed_fingerprint(DOC_ID, "source", PAGE)
+        self.assertIsNotNone(fingerprint)
+        self.assertIsNone(fingerprint.simhash)
+
+    def test_same_content_is_unchanged(self):
+        self.remember(PAGE)
+        self.assertIsNone(self.store.changed_fingerprint(DOC_ID, "source", PAGE))
+        self.assertIsNotNone(self.store.changed_fingerprint(DOC_ID, "render", PAGE))
+
+    def test_changed_content(self):
+        self.remember(PAGE)
+        self.assertIsNotNone(self.store.changed_fingerprint(DOC_ID, "source", PAGE + " more"))
+
+    def test_near_duplicate_is_unchanged(self):
+        self.remember(PAGE, near_duplicates=True)
+        self.assertIsNone(self.store.changed_fingerprint(DOC_ID, "source", PAGE + " word0", near_duplicates=True))
+        other = " ".join(f"other{i}" for i in range(300))
+        self.assertIsNotNone(self.store.changed_fingerprint(DOC_ID, "source", other, near_duplicates=True))
+
+    def test_simhash_distance(self):
+        self.assertEqual(hamming_distance(simhash(PAGE), simhash(PAGE)), 0)
+        self.assertEqual(hamming_distance(0, -1), 64)
@@ -0,0 +1,89 @@
+import multiprocessing
+import os
+import tempfile
+import threading
+import unittest
+
+from crawler.frontier import BloomFilter, CrawlFrontier
+
+
+def add_keys(path, prefix, count):
+    bloom = BloomFilter(path, capacity=100000)
+    for i in range(count):
+        bloom.add(f"{prefix}-{i}".encode("utf-8"))
+    bloom.close()
+
+
+def hold_claim(directory, claimed, release):
+    frontier = CrawlFrontier(directory)
+    frontier.claim("example.com", "source")
+    claimed.set()
+    release.wait(10)
+    frontier.close()
+
+
+class BloomFilterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "seen.bloom")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_concurrent_adds_keep_every_key(self):
+        BloomFilter(self.path, capacity=100000).close()
+        context = multiprocessing.get_context("fork")
+        processes = [context.Process(target=add_keys, args=(self.path, f"process{i}", 3000)) for i in range(3)]
+        threads = [threading.Thread(target=add_keys, args=(self.path, f"thread{i}", 3000)) for i in range(3)]
+        for worker in processes + threads:
+            worker.start()
+        for worker in processes + threads:
+            worker.join()
+        bloom = BloomFilter(self.path)
+        prefixes = [f"process{i}" for i in range(3)] + [f"thread{i}" for i in range(3)]
+        missing = [(prefix, i) for prefix in prefixes for i in range(3000)
+                   if f"{prefix}-{i}".encode("utf-8") not in bloom]
+        bloom.close()
+        self.assertEqual(missing, [])
+
+
+class CrawlFrontierTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.frontier = CrawlFrontier(self.directory.name, default_interval=3600, capacity=100000)
+
+    def tearDown(self):
+        self.frontier.close()
+        self.directory.cleanup()
+
+    def test_key_is_claimed_once_until_completed(self):
+        self.assertTrue(self.frontier.claim("example.com", "source"))
+        self.assertFalse(self.frontier.claim("www.example.com/", "source"))
+        self.assertTrue(self.frontier.claim("example.com", "render"))
+        self.frontier.complete("example.com", "source", crawled=False)
+        self.assertTrue(self.frontier.claim("example.com", "source"))
+
+    def test_crawled_key_is_skipped_until_recrawl_interval(self):
+        self.assertTrue(self.frontier.claim("example.com", "source"))
+        self.frontier.complete("example.com", "source", crawled=True)
+        self.assertFalse(self.frontier.claim("example.com", "source"))
+
+    def test_claim_of_another_process_is_held_while_it_runs(self):
+        context = multiprocessing.get_context("fork")
+        claimed, release = context.Event(), context.Event()
+        process = context.Process(target=hold_claim, args=(self.directory.name, claimed, release))
+        process.start()
+        try:
+            self.assertTrue(claimed.wait(10))
+            self.assertFalse(self.frontier.claim("example.com", "source"))
+        finally:
+            release.set()
+            process.join()
+        # The process ended without completing its claim, its message is delivered again
+        self.assertTrue(self.frontier.claim("example.com", "source"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,66 @@
+import unittest
+
+from engine.render_classifier import EMPTY_BODY, LOW_TEXT_RATIO, NOSCRIPT, SPA_SHELL, RenderClassifier, \
+    RenderDecisionCache, split_hidden, visible_text
+from tools.structures import CrawlingType
+
+ARTICLE = "<p>" + "Plain server rendered text of the page. " * 40 + "</p>"
+
+
+class RenderClassifierTest(unittest.TestCase):
+
+    def setUp(self):
+        self.classifier = RenderClassifier()
+
+    def test_page_without_scripts_is_not_rendered(self):
+        self.assertIsNone(self.classifier.render_reason("<html><body>Hi</body></html>"))
+
+    def test_empty_body(self):
+        self.assertEqual(self.classifier.render_reason(""), EMPTY_BODY)
+        self.assertEqual(self.classifier.render_reason("<html><script>x()</script><p>Hi</p></html>"), EMPTY_BODY)
+
+    def test_spa_shell(self):
+        html = '<html><body><div id="root"></div><script src="/static/js/main.js"></script></body></html>'
+        self.assertEqual(self.classifier.render_reason(html), SPA_SHELL)
+
+    def test_noscript_hint(self):
+        html = "<html><body><noscript>You need to enable JavaScript to run this app.</noscript>" \
+               "<script>app()</script></body></html>"
+        self.assertEqual(self.classifier.render_reason(html), NOSCRIPT)
+
+    def test_server_rendered_page(self):
+        html = f"<html><body>{ARTICLE}<script>analytics()</script></body></html>"
+        self.assertIsNone(self.classifier.render_reason(html))
+
+    def test_low_text_ratio(self):
+        html = f"<html><body>{ARTICLE}{'<div class=x></div>' * 5000}<script>x()</script></body></html>"
+        self.assertEqual(self.classifier.render_reason(html), LOW_TEXT_RATIO)
+
+
+class SplitHiddenTest(unittest.TestCase):
+
+    def test_hidden_elements_are_removed(self):
+        markup, noscripts = split_hidden("<p>a</p><SCRIPT>b()</SCRIPT><style>c{}</style><noscript>d</noscript>e")
+        self.assertEqual(visible_text(markup), "a e")
+        self.assertEqual(noscripts, ["d"])
+
+    def test_unclosed_element_ends_the_markup(self):
+        markup, noscripts = split_hidden("<p>a</p><noscript>enable javascript")
+        self.assertEqual(visible_text(markup), "a")
+        self.assertEqual(noscripts, ["enable javascript"])
+
+
+class RenderDecisionCacheTest(unittest.TestCase):
+
+    def test_decisions_expire(self):
+        cache = RenderDecisionCache(max_age=0)
+        cache.set("example.com", CrawlingType.RENDER)
+        self.assertIsNone(cache.get("example.com"))
+
+    def test_size_is_capped(self):
+        cache = RenderDecisionCache(max_size=2)
+        for domain in ("a.com", "b.com", "c.com"):
+            cache.set(domain, CrawlingType.SOURCE)
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get("a.com"))
+        self.assertEqual(cache.get("c.com"), CrawlingType.SOURCE)
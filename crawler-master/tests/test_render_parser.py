@@ -0,0 +1,56 @@
+import io
+import json
+import unittest
+
+from engine.render_parser import parse_render_payload, parse_render_response
+from exceptions import ParseError
+
+
+def render_payload(**overrides):
+    payload = {
+        "requestedUrl": "https://example.com",
+        "html": "<html><body>Example</body></html>",
+        "har": {"log": {"entries": [
+            {"request": {"url": "https://example.com/"},
+             "response": {"headers": [{"name": "Server", "value": "nginx"}]}},
+            {"request": {"url": "https://example.com/app.js"},
+             "response": {"headers": [{"name": "Server", "value": "cdn"}]}},
+        ]}},
+    }
+    payload.update(overrides)
+    return json.dumps(payload).encode("utf-8")
+
+
+class ContentResponse:
+
+    def __init__(self, content):
+        self.content = content
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class RenderParserTest(unittest.TestCase):
+
+    def test_payload_is_parsed(self):
+        result = parse_render_payload(io.BytesIO(render_payload()))
+        self.assertEqual(result.page_url, "https://example.com")
+        self.assertEqual(result.html, "<html><body>Example</body></html>")
+        self.assertEqual(json.loads(result.headers), [{"name": "Server", "value": "nginx"}])
+        self.assertEqual(json.loads(result.web_requests), ["https://example.com/", "https://example.com/app.js"])
+
+    def test_payload_without_har(self):
+        result = parse_render_payload(io.BytesIO(render_payload(har=None)))
+        self.assertEqual(json.loads(result.headers), {})
+        self.assertEqual(json.loads(result.web_requests), [])
+
+    def test_payload_without_html(self):
+        with self.assertRaises(ParseError):
+            parse_render_payload(io.BytesIO(render_payload(html=None)))
+
+    def test_broken_payload_closes_the_response(self):
+        response = ContentResponse(render_payload()[:40])
+        with self.assertRaises(ParseError):
+            parse_render_response(response)
+        self.assertTrue(response.closed)
@@ -0,0 +1,143 @@
+import threading
+import time
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from amqpstorm import AMQPConnectionError
+
+from queues.rmq_consumer import RMQConsumer
+
+
+class FakeChannel:
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.basic = self
+        self.acks = []
+        self.closed = False
+        self._on_message = None
+
+    def qos(self, prefetch_count):
+        pass
+
+    def consume(self, callback, queue, no_ack=False):
+        self._on_message = callback
+
+    def process_data_events(self, to_tuple=False):
+        if self.broker.fail.is_set():
+            self.broker.fail.clear()
+            raise AMQPConnectionError("connection lost")
+        with self.broker.lock:
+            tags, self.broker.pending = self.broker.pending, []
+        for tag in tags:
+            self._on_message(SimpleNamespace(delivery_tag=tag, channel=self))
+
+    def ack(self, delivery_tag, multiple=False):
+        self.acks.append((delivery_tag, multiple))
+
+    def close(self):
+        self.closed = True
+
+
+class FakeBroker:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = []
+        self.channels = []
+        self.fail = threading.Event()
+
+    def deliver(self, *tags):
+        with self.lock:
+            self.pending.extend(tags)
+
+    def connection(self, uri):
+        channel = FakeChannel(self)
+        self.channels.append(channel)
+        return SimpleNamespace(channel=lambda: channel, close=lambda: None)
+
+
+class RMQConsumerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.broker = FakeBroker()
+        patcher = mock.patch("queues.rmq_consumer.UriConnection", self.broker.connection)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def consumer(self, **kwargs):
+        kwargs.setdefault("ack_batch_size", 100)
+        kwargs.setdefault("ack_interval", 0.05)
+        return RMQConsumer("amqp://", "domains", poll_interval=0.005, receive_timeout=1.0, reconnect_delay=0.01,
+                           **kwargs)
+
+    def receive(self, consumer, count):
+        messages = []
+        deadline = time.monotonic() + 5
+        while len(messages) < count and time.monotonic() < deadline:
+            messages.extend(consumer.receive(count - len(messages)))
+        return messages
+
+    def wait_acked(self, consumer, count):
+        deadline = time.monotonic() + 5
+        while consumer.stats()["acked"] < count and time.monotonic() < deadline:
+            time.sleep(0.005)
+
+    def test_finished_prefix_is_acked_with_one_multiple_ack(self):
+        consumer = self.consumer()
+        self.broker.deliver(1, 2, 3)
+        messages = self.receive(consumer, 3)
+        for message in messages:
+            consumer.ack_message(message)
+        self.wait_acked(consumer, 3)
+        consumer.close()
+        self.assertEqual(self.broker.channels[0].acks, [(3, True)])
+
+    def test_messages_finished_behind_a_slow_one_are_acked_singly(self):
+        consumer = self.consumer()
+        self.broker.deliver(1, 2, 3, 4)
+        slow, *finished = self.receive(consumer, 4)
+        for message in finished:
+            consumer.ack_message(message)
+        self.wait_acked(consumer, 3)
+        self.assertEqual(self.broker.channels[0].acks, [(2, False), (3, False), (4, False)])
+        consumer.ack_message(slow)
+        self.wait_acked(consumer, 4)
+        consumer.close()
+        self.assertEqual(self.broker.channels[0].acks[-1], (1, True))
+        self.assertEqual(consumer.stats()["unacked"], 0)
+
+    def test_acks_wait_for_the_batch_and_are_flushed_on_close(self):
+        consumer = self.consumer(ack_batch_size=10, ack_interval=60)
+        self.broker.deliver(1, 2)
+        for message in self.receive(consumer, 2):
+            consumer.ack_message(message)
+        time.sleep(0.05)
+        self.assertEqual(self.broker.channels[0].acks, [])
+        consumer.close()
+        self.assertEqual(self.broker.channels[0].acks, [(2, True)])
+
+    def test_messages_of_a_lost_channel_are_not_acked_on_the_new_one(self):
+        consumer = self.consumer()
+        self.broker.deliver(1)
+        old = self.receive(consumer, 1)
+        self.broker.fail.set()
+        deadline = time.monotonic() + 5
+        while len(self.broker.channels) < 2 and time.monotonic() < deadline:
+            time.sleep(0.005)
+        # The broker redelivers the unacked message on the new channel
+        self.broker.deliver(1)
+        redelivered = self.receive(consumer, 1)
+        consumer.ack_message(old[0])
+        consumer.ack_message(redelivered[0])
+        self.wait_acked(consumer, 1)
+        consumer.close()
+        self.assertEqual(self.broker.channels[0].acks, [])
+        self.assertEqual(self.broker.channels[1].acks, [(1, True)])
+        self.assertIs(redelivered[0].channel, self.broker.channels[1])
+        self.assertEqual(consumer.stats()["reconnects"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
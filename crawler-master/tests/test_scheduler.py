@@ -0,0 +1,71 @@
+import unittest
+
+from crawler.scheduler import BucketMap, PolitenessScheduler, TokenBucket, normalize_host
+
+
+class TokenBucketTest(unittest.TestCase):
+
+    def test_burst_then_rate(self):
+        bucket = TokenBucket(rate=2.0, capacity=2, now=0.0)
+        for _ in range(2):
+            self.assertEqual(bucket.wait_time(0.0), 0.0)
+            bucket.consume(0.0)
+        self.assertAlmostEqual(bucket.wait_time(0.0), 0.5)
+        self.assertEqual(bucket.wait_time(0.5), 0.0)
+
+    def test_refill_is_capped(self):
+        bucket = TokenBucket(rate=1.0, capacity=2, now=0.0)
+        bucket.consume(0.0)
+        self.assertFalse(bucket.is_idle(0.5))
+        self.assertTrue(bucket.is_idle(100.0))
+        self.assertEqual(bucket.tokens, 2)
+
+
+class BucketMapTest(unittest.TestCase):
+
+    def test_idle_buckets_are_evicted_first(self):
+        buckets = BucketMap(rate=1.0, capacity=2, max_size=4)
+        buckets.get("busy", 0.0).consume(0.0)
+        for key in ("a", "b", "c"):
+            buckets.get(key, 0.0)
+        busy = buckets.get("busy", 0.0)
+        buckets.get("d", 0.0)
+        self.assertEqual(len(buckets), 4)
+        self.assertIs(buckets.get("busy", 0.0), busy)
+
+    def test_size_is_capped_when_nothing_is_idle(self):
+        buckets = BucketMap(rate=1.0, capacity=2, max_size=10)
+        for key in range(100):
+            buckets.get(key, 0.0).consume(0.0)
+        self.assertEqual(len(buckets), 10)
+
+
+class PolitenessSchedulerTest(unittest.TestCase):
+
+    def test_hosts_are_normalized(self):
+        self.assertEqual(normalize_host("https://WWW.Example.com:443/path"), "example.com")
+        self.assertEqual(normalize_host("www.example.com/"), "example.com")
+
+    def test_one_host_is_rate_limited(self):
+        scheduler = PolitenessScheduler(host_rate=0.001, host_burst=1)
+        for i in range(3):
+            scheduler.add({"i": i}, "example.com")
+        scheduler.add({"i": 3}, "www.example.com")
+        scheduler.add({"i": 4}, "other.com")
+        self.assertEqual(scheduler.pop_ready(), [{"i": 0}, {"i": 4}])
+        self.assertEqual(scheduler.pop_ready(), [])
+        self.assertEqual(scheduler.pending, 3)
+
+    def test_messages_without_host_are_not_limited(self):
+        scheduler = PolitenessScheduler(host_rate=0.001, host_burst=1)
+        for i in range(3):
+            scheduler.add({"i": i}, None)
+        self.assertEqual(list(scheduler.drain()), [{"i": 0}, {"i": 1}, {"i": 2}])
+
+    def test_drain_leaves_up_to_max_pending(self):
+        scheduler = PolitenessScheduler(host_rate=0.001, host_burst=1)
+        for i in range(3):
+            scheduler.add({"i": i}, "example.com")
+        self.assertEqual(list(scheduler.drain(max_pending=2)), [{"i": 0}])
+        self.assertEqual(scheduler.clear(), [{"i": 1}, {"i": 2}])
+        self.assertEqual(scheduler.pending, 0)
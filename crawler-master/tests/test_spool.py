@@ -0,0 +1,154 @@
+import os
+import tempfile
+import time
+import unittest
+
+from queues.output_queue import OutputQueue
+from queues.spool import SpoolQueue, RECORD_HEADER, segment_numbers, segment_path
+from repository.checkpoint import FileCheckpoint
+
+
+class RecordingQueue(OutputQueue):
+    # Writes every document except the ids of fail_once, which fail their first write
+
+    def __init__(self, fail_once=()):
+        self.written = []
+        self.closed = False
+        self._fail_once = set(fail_once)
+
+    def put(self, message):
+        self.written.append(message)
+
+    def write_batch(self, docs):
+        failed = [doc for doc in docs if doc["id"] in self._fail_once]
+        self._fail_once.difference_update(doc["id"] for doc in failed)
+        self.written.extend(doc for doc in docs if doc not in failed)
+        return failed
+
+    def close(self):
+        self.closed = True
+
+
+def write_segment(directory, seq, messages, tail=b""):
+    os.makedirs(directory, exist_ok=True)
+    offsets = []
+    with open(segment_path(directory, seq), "wb") as file:
+        for message in messages:
+            file.write(SpoolQueue.encode(message))
+            offsets.append(file.tell())
+        file.write(tail)
+    return offsets
+
+
+def docs(start, stop):
+    return [{"id": i} for i in range(start, stop)]
+
+
+class SpoolQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.TemporaryDirectory()
+        self.directory = os.path.join(self.root.name, "worker-0")
+
+    def tearDown(self):
+        self.root.cleanup()
+
+    def spool(self, queue, **kwargs):
+        return SpoolQueue(queue, self.directory, batch_size=10, max_latency=0.05, fsync_interval=0.05,
+                          retry_delay=0.01, close_timeout=5.0, **kwargs)
+
+    def wait_written(self, queue, count, timeout=5.0):
+        deadline = time.monotonic() + timeout
+        while len(queue.written) < count and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def test_put_messages_are_written_in_order(self):
+        queue = RecordingQueue()
+        spool = self.spool(queue)
+        for doc in docs(0, 25):
+            spool.put(doc)
+        spool.close()
+        self.assertEqual(queue.written, docs(0, 25))
+        self.assertTrue(queue.closed)
+        self.assertEqual(segment_numbers(self.directory), [])
+
+    def test_segments_are_replayed_from_the_checkpoint(self):
+        offsets = write_segment(self.directory, 3, docs(0, 5))
+        write_segment(self.directory, 4, docs(5, 8))
+        # Segment 3 was drained up to its third record before the process stopped
+        FileCheckpoint(os.path.join(self.directory, "drained")).save(f"3 {offsets[2]}")
+        queue = RecordingQueue()
+        spool = self.spool(queue)
+        spool.close()
+        self.assertEqual(queue.written, docs(3, 8))
+        self.assertEqual(segment_numbers(self.directory), [])
+
+    def test_new_segments_are_numbered_after_replayed_ones(self):
+        write_segment(self.directory, 7, docs(0, 2))
+        FileCheckpoint(os.path.join(self.directory, "drained")).save("9 0")
+        queue = RecordingQueue()
+        spool = self.spool(queue)
+        spool.put({"id": 2})
+        spool.close()
+        self.assertEqual(queue.written, docs(0, 3))
+
+    def test_given_up_docs_are_requeued_behind_the_rest(self):
+        queue = RecordingQueue(fail_once={1, 3})
+        spool = self.spool(queue)
+        for doc in docs(0, 5):
+            spool.put(doc)
+        spool.flush()
+        self.wait_written(queue, 5)
+        stats = spool.stats()
+        spool.close()
+        self.assertEqual(queue.written, [{"id": 0}, {"id": 2}, {"id": 4}, {"id": 1}, {"id": 3}])
+        self.assertEqual(stats["requeued"], 2)
+        self.assertEqual(stats["drained"], 5)
+
+    def test_torn_tail_is_dropped(self):
+        payload = SpoolQueue.encode({"id": 3})
+        # A crash in the middle of a write leaves a header with part of its payload
+        write_segment(self.directory, 0, docs(0, 3), tail=payload[:RECORD_HEADER.size + 2])
+        write_segment(self.directory, 1, docs(4, 6))
+        queue = RecordingQueue()
+        spool = self.spool(queue)
+        spool.close()
+        self.assertEqual(queue.written, docs(0, 3) + docs(4, 6))
+        self.assertEqual(spool.stats()["corrupted"], 1)
+        self.assertEqual(segment_numbers(self.directory), [])
+
+    def test_record_with_a_wrong_checksum_ends_its_segment(self):
+        payload = bytearray(SpoolQueue.encode({"id": 3}))
+        payload[-2] ^= 0xff
+        write_segment(self.directory, 0, docs(0, 3), tail=bytes(payload) + SpoolQueue.encode({"id": 4}))
+        queue = RecordingQueue()
+        spool = self.spool(queue)
+        spool.close()
+        self.assertEqual(queue.written, docs(0, 3))
+        self.assertEqual(spool.stats()["corrupted"], 1)
+
+    def test_second_process_can_not_open_the_spool(self):
+        spool = self.spool(RecordingQueue())
+        try:
+            with self.assertRaises(RuntimeError):
+                self.spool(RecordingQueue())
+        finally:
+            spool.close()
+
+    def test_orphaned_spools_are_adopted(self):
+        orphan = os.path.join(self.root.name, "worker-3")
+        offsets = write_segment(orphan, 0, docs(0, 4))
+        write_segment(orphan, 1, docs(4, 6))
+        FileCheckpoint(os.path.join(orphan, "drained")).save(f"0 {offsets[0]}")
+        queue = RecordingQueue()
+        spool = self.spool(queue, orphans=[orphan])
+        self.wait_written(queue, 5)
+        stats = spool.stats()
+        spool.close()
+        self.assertEqual(queue.written, docs(1, 6))
+        self.assertEqual(stats["adopted"], 5)
+        self.assertEqual(segment_numbers(orphan), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
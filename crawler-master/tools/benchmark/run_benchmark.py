@@ -0,0 +1,366 @@
+import argparse
+import json
+import logging.config
+import math
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+
+from elasticsearch import Elasticsearch
+from pymq import MessageQueueContract
+
+sys.path.append(os.path.abspath(os.curdir))
+
+from configs.crawler_settings import DEFAULT_HEADERS, ASYNC_MAX_IN_FLIGHT, ASYNC_PER_HOST_LIMIT, \
+    CRAWLING_TYPE_CONCURRENCY, HTTP_POOL_CONNECTIONS, HTTP_POOL_MAXSIZE, RENDER_POOL_MAXSIZE, MAX_BODY_SIZE, \
+    BODY_CHUNK_SIZE, DNS_MAX_IN_FLIGHT, DNS_CACHE_SIZE, ES_BULK_SIZE, ES_BULK_MAX_BYTES, ES_BULK_MAX_LATENCY, \
+    RENDER_INITIAL_CONCURRENCY, RENDER_MIN_CONCURRENCY, RENDER_MAX_CONCURRENCY, RENDER_LATENCY_TARGET, \
+    RENDER_PARK_AFTER, RENDER_MAX_PARKED, CRAWLING_TYPE_WORKERS
+from configs.logging_config import logging_config
+from crawler.async_crawling_service import AsyncCrawlingService
+from crawler.base_crawler import BaseCrawler
+from crawler.crawling_service import CrawlingService
+from crawling_locator.locator import CrawlingEngineLocator, AutoRenderCrawler
+from engine.async_engine import AsyncRequestsEngine
+from engine.dns_cache import DNSCache
+from engine.dns_records import DNSRecordsCrawler, DNSRecordsBaseEngine
+from engine.fallback import FallbackStrategy, SEQUENTIAL
+from engine.http_session import PooledSession
+from engine.render_dispatcher import RenderDispatcher, AdaptiveLimit
+from engine.render_engine import RenderAPIEngine
+from engine.requests_engine import RequestsEngine
+from queues.output_queue import OutputQueue, ESIndexQueue
+from tools.benchmark.stubs import HTTPProfile, run_stubs
+from tools.structures import CrawlingType, DNS_RECORD_TYPES
+
+logger = logging.getLogger(__name__)
+
+HTTP_TYPES = [CrawlingType.SOURCE, CrawlingType.CAREERS, CrawlingType.RENDER, CrawlingType.AUTO]
+# The stubs serve plain http on a random port, other schemas and www. variants would only add failures
+BENCHMARK_VARIANTS = [("http", "")]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Runs CrawlingService end to end against local stub servers")
+    parser.add_argument("-n", "--messages", default=100000, type=int, help="Number of synthetic messages")
+    parser.add_argument("-m", "--mix",
+                        default="source=60,render=10,txt=10,mx=10,dns=10",
+                        help="Share of every crawling type, as type=weight pairs")
+    parser.add_argument("-w", "--workers", default=50, type=int, help="Number of messages processed concurrently")
+    parser.add_argument("-a", "--asyncio", help="Crawl with AsyncCrawlingService", action='store_true')
+    parser.add_argument("-b", "--batch_size", default=1000, type=int, help="Message batch size from the input queue")
+    parser.add_argument("-o", "--output", choices=["es", "null"], default="es",
+                        help="Index into the stub ElasticSearch or drop the results")
+    parser.add_argument("--latency", default=0.05, type=float, help="Mean response latency of the stub sites, s")
+    parser.add_argument("--jitter", default=0.5, type=float, help="Latency varies by +- this share of it")
+    parser.add_argument("--size", default=20000, type=int, help="Body size of the stub pages, bytes")
+    parser.add_argument("--error_rate", default=0.0, type=float, help="Share of 500 responses")
+    parser.add_argument("--not_found_rate", default=0.0, type=float, help="Share of 404 responses")
+    parser.add_argument("--redirect_rate", default=0.0, type=float, help="Share of 302 responses")
+    parser.add_argument("--render_latency", default=0.5, type=float, help="Mean latency of the stub render API, s")
+    parser.add_argument("--web_requests", default=20, type=int, help="Number of HAR entries of a rendered page")
+    parser.add_argument("-p", "--progress", default=10.0, type=float, help="Progress log interval, s")
+    parser.add_argument("-r", "--report", help="Writes the report as JSON into this file")
+    parser.add_argument("--seed", default=0, type=int, help="Seed of the crawling type mix")
+    return parser.parse_args()
+
+
+def parse_mix(mix):
+    weights = {}
+    for pair in mix.split(","):
+        name, _, weight = pair.partition("=")
+        weights[CrawlingType.get_by_index(name.strip())] = float(weight or 1)
+    return weights
+
+
+class LatencyRecorder:
+    # Log-scale buckets keep the memory constant for any number of messages, quantiles are within 2%
+
+    GROWTH = 1.02
+    MIN_LATENCY = 1e-5
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = defaultdict(Counter)
+
+    def observe(self, crawling_type, latency):
+        bucket = int(math.log(max(latency, self.MIN_LATENCY) / self.MIN_LATENCY, self.GROWTH))
+        with self._lock:
+            self._buckets[crawling_type][bucket] += 1
+
+    def quantile(self, crawling_type, q):
+        with self._lock:
+            buckets = sorted(self._buckets[crawling_type].items())
+        total = sum(count for _, count in buckets)
+        if not total:
+            return None
+        rank = q * total
+        seen = 0
+        for bucket, count in buckets:
+            seen += count
+            if seen >= rank:
+                return self.MIN_LATENCY * self.GROWTH ** (bucket + 0.5)
+        return None
+
+    def summary(self):
+        with self._lock:
+            types = {crawling_type: sum(buckets.values()) for crawling_type, buckets in self._buckets.items()}
+        return {crawling_type: {"messages": count,
+                                "p50": self.quantile(crawling_type, 0.5),
+                                "p99": self.quantile(crawling_type, 0.99)}
+                for crawling_type, count in sorted(types.items())}
+
+
+class SyntheticQueue(MessageQueueContract):
+    # Generates messages on demand and times every one of them from receive to ack
+
+    def __init__(self, total, weights, http_port, seed=0, on_done=None):
+        self._total = total
+        self._types = list(weights)
+        self._weights = list(weights.values())
+        self._http_port = http_port
+        self._random = random.Random(seed)
+        self._on_done = on_done
+        self._lock = threading.Lock()
+        self._produced = 0
+        self._acked = 0
+        self._received_at = {}
+        self.latencies = LatencyRecorder()
+
+    def queue(self):
+        return "benchmark"
+
+    def send(self, message):
+        pass
+
+    @property
+    def produced(self):
+        return self._produced
+
+    @property
+    def acked(self):
+        return self._acked
+
+    def _message(self, i, crawling_type):
+        if crawling_type in HTTP_TYPES:
+            domain = f"127.0.0.1:{self._http_port}/site/{i}"
+        else:
+            domain = f"d{i}.bench"
+        message = {"domain": domain, "crawling_type": crawling_type.value, "_bench_id": i}
+        if crawling_type == CrawlingType.CAREERS:
+            message["url_to_crawl"] = domain + "/careers"
+        if crawling_type == CrawlingType.DNS:
+            message["record_types"] = [record_type.value for record_type in DNS_RECORD_TYPES]
+        return message
+
+    def receive(self, messages_number: int = 1, break_on_empty=True):
+        with self._lock:
+            count = min(messages_number, self._total - self._produced)
+            start = self._produced
+            self._produced += count
+            types = self._random.choices(self._types, self._weights, k=count)
+            now = time.perf_counter()
+            for i in range(start, start + count):
+                self._received_at[i] = now
+        if not count:
+            # Exhausted, the service keeps polling until the last messages are acked
+            time.sleep(0.1)
+            return []
+        return [self._message(i, crawling_type) for i, crawling_type in zip(range(start, start + count), types)]
+
+    def ack_message(self, message):
+        with self._lock:
+            received_at = self._received_at.pop(message["_bench_id"], None)
+            if received_at is None:
+                return
+            self._acked += 1
+            done = self._acked == self._total
+        self.latencies.observe(message["crawling_type"], time.perf_counter() - received_at)
+        if done and self._on_done is not None:
+            self._on_done()
+
+
+class CountingQueue(OutputQueue):
+    # Drops the messages, counts them per crawling type and error reason
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = Counter()
+
+    def put(self, message):
+        key = message.get("crawling_type", "")
+        if "error" in message:
+            key = f"{key}:{message['error']['reason']}"
+        with self._lock:
+            self.counters[key] += 1
+
+
+def build_crawling_service(args, ports, input_queue, output_queue, errors_queue):
+    fallback_workers = args.workers * len(BENCHMARK_VARIANTS)
+    source_fallback = FallbackStrategy(SEQUENTIAL, variants=BENCHMARK_VARIANTS, max_workers=fallback_workers)
+    render_fallback = FallbackStrategy(SEQUENTIAL, variants=BENCHMARK_VARIANTS, max_workers=fallback_workers)
+    if args.asyncio:
+        source_engine = AsyncRequestsEngine(headers=DEFAULT_HEADERS,
+                                            max_connections=ASYNC_MAX_IN_FLIGHT,
+                                            fallback=source_fallback,
+                                            max_body_size=MAX_BODY_SIZE,
+                                            chunk_size=BODY_CHUNK_SIZE)
+    else:
+        source_session = PooledSession(pool_connections=HTTP_POOL_CONNECTIONS,
+                                       pool_maxsize=max(HTTP_POOL_MAXSIZE, args.workers),
+                                       keep_alive=True)
+        source_engine = RequestsEngine(headers=DEFAULT_HEADERS,
+                                       fallback=source_fallback,
+                                       session=source_session,
+                                       max_body_size=MAX_BODY_SIZE,
+                                       chunk_size=BODY_CHUNK_SIZE)
+    render_session = PooledSession(pool_connections=1,
+                                   pool_maxsize=max(RENDER_POOL_MAXSIZE, RENDER_MAX_CONCURRENCY + RENDER_MAX_PARKED),
+                                   keep_alive=True)
+    render_engine = RenderAPIEngine(f"http://127.0.0.1:{ports['render']}/render.json",
+                                    headers=DEFAULT_HEADERS,
+                                    fallback=render_fallback,
+                                    session=render_session)
+    render_dispatcher = RenderDispatcher(render_engine,
+                                         AdaptiveLimit(initial=RENDER_INITIAL_CONCURRENCY,
+                                                       min_limit=RENDER_MIN_CONCURRENCY,
+                                                       max_limit=RENDER_MAX_CONCURRENCY,
+                                                       latency_target=RENDER_LATENCY_TARGET),
+                                         park_after=RENDER_PARK_AFTER,
+                                         max_parked=RENDER_MAX_PARKED)
+    dns_engine = DNSRecordsBaseEngine(nameservers=["127.0.0.1"],
+                                      port=ports["dns"],
+                                      max_in_flight=DNS_MAX_IN_FLIGHT,
+                                      cache=DNSCache(max_size=DNS_CACHE_SIZE))
+    dns_crawler = DNSRecordsCrawler(dns_engine)
+
+    crawling_locator = CrawlingEngineLocator()
+    crawling_locator.add(CrawlingType.SOURCE, BaseCrawler(source_engine))
+    crawling_locator.add(CrawlingType.CAREERS, BaseCrawler(source_engine))
+    crawling_locator.add(CrawlingType.RENDER, BaseCrawler(render_dispatcher))
+    crawling_locator.add(CrawlingType.AUTO, AutoRenderCrawler(crawling_locator))
+    for crawling_type in DNS_RECORD_TYPES + [CrawlingType.DNS]:
+        crawling_locator.add(crawling_type, dns_crawler)
+
+    # Frontier, politeness and change detection are off: every synthetic message is crawled
+    if args.asyncio:
+        crawling_service = AsyncCrawlingService(crawler=crawling_locator,
+                                                input_queue=input_queue,
+                                                output_queue=output_queue,
+                                                errors_queue=errors_queue,
+                                                worker_num=args.workers,
+                                                max_in_flight=ASYNC_MAX_IN_FLIGHT,
+                                                per_host_limit=ASYNC_PER_HOST_LIMIT,
+                                                async_engines=[source_engine],
+                                                type_concurrency=CRAWLING_TYPE_CONCURRENCY,
+                                                type_workers=CRAWLING_TYPE_WORKERS)
+    else:
+        crawling_service = CrawlingService(crawler=crawling_locator,
+                                           input_queue=input_queue,
+                                           output_queue=output_queue,
+                                           errors_queue=errors_queue,
+                                           worker_num=args.workers,
+                                           type_concurrency=CRAWLING_TYPE_CONCURRENCY,
+                                           type_workers=CRAWLING_TYPE_WORKERS)
+    return crawling_service, render_dispatcher
+
+
+def map_output_queue(key, ports):
+    if key == "es":
+        return ESIndexQueue(Elasticsearch(f"http://127.0.0.1:{ports['es']}"), "benchmark",
+                            batch_size=ES_BULK_SIZE,
+                            max_batch_bytes=ES_BULK_MAX_BYTES,
+                            max_latency=ES_BULK_MAX_LATENCY)
+    return CountingQueue()
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def log_progress(input_queue, started, interval, finished: threading.Event):
+    while not finished.wait(interval):
+        elapsed = time.monotonic() - started
+        logger.info(f"Acked {input_queue.acked}/{input_queue.produced} messages, "
+                    f"{input_queue.acked / elapsed:.0f} messages/s, peak RSS {peak_rss_mb():.0f} MB")
+
+
+def run_benchmark(args):
+    profile = HTTPProfile(latency=args.latency,
+                          jitter=args.jitter,
+                          size=args.size,
+                          error_rate=args.error_rate,
+                          not_found_rate=args.not_found_rate,
+                          redirect_rate=args.redirect_rate,
+                          render_latency=args.render_latency,
+                          web_requests=args.web_requests)
+    # The stubs run in another process, so their CPU time doesn't count against the crawler
+    connection, stubs_connection = multiprocessing.Pipe()
+    stubs = multiprocessing.Process(target=run_stubs, args=(profile, stubs_connection), name="benchmark-stubs",
+                                    daemon=True)
+    stubs.start()
+    ports = connection.recv()
+    logger.info(f"Stub servers are listening on {ports}")
+
+    services = []
+    input_queue = SyntheticQueue(args.messages, parse_mix(args.mix), ports["http"], seed=args.seed,
+                                 on_done=lambda: services[0].stop())
+    output_queue = map_output_queue(args.output, ports)
+    errors_queue = CountingQueue()
+    crawling_service, render_dispatcher = build_crawling_service(args, ports, input_queue, output_queue,
+                                                                 errors_queue)
+    services.append(crawling_service)
+
+    finished = threading.Event()
+    started = time.monotonic()
+    progress = threading.Thread(target=log_progress, args=(input_queue, started, args.progress, finished),
+                                name="benchmark-progress", daemon=True)
+    progress.start()
+    crawling_service.run(message_batch_size=args.batch_size, single_batch=False)
+    elapsed = time.monotonic() - started
+    finished.set()
+
+    connection.send("stop")
+    es_counters = connection.recv()
+    stubs.join()
+
+    report = {
+        "messages": input_queue.acked,
+        "seconds": round(elapsed, 3),
+        "messages_per_second": round(input_queue.acked / elapsed, 1),
+        "latency": input_queue.latencies.summary(),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        "service": crawling_service.stats(),
+        "errors": dict(errors_queue.counters),
+        "render": render_dispatcher.stats(),
+        "es": es_counters,
+    }
+    if isinstance(output_queue, ESIndexQueue):
+        report["es_queue"] = output_queue.stats()
+    return report
+
+
+def log_report(report):
+    logger.info(f"{report['messages']} messages in {report['seconds']}s: {report['messages_per_second']} messages/s, "
+                f"peak RSS {report['peak_rss_mb']} MB")
+    for crawling_type, latency in report["latency"].items():
+        logger.info(f"{crawling_type}: {latency['messages']} messages, "
+                    f"p50 {latency['p50'] * 1000:.1f} ms, p99 {latency['p99'] * 1000:.1f} ms")
+    logger.info(f"Service counters: {report['service']}, errors: {report['errors']}")
+    logger.info(f"Render dispatcher: {report['render']}, ElasticSearch stub: {report['es']}")
+
+
+if __name__ == '__main__':
+    logging.config.dictConfig(logging_config)
+    args = parse_args()
+    report = run_benchmark(args)
+    log_report(report)
+    if args.report:
+        with open(args.report, "w") as file:
+            json.dump(report, file, indent=2, default=str)
@@ -0,0 +1,214 @@
+import json
+import logging
+import random
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import NamedTuple
+
+import dns.message
+import dns.rdataclass
+import dns.rdatatype
+import dns.rrset
+
+logger = logging.getLogger(__name__)
+
+
+class HTTPProfile(NamedTuple):
+    latency: float = 0.05
+    # Latency varies by +- this share of it
+    jitter: float = 0.5
+    size: int = 20000
+    error_rate: float = 0.0
+    not_found_rate: float = 0.0
+    redirect_rate: float = 0.0
+    render_latency: float = 0.5
+    web_requests: int = 20
+
+
+def page(size):
+    head = b"<html><head><title>Benchmark page</title></head><body>"
+    tail = b"</body></html>"
+    paragraph = b"<p>Lorem ipsum dolor sit amet, consectetur adipiscing elit.</p>"
+    body = paragraph * max(0, (size - len(head) - len(tail)) // len(paragraph) + 1)
+    return (head + body)[:max(0, size - len(tail))] + tail
+
+
+def sleep_latency(latency, jitter):
+    if latency > 0:
+        time.sleep(max(0.0, random.uniform(latency * (1 - jitter), latency * (1 + jitter))))
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    profile = HTTPProfile()
+
+    def reply(self, status, body: bytes = b"", content_type="text/html; charset=utf-8", headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if body and self.command != "HEAD":
+            self.wfile.write(body)
+
+    def read_body(self) -> bytes:
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def log_message(self, format, *args):
+        pass
+
+
+class SiteHandler(StubHandler):
+    # Crawled sites: latency, body size, error and redirect share come from the profile
+
+    page_body = b""
+
+    def do_GET(self):
+        profile = self.profile
+        sleep_latency(profile.latency, profile.jitter)
+        roll = 1.0 if self.path.startswith("/final/") else random.random()
+        if roll < profile.error_rate:
+            self.reply(500, b"Internal error")
+        elif roll < profile.error_rate + profile.not_found_rate:
+            self.reply(404, b"Not found")
+        elif roll < profile.error_rate + profile.not_found_rate + profile.redirect_rate:
+            self.reply(302, headers={"Location": "/final" + self.path})
+        else:
+            self.reply(200, self.page_body)
+
+    do_HEAD = do_GET
+
+
+class RenderHandler(StubHandler):
+    # Render API: answers with a HAR payload of the requested url
+
+    page_html = ""
+
+    def do_POST(self):
+        profile = self.profile
+        request = json.loads(self.read_body() or b"{}")
+        url = request.get("url", "")
+        sleep_latency(profile.render_latency, profile.jitter)
+        entries = [{
+            "request": {"url": url},
+            "response": {"status": 200, "headers": [{"name": "Content-Type", "value": "text/html"},
+                                                    {"name": "Server", "value": "stub"}]},
+        }]
+        for i in range(profile.web_requests):
+            entries.append({
+                "request": {"url": f"{url}/static/{i}.js"},
+                "response": {"status": 200, "headers": [{"name": "Content-Type", "value": "text/javascript"}]},
+            })
+        payload = {"requestedUrl": url, "html": self.page_html, "har": {"log": {"entries": entries}}}
+        self.reply(200, json.dumps(payload).encode("utf-8"), content_type="application/json")
+
+
+class ElasticsearchHandler(StubHandler):
+    # Bulk sink: acknowledges every action and counts them
+
+    lock = threading.Lock()
+    counters = {"bulk_requests": 0, "actions": 0, "bytes": 0}
+
+    def do_GET(self):
+        self.reply(200, json.dumps({"version": {"number": "7.9.1"}, "tagline": "stub"}).encode("utf-8"),
+                   content_type="application/json")
+
+    def do_HEAD(self):
+        self.reply(200, content_type="application/json")
+
+    def do_POST(self):
+        body = self.read_body()
+        if not self.path.split("?")[0].endswith("/_bulk"):
+            self.reply(200, b"{}", content_type="application/json")
+            return
+        items = []
+        expects_source = False
+        for line in body.splitlines():
+            if not line.strip():
+                continue
+            if expects_source:
+                expects_source = False
+                continue
+            action = json.loads(line)
+            name, meta = next(iter(action.items()))
+            items.append({name: {"_index": meta.get("_index"), "_id": meta.get("_id"), "status": 200,
+                                 "result": "updated"}})
+            expects_source = name != "delete"
+        with self.lock:
+            self.counters["bulk_requests"] += 1
+            self.counters["actions"] += len(items)
+            self.counters["bytes"] += len(body)
+        self.reply(200, json.dumps({"took": 1, "errors": False, "items": items}).encode("utf-8"),
+                   content_type="application/json")
+
+    do_PUT = do_POST
+
+
+DNS_ANSWERS = {
+    "A": "127.0.0.1",
+    "AAAA": "::1",
+    "CNAME": "alias.{name}",
+    "MX": "10 mail.{name}",
+    "NS": "ns1.{name}",
+    "SOA": "ns1.{name} hostmaster.{name} 1 3600 600 86400 300",
+    "TXT": "\"v=spf1 include:_spf.{name} -all\"",
+    "SPF": "\"v=spf1 include:_spf.{name} -all\"",
+}
+
+
+class DNSHandler(socketserver.BaseRequestHandler):
+    # Answers every known record type for any name, unknown types get an empty answer
+
+    def handle(self):
+        data, sock = self.request
+        try:
+            query = dns.message.from_wire(data)
+        except Exception:
+            return
+        response = dns.message.make_response(query)
+        for question in query.question:
+            template = DNS_ANSWERS.get(dns.rdatatype.to_text(question.rdtype))
+            if template is None:
+                continue
+            name = question.name.to_text()
+            response.answer.append(dns.rrset.from_text(question.name, 300, dns.rdataclass.IN, question.rdtype,
+                                                       template.format(name=name)))
+        sock.sendto(response.to_wire(), self.client_address)
+
+
+class ThreadingDNSServer(socketserver.ThreadingUDPServer):
+    daemon_threads = True
+
+
+def _serve(server):
+    thread = threading.Thread(target=server.serve_forever, name=type(server).__name__, daemon=True)
+    thread.start()
+    return server.server_address[1]
+
+
+def http_server(handler, profile: HTTPProfile, **attributes):
+    handler = type(handler.__name__, (handler,), dict(profile=profile, **attributes))
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    return server
+
+
+def run_stubs(profile: HTTPProfile, connection):
+    # Runs in its own process, so the stubs don't share the GIL with the measured crawler
+    body = page(profile.size)
+    servers = {
+        "http": http_server(SiteHandler, profile, page_body=body),
+        "render": http_server(RenderHandler, profile, page_html=body.decode("utf-8")),
+        "es": http_server(ElasticsearchHandler, profile),
+        "dns": ThreadingDNSServer(("127.0.0.1", 0), DNSHandler),
+    }
+    connection.send({name: _serve(server) for name, server in servers.items()})
+    connection.recv()
+    connection.send(dict(ElasticsearchHandler.counters))
+    for server in servers.values():
+        server.shutdown()
+        server.server_close()
@@ -2,10 +2,11 @@ import argparse
 import logging.config
 import os
 import sys
+import time
+from datetime import datetime, timedelta, timezone
 
 import psycopg2
 from dotenv import load_dotenv
-from pymq import RabbitMQQueue, RabbitMQ, RabbitMQConnectionClient
 
 sys.path.append(os.path.abspath(os.curdir))
 
@@ -13,43 +14,106 @@ from repository.repository import RepositoryContract
 from tools.structures import CrawlingType
 
 from configs.logging_config import logging_config
-from queues.output_queue import OutputQueue, RMQQueue
-from repository.domain_repository import FakeDomainRepository, DBDomainRepository
+from queues.output_queue import OutputQueue, PrintingQueue
+from queues.rmq_publisher import BatchRMQPublisher
+from repository.checkpoint import FileCheckpoint
+from repository.domain_repository import FakeDomainRepository, DBDomainRepository, CSVDomainRepository
 from service_locator import service_locator
 
+logger = logging.getLogger(__name__)
+
+# Careers messages need an url to crawl, they are not seeded from a domains list
+POPULATE_CRAWLING_TYPES = [crawling_type.value for crawling_type in CrawlingType
+                           if crawling_type != CrawlingType.CAREERS]
+
 
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("-r", "--repository",
-                        choices=["db", "fake"],
+                        choices=["db", "csv", "fake"],
                         default="db",
-                        help="Domains repository: fake or db")
-    parser.add_argument("-ct", "--crawling_type",
-                        choices=["source", "render", "spf", "mx", "cname", "ns", "soa", "txt", "http"],
-                        default="render", help="Type of crawling")
-    parser.add_argument("-l", "--limit", type=int, default=100,
-                        help="Limit of records. Default is 10. Works with db only")
+                        help="Domains repository: db, csv or fake")
+    parser.add_argument("-f", "--file", nargs="+", default=[],
+                        help="CSV files with domains, a 'domain' column or the first column. Works with csv only")
+    parser.add_argument("-ct", "--crawling_type", nargs="+",
+                        choices=POPULATE_CRAWLING_TYPES,
+                        default=["render"], help="Types of crawling, every domain is sent once per type")
+    parser.add_argument("-l", "--limit", type=int, default=None,
+                        help="Limit of domains. All domains by default")
+    parser.add_argument("-o", "--output",
+                        choices=["rmq", "console"],
+                        default="rmq",
+                        help="Output queue: rmq or console. RMQ by default")
+    parser.add_argument("-bs", "--batch_size", type=int, default=1000,
+                        help="Messages published per confirmed batch. Default is 1000")
+    parser.add_argument("--shard", type=int, default=0,
+                        help="Shard of the domains this loader sends, from 0 to shards - 1")
+    parser.add_argument("--shards", type=int, default=1,
+                        help="Number of shards the domains are split into by hash. Default is 1")
+    parser.add_argument("--start", default=None,
+                        help="First domain of the range to send. Works with db only")
+    parser.add_argument("--end", default=None,
+                        help="Domain the range to send stops before. Works with db only")
+    parser.add_argument("--not_crawled_for", type=float, default=None,
+                        help="Sends only domains not crawled for these many hours. Works with db only")
+    parser.add_argument("--crawled_column", default="last_crawled_at",
+                        help="Column with the last crawl time. Default is last_crawled_at")
+    parser.add_argument("-c", "--checkpoint", default=None,
+                        help="File with the last sent domain, the loader resumes after it")
+    parser.add_argument("-p", "--progress", type=float, default=10.0,
+                        help="Seconds between progress reports. Default is 10")
     return parser.parse_args()
 
 
-def populate(crawling_type, limit):
+def populate(crawling_types, limit, progress_interval=10.0, checkpoint: FileCheckpoint = None):
     domain_repository_ = service_locator.get(RepositoryContract)
     output_queue_ = service_locator.get(OutputQueue)
-    with open("/home/proplus/Documents/Domains.csv") as file:
-    csv_reader=csv.reader.read(file)
-    for entity in csv_reader.readline(crawling_type, limit):
-    #for entity in domain_repository_.all(crawling_type, limit):
-        output_message = {
-            "domain": entity.domain,
-            "crawling_type": entity.crawling_type.value
-        }
-        output_queue_.put(output_message)
-
-
-def repository_map(key):
+    crawling_type_values = [crawling_type.value for crawling_type in crawling_types]
+
+    after = checkpoint.load() if checkpoint is not None else None
+    if after is not None:
+        logger.info(f"Resuming after {after}")
+
+    started = last_report = time.monotonic()
+    domains = messages = last_messages = 0
+    domain = None
+    try:
+        for domain in domain_repository_.domains(limit, after=after):
+            for crawling_type in crawling_type_values:
+                output_queue_.put({"domain": domain, "crawling_type": crawling_type})
+            domains += 1
+            messages += len(crawling_type_values)
+            now = time.monotonic()
+            if now - last_report >= progress_interval:
+                if checkpoint is not None:
+                    # Only confirmed messages are checkpointed, a crash resends at most one interval
+                    output_queue_.flush()
+                    checkpoint.save(domain)
+                rate = (messages - last_messages) / (now - last_report)
+                logger.info(f"Populated {domains} domains, {messages} messages, {rate:.0f} messages/s")
+                last_report, last_messages = now, messages
+        output_queue_.flush()
+        if checkpoint is not None and domain is not None:
+            checkpoint.save(domain)
+    finally:
+        output_queue_.close()
+    elapsed = time.monotonic() - started
+    logger.info(f"Populated {domains} domains, {messages} messages in {elapsed:.1f}s, "
+                f"{messages / elapsed if elapsed else 0:.0f} messages/s")
+
+
+def repository_map(key, args):
     if key == "db":
         pg = psycopg2.connect(os.getenv("POSTGRESQL_CONNECTION_STRING"))
-        repository = DBDomainRepository(pg)
+        crawled_before = None
+        if args.not_crawled_for is not None:
+            crawled_before = datetime.now(timezone.utc) - timedelta(hours=args.not_crawled_for)
+        repository = DBDomainRepository(pg, shard=args.shard, shards=args.shards, start=args.start, end=args.end,
+                                        crawled_before=crawled_before, crawled_column=args.crawled_column)
+    elif key == "csv":
+        if not args.file:
+            raise RuntimeError("CSV repository needs at least one file")
+        repository = CSVDomainRepository(args.file, shard=args.shard, shards=args.shards)
     elif key == "fake":
         repository = FakeDomainRepository()
     else:
@@ -58,21 +122,29 @@ def repository_map(key):
     return repository
 
 
+def output_queue_map(key, batch_size):
+    if key == "rmq":
+        queue = BatchRMQPublisher(os.getenv("RABBITMQ_CONNECTION_STRING"),
+                                  exchange=os.getenv("DOMAINS_EXCHANGE_NAME"),
+                                  routing_key=os.getenv("DOMAINS_ROUTING_KEY"),
+                                  batch_size=batch_size)
+    elif key == "console":
+        queue = PrintingQueue()
+    else:
+        raise RuntimeError("Key {} is not mapped to any output queue".format(key))
+
+    return queue
+
+
 if __name__ == '__main__':
     load_dotenv()
     logging.config.dictConfig(logging_config)
     args = parse_args()
 
-    crawling_type = CrawlingType.get_by_index(args.crawling_type)
-    domain_repository = repository_map(args.repository)
+    crawling_types = [CrawlingType.get_by_index(crawling_type) for crawling_type in args.crawling_type]
+    domain_repository = repository_map(args.repository, args)
     service_locator.bind(RepositoryContract, domain_repository)
+    service_locator.bind(OutputQueue, output_queue_map(args.output, args.batch_size))
 
-    domains_queue = RabbitMQQueue(uri=os.getenv("DOMAINS_QUEUE_NAME"),
-                                  exchange=os.getenv("DOMAINS_EXCHANGE_NAME"),
-                                  routing=os.getenv("DOMAINS_ROUTING_KEY"))
-
-    domains_rmq = RabbitMQ(domains_queue, RabbitMQConnectionClient(os.getenv("RABBITMQ_CONNECTION_STRING")))
-    domains_rmq.connect()
-    service_locator.bind(OutputQueue, RMQQueue(domains_rmq))
-
-    populate(crawling_type, args.limit)
+    checkpoint = FileCheckpoint(args.checkpoint) if args.checkpoint else None
+    populate(crawling_types, args.limit, args.progress, checkpoint)
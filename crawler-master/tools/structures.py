@@ -1,5 +1,6 @@
 from dataclasses import dataclass
 from enum import Enum
+from typing import List, Optional
 
 
 class CrawlingType(Enum):
@@ -12,6 +13,9 @@ class CrawlingType(Enum):
     SOA = "soa"
     TXT = "txt"
     CAREERS = "careers"
+    DNS = "dns"
+    # Source, escalated to render when the page needs JavaScript
+    AUTO = "auto"
 
     @classmethod
     def get_by_index(cls, index):
@@ -22,7 +26,13 @@ class CrawlingType(Enum):
         raise RuntimeError("Type is not specified for {}".format(index))
 
 
+# Record types resolved by a single CrawlingType.DNS message
+DNS_RECORD_TYPES = [CrawlingType.SPF, CrawlingType.TXT, CrawlingType.MX,
+                    CrawlingType.NS, CrawlingType.SOA, CrawlingType.CNAME]
+
+
 @dataclass
 class URLObject:
     url: str
     crawling_type: CrawlingType
+    record_types: Optional[List[CrawlingType]] = None